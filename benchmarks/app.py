@@ -0,0 +1,28 @@
+"""kobo-connect served by its production server, with an in-memory CosmosDB.
+
+Every worker process imports this module, so each worker gets its own
+``FakeCosmosContainer``. Used by ``benchmarks.run --workers``.
+
+Usage:
+    python -m benchmarks.app PORT WORKERS
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.fakes import FakeCosmosContainer  # noqa: E402
+from main import app  # noqa: E402, F401
+from utils import cosmos  # noqa: E402
+from utils.server import run_server  # noqa: E402
+
+cosmos.cosmos_container_client = FakeCosmosContainer(
+    float(os.getenv("BENCHMARK_COSMOS_LATENCY", "0"))
+)
+
+if __name__ == "__main__":
+    run_server("benchmarks.app:app", port=int(sys.argv[1]), workers=int(sys.argv[2]))
@@ -0,0 +1,277 @@
+"""Local stand-ins for Kobo, EspoCRM, Bitrix24, 121 and CosmosDB.
+
+The fake services answer just enough of each API for the kobo-connect routes
+to run end to end. Every fake server takes a ``Faults`` configuration to
+inject latency and errors, and runs as a real HTTP server on localhost so
+that the connection pool, rate limiter and retries of kobo-connect are
+exercised as in production.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import multiprocessing
+import random
+import socket
+import time
+import uuid
+from typing import Any, NamedTuple
+
+import uvicorn
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+
+class Faults(NamedTuple):
+    """Latency and errors injected in the responses of a fake server."""
+
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # random extra latency, up to this many seconds
+    error_rate: float = 0.0  # fraction of requests answered with error_status
+    error_status: int = 503
+
+
+def add_faults(app: FastAPI, faults: Faults):
+    """Delay responses and fail a fraction of them, according to ``faults``."""
+
+    @app.middleware("http")
+    async def inject_faults(request: Request, call_next):
+        delay = faults.latency + random.uniform(0, faults.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if faults.error_rate and random.random() < faults.error_rate:
+            return JSONResponse(
+                status_code=faults.error_status, content={"detail": "Injected error"}
+            )
+        return await call_next(request)
+
+    return app
+
+
+def fake_kobo(
+    faults: Faults = Faults(), attachments: int = 0, attachment_size: int = 100_000
+) -> FastAPI:
+    """Kobo API: submission data, attachments, assets, hooks and deployment."""
+    app = FastAPI()
+    content = random.randbytes(attachment_size)
+    hooks: dict[str, list[dict[str, Any]]] = {}
+
+    @app.get("/api/v2")
+    async def root():
+        return {"assets": "/api/v2/assets/"}
+
+    @app.get("/api/v2/assets/{asset}/data/{submission_id}/")
+    async def submission(asset: str, submission_id: int, request: Request):
+        base_url = str(request.base_url).rstrip("/")
+        return {
+            "_id": submission_id,
+            "_attachments": [
+                {
+                    "filename": f"kobo/attachments/{submission_id}/photo_{i}.jpg",
+                    "mimetype": "image/jpeg",
+                    "download_url": f"{base_url}/media/original"
+                    f"?media_file=kobo/attachments/{submission_id}/photo_{i}.jpg",
+                }
+                for i in range(attachments)
+            ],
+        }
+
+    @app.get("/media/original")
+    async def media(media_file: str):
+        return Response(content=content, media_type="image/jpeg")
+
+    @app.get("/api/v2/assets/{asset}/data.json")
+    async def data(asset: str):
+        return {"count": 0, "next": None, "results": []}
+
+    @app.get("/api/v2/assets/{asset}/")
+    async def get_asset(asset: str):
+        return {
+            "uid": asset,
+            "version_id": "v1",
+            "content": {"survey": [], "choices": []},
+        }
+
+    @app.patch("/api/v2/assets/{asset}/")
+    async def patch_asset(asset: str):
+        return {"uid": asset, "version_id": uuid.uuid4().hex}
+
+    @app.api_route("/api/v2/assets/{asset}/deployment/", methods=["POST", "PATCH"])
+    async def deployment(asset: str):
+        return {"asset": {"deployment_status": "deployed"}}
+
+    @app.get("/api/v2/assets/{asset}/hooks/")
+    async def list_hooks(asset: str):
+        return {"count": len(hooks.get(asset, [])), "results": hooks.get(asset, [])}
+
+    @app.post("/api/v2/assets/{asset}/hooks/", status_code=201)
+    async def create_hook(asset: str, request: Request):
+        hook = {**(await request.json()), "uid": uuid.uuid4().hex}
+        hooks.setdefault(asset, []).append(hook)
+        return hook
+
+    return add_faults(app, faults)
+
+
+def fake_espocrm(faults: Faults = Faults()) -> FastAPI:
+    """EspoCRM API: create, search and update records of any entity."""
+    app = FastAPI()
+
+    @app.get("/api/v1/{entity}")
+    async def search(entity: str):
+        # every lookup matches exactly one record
+        return {"total": 1, "list": [{"id": f"{entity.lower()}-1"}]}
+
+    @app.post("/api/v1/{entity}")
+    async def create(entity: str):
+        return {"id": uuid.uuid4().hex}
+
+    @app.put("/api/v1/{entity}/{record_id}")
+    async def update(entity: str, record_id: str):
+        return {"id": record_id}
+
+    return add_faults(app, faults)
+
+
+def fake_bitrix24(faults: Faults = Faults()) -> FastAPI:
+    """Bitrix24 REST API: add and update CRM items, one by one or in batches."""
+    app = FastAPI()
+    ids = itertools.count(1)
+
+    @app.post("/rest/{user_id}/{key}/batch")
+    async def batch(user_id: str, key: str, request: Request):
+        commands = (await request.json())["cmd"]
+        return {
+            "result": {
+                "result": {name: {"item": {"id": next(ids)}} for name in commands},
+                "result_error": [],
+            },
+            "time": {},
+        }
+
+    @app.post("/rest/{user_id}/{key}/{method}")
+    async def call(user_id: str, key: str, method: str):
+        return {"result": {"item": {"id": next(ids)}}, "time": {}}
+
+    return add_faults(app, faults)
+
+
+def fake_121(faults: Faults = Faults()) -> FastAPI:
+    """121 API: login and registrations of a program."""
+    app = FastAPI()
+
+    @app.post("/api/users/login")
+    async def login():
+        return {"access_token_general": uuid.uuid4().hex, "expires": "2099-01-01T00:00:00Z"}
+
+    @app.get("/api/programs/{program_id}/registrations")
+    async def registrations(program_id: int):
+        return {"data": [], "meta": {}}
+
+    @app.post("/api/programs/{program_id}/registrations", status_code=201)
+    async def import_registrations(program_id: int, request: Request):
+        return {"aggregateImportResult": {"countImported": len(await request.json())}}
+
+    @app.patch("/api/programs/{program_id}/registrations/{reference_id}")
+    async def update_registration(program_id: int, reference_id: str):
+        return {"referenceId": reference_id}
+
+    return add_faults(app, faults)
+
+
+class FakeServer:
+    """Run an ASGI app with uvicorn on a free localhost port.
+
+    The server runs in a forked process, so that it does not compete with
+    kobo-connect for the GIL and the measurements only include kobo-connect.
+    """
+
+    def __init__(self, app: FastAPI):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        config = uvicorn.Config(
+            app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="off"
+        )
+        self.server = uvicorn.Server(config)
+        self.process = multiprocessing.get_context("fork").Process(
+            target=self.server.run, daemon=True
+        )
+
+    def __enter__(self) -> "FakeServer":
+        self.process.start()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except OSError:
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    raise RuntimeError(f"Fake server on port {self.port} did not start")
+                time.sleep(0.01)
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+
+class FakeCosmosContainer:
+    """In-memory CosmosDB container with the operations used by utils.cosmos.
+
+    Queries are not evaluated: ``query_items`` returns all items.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.items: dict[tuple[str, str], dict[str, Any]] = {}
+
+    async def _wait(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _store(self, item: dict[str, Any]) -> dict[str, Any]:
+        item = {**item, "_etag": uuid.uuid4().hex}
+        self.items[(item["id"], item["uuid"])] = item
+        return dict(item)
+
+    async def create_item(self, body):
+        await self._wait()
+        if (body["id"], body["uuid"]) in self.items:
+            raise CosmosResourceExistsError(message="Resource already exists")
+        return self._store(body)
+
+    async def read_item(self, item, partition_key):
+        await self._wait()
+        if (item, partition_key) not in self.items:
+            raise CosmosResourceNotFoundError(message="Resource not found")
+        return dict(self.items[(item, partition_key)])
+
+    async def patch_item(
+        self, item, partition_key, patch_operations, etag=None, match_condition=None
+    ):
+        await self._wait()
+        stored = self.items.get((item, partition_key))
+        if stored is None:
+            raise CosmosResourceNotFoundError(message="Resource not found")
+        if etag is not None and stored["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(message="Precondition failed")
+        stored = dict(stored)
+        for operation in patch_operations:
+            stored[operation["path"].lstrip("/")] = operation["value"]
+        return self._store(stored)
+
+    async def query_items(self, query, parameters=None, **kwargs):
+        await self._wait()
+        for item in list(self.items.values()):
+            yield dict(item)
+
+    async def read(self):
+        await self._wait()
+        return {"id": "kobo-submissions"}
@@ -0,0 +1,98 @@
+"""Compare the EspoCRM query string encoder with its previous, recursive version.
+
+Usage:
+    python -m benchmarks.query_string
+    python -m benchmarks.query_string --repeat 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import timeit
+import urllib.parse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from clients.espo_api_client import encode_query, http_build_query  # noqa: E402
+
+
+def legacy_http_build_query(data):
+    """Previous implementation of clients.espo_api_client.http_build_query."""
+    parents = list()
+    pairs = dict()
+
+    def renderKey(parents):
+        depth, outStr = 0, ""
+        for x in parents:
+            s = "[%s]" if depth > 0 or isinstance(x, int) else "%s"
+            outStr += s % str(x)
+            depth += 1
+        return outStr
+
+    def r_urlencode(data):
+        if isinstance(data, list) or isinstance(data, tuple):
+            for i in range(len(data)):
+                parents.append(i)
+                r_urlencode(data[i])
+                parents.pop()
+        elif isinstance(data, dict):
+            for key, value in data.items():
+                parents.append(key)
+                r_urlencode(value)
+                parents.pop()
+        else:
+            pairs[renderKey(parents)] = str(data)
+
+        return pairs
+
+    return urllib.parse.urlencode(r_urlencode(data))
+
+
+PARAMS = {
+    # related-entity lookup
+    "lookup": {"where": [{"type": "equals", "attribute": "name", "value": "Ådne Øster"}]},
+    # updaterecordby search
+    "search": {"where": [{"type": "contains", "attribute": "phone", "value": "+31612345678"}]},
+    # list request with several conditions and options
+    "list": {
+        "select": "id,name",
+        "maxSize": 50,
+        "orderBy": "createdAt",
+        "where": [
+            {"type": "equals", "attribute": "status", "value": "Active"},
+            {"type": "in", "attribute": "type", "value": ["A", "B", "C"]},
+            {
+                "type": "or",
+                "value": [
+                    {"type": "isNull", "attribute": "deletedAt"},
+                    {"type": "after", "attribute": "modifiedAt", "value": "2024-01-01"},
+                ],
+            },
+        ],
+    },
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    print(f"{'params':<8}{'legacy':>10}{'new':>10}{'query':>10}{'speed-up':>10}")
+    for name, params in PARAMS.items():
+        assert http_build_query(params) == legacy_http_build_query(params)
+        assert encode_query(params) == legacy_http_build_query(params)
+        times = [
+            min(timeit.repeat(lambda: f(params), number=args.repeat, repeat=3)) / args.repeat
+            for f in (legacy_http_build_query, http_build_query, encode_query)
+        ]
+        print(
+            f"{name:<8}{times[0] * 1e6:>8.1f}µs{times[1] * 1e6:>8.1f}µs"
+            f"{times[2] * 1e6:>8.1f}µs{times[0] / times[2]:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
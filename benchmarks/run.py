@@ -0,0 +1,359 @@
+"""Benchmark kobo-connect against local fake services.
+
+Starts fake Kobo and target servers (see ``benchmarks.fakes``), replaces
+CosmosDB with an in-memory container, and sends submissions based on the test
+fixtures to ``main.app`` at a controlled concurrency. Reports throughput,
+latency percentiles and memory usage.
+
+With ``--workers``, kobo-connect is served over HTTP by its production server
+(see ``utils.server``) with the given number of worker processes; several
+values compare the throughput, e.g. on a multi-core machine.
+
+Usage:
+    python -m benchmarks.run --scenario espocrm --requests 500 --concurrency 20
+    python -m benchmarks.run --scenario espocrm --attachments 2 --target-latency 0.05
+    python -m benchmarks.run --scenario 121 --target-error-rate 0.05 --json
+    python -m benchmarks.run --workers 1 2 4 --requests 2000 --concurrency 64
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.fakes import (  # noqa: E402
+    FakeCosmosContainer,
+    FakeServer,
+    Faults,
+    fake_121,
+    fake_bitrix24,
+    fake_espocrm,
+    fake_kobo,
+)
+
+ROOT = Path(__file__).resolve().parents[1]
+FIXTURES = ROOT / "tests"
+SCENARIOS = ("espocrm", "bitrix24", "121")
+
+
+def load_fixture(name: str) -> dict[str, Any]:
+    with open(FIXTURES / name) as file:
+        return json.load(file)
+
+
+def build_scenario(
+    args: argparse.Namespace, kobo_url: str, target_url: str
+) -> tuple[str, dict[str, str], dict[str, Any]]:
+    """Return the route, headers and submission template of a scenario."""
+    if args.scenario == "espocrm":
+        submission = load_fixture("kobo_data_espo.json")
+        headers = {
+            "targeturl": target_url,
+            "targetkey": "benchmark",
+            "task_name": "CTask.taskName",
+            "due_date": "CTask.dueDate",
+        }
+        for i in range(args.related):
+            submission[f"related_{i}"] = f"value {i}"
+            headers[f"related_{i}"] = f"CTask.account{i}.name"
+        for i in range(1, args.entities):
+            submission[f"note_{i}"] = f"note {i}"
+            headers[f"note_{i}"] = f"CNote{i}.description"
+        path = "/kobo-to-espocrm"
+    elif args.scenario == "bitrix24":
+        submission = load_fixture("kobo_data_espo.json")
+        headers = {
+            "targeturl": target_url,
+            "targetkey": "benchmark",
+            "entitytypeid": "1",
+            "task_name": "TITLE",
+            "due_date": "UF_DUE_DATE",
+        }
+        path = "/kobo-to-bitrix24"
+    else:
+        submission = load_fixture("kobo_data.json")
+        headers = {
+            key.lower(): value
+            for key, value in load_fixture("kobo_headers.json").items()
+            if key.lower() not in ("host", "content-length")
+        }
+        headers["url121"] = target_url
+        path = "/kobo-to-121"
+
+    if args.batch_writes and args.scenario != "121":
+        headers["batchwrites"] = "true"
+    if args.attachments:
+        headers["kobotoken"] = "benchmark"
+        headers["koboasset"] = "benchmark"
+        field_prefix = {"espocrm": "CTask.photo", "bitrix24": "UF_PHOTO_"}.get(
+            args.scenario, "photo"
+        )
+        # Kobo sends the attachments in the submission; EspoCRM and 121 fetch them again
+        submission["_attachments"] = [
+            {
+                "filename": f"kobo/attachments/photo_{i}.jpg",
+                "mimetype": "image/jpeg",
+                "download_url": f"{kobo_url}/media/original"
+                f"?media_file=kobo/attachments/photo_{i}.jpg",
+            }
+            for i in range(args.attachments)
+        ]
+        for i in range(args.attachments):
+            submission[f"photo_{i}"] = f"photo_{i}.jpg"
+            field = f"photo_{i}" if args.scenario != "bitrix24" else f"attachment-photo_{i}"
+            headers[field] = f"{field_prefix}{i}"
+    return path, headers, submission
+
+
+def percentile(quantiles: list[float], p: int) -> float:
+    return quantiles[p - 1] if quantiles else 0.0
+
+
+@contextmanager
+def production_server(workers: int):
+    """Serve kobo-connect with its production server in a new process."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.app", str(port), str(workers)],
+        cwd=ROOT,
+        env={**os.environ, "SERVER_ACCESS_LOG": "false"},
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if httpx.get(f"{url}/health").status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError(f"kobo-connect did not start on port {port}")
+            time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def drive(
+    transport: httpx.AsyncBaseTransport,
+    base_url: str,
+    path: str,
+    headers: dict[str, str],
+    template: dict[str, Any],
+    args,
+) -> dict[str, Any]:
+    """Send the submissions and measure the latency of every request."""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+    statuses: Counter = Counter()
+
+    async def send(client: httpx.AsyncClient, i: int):
+        submission = copy.deepcopy(template)
+        submission["_id"] = 10_000_000 + i
+        submission["_uuid"] = str(uuid.uuid4())
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, headers=headers, json=submission)
+                statuses[str(response.status_code)] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=None) as client:
+        # warm up connections and caches before measuring
+        await asyncio.gather(*(send(client, -i - 1) for i in range(args.warmup)))
+        latencies.clear()
+        statuses.clear()
+
+        # tracemalloc slows down every allocation: only trace memory on request
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        await asyncio.gather(*(send(client, i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    from clients.http_client import close_http_client
+
+    await close_http_client()
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else []
+    return {
+        "scenario": args.scenario,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(args.requests / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(quantiles, 50) * 1000, 1),
+            "p95": round(percentile(quantiles, 95) * 1000, 1),
+            "p99": round(percentile(quantiles, 99) * 1000, 1),
+            "max": round(max(latencies, default=0) * 1000, 1),
+        },
+        "status_codes": dict(statuses),
+        "peak_traced_memory_mb": round(peak_memory / 2**20, 1) if args.trace_memory else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, default="espocrm")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--attachments", type=int, default=0, help="attachments per submission")
+    parser.add_argument("--attachment-size", type=int, default=100_000, help="bytes")
+    parser.add_argument(
+        "--attachment-delay", type=float, default=0.0,
+        help="seconds kobo-connect waits for Kobo to store attachments (KOBO_ATTACHMENT_DELAY)",
+    )
+    parser.add_argument("--related", type=int, default=0, help="related-entity lookups (espocrm)")
+    parser.add_argument(
+        "--entities", type=int, default=1, help="records created per submission (espocrm)"
+    )
+    parser.add_argument(
+        "--batch-writes", action="store_true",
+        help="send the batchwrites header (espocrm, bitrix24)",
+    )
+    parser.add_argument("--kobo-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--kobo-error-rate", type=float, default=0.0)
+    parser.add_argument("--target-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--target-jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--target-error-rate", type=float, default=0.0)
+    parser.add_argument("--target-error-status", type=int, default=503)
+    parser.add_argument("--cosmos-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument(
+        "--rate-limit", type=float, default=10_000,
+        help="outbound requests per second per host (RATE_LIMIT_DEFAULT_RPS)",
+    )
+    parser.add_argument(
+        "--trace-memory", action="store_true",
+        help="report the peak memory allocated while sending (slows down kobo-connect)",
+    )
+    parser.add_argument(
+        "--workers", type=int, nargs="+",
+        help="serve kobo-connect over HTTP with this many worker processes (WEB_CONCURRENCY); "
+        "several values are compared",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def print_report(report: dict[str, Any]):
+    workers = f", {report['workers']} workers" if report["workers"] else ""
+    print(f"scenario      {report['scenario']} ({report['requests']} requests, "
+          f"concurrency {report['concurrency']}{workers})")
+    print(f"throughput    {report['throughput_rps']} requests/s")
+    latency = report["latency_ms"]
+    print(f"latency       p50 {latency['p50']} ms, p95 {latency['p95']} ms, "
+          f"p99 {latency['p99']} ms, max {latency['max']} ms")
+    print(f"status codes  {report['status_codes']}")
+    if report["workers"]:
+        return
+    memory = f"max RSS {report['max_rss_mb']} MB"
+    if report["peak_traced_memory_mb"] is not None:
+        memory = f"peak traced {report['peak_traced_memory_mb']} MB, {memory}"
+    print(f"memory        {memory}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    kobo_faults = Faults(latency=args.kobo_latency, error_rate=args.kobo_error_rate)
+    target_faults = Faults(
+        latency=args.target_latency,
+        jitter=args.target_jitter,
+        error_rate=args.target_error_rate,
+        error_status=args.target_error_status,
+    )
+    target_app = {"espocrm": fake_espocrm, "bitrix24": fake_bitrix24, "121": fake_121}[
+        args.scenario
+    ](target_faults)
+
+    with ExitStack() as stack:
+        kobo = stack.enter_context(
+            FakeServer(fake_kobo(kobo_faults, args.attachments, args.attachment_size))
+        )
+        target = stack.enter_context(FakeServer(target_app))
+        cache_dir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        # configuration is read when kobo-connect is imported
+        os.environ.update(
+            {
+                "PORT": os.getenv("PORT", "8000"),
+                "KOBO_URL": kobo.url,
+                "KOBO_MEDIA_URL": f"{kobo.url}/media/original",
+                "KOBO_ATTACHMENT_DELAY": str(args.attachment_delay),
+                "KOBO_ATTACHMENT_RETRY_DELAY": "0",
+                "ATTACHMENT_CACHE_DIR": cache_dir,
+                "RATE_LIMIT_DEFAULT_RPS": str(args.rate_limit),
+                "RATE_LIMIT_DEFAULT_BURST": str(args.rate_limit),
+                # all submissions are of one form: do not cap them below --concurrency
+                "SCHEDULER_MAX_CONCURRENCY": str(args.concurrency),
+                "SCHEDULER_TENANT_MAX_CONCURRENCY": str(args.concurrency),
+                "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+            }
+        )
+        path, headers, template = build_scenario(args, kobo.url, target.url)
+        reports = []
+        if args.workers:
+            # memory is not measured in the worker processes
+            args.trace_memory = False
+            os.environ["BENCHMARK_COSMOS_LATENCY"] = str(args.cosmos_latency)
+            for workers in args.workers:
+                with production_server(workers) as url:
+                    transport = httpx.AsyncHTTPTransport(
+                        limits=httpx.Limits(max_connections=args.concurrency)
+                    )
+                    report = asyncio.run(drive(transport, url, path, headers, template, args))
+                report.update(workers=workers, max_rss_mb=None)
+                reports.append(report)
+        else:
+            from main import app
+            from utils import cosmos
+
+            cosmos.cosmos_container_client = FakeCosmosContainer(args.cosmos_latency)
+            transport = httpx.ASGITransport(app=app)
+            report = asyncio.run(
+                drive(transport, "http://kobo-connect", path, headers, template, args)
+            )
+            report.update(workers=None)
+            reports.append(report)
+
+    if args.json:
+        print(json.dumps(reports[0] if len(reports) == 1 else reports, indent=2))
+        return
+    for i, report in enumerate(reports):
+        if i:
+            print()
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
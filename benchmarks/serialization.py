@@ -0,0 +1,100 @@
+"""Compare the CPU time of JSON serialization with the standard library and orjson.
+
+Payloads: a 121 program definition (as returned by create-121-program-from-kobo)
+scaled up to many attributes, a set of EspoCRM records (as returned by
+kobo-to-espocrm), and a large Kobo submission.
+
+Usage:
+    python -m benchmarks.serialization
+    python -m benchmarks.serialization --scale 50 --repeat 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from starlette.responses import JSONResponse
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils import fastjson  # noqa: E402
+from utils.fastjson import FastJSONResponse  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parents[1] / "tests"
+
+
+def build_payloads(scale: int) -> dict[str, object]:
+    with open(FIXTURES / "program121.json") as file:
+        program = json.load(file)
+    program["programRegistrationAttributes"] = [
+        {**attribute, "name": f"{attribute.get('name', 'attribute')}_{i}"}
+        for i in range(scale)
+        for attribute in program.get("programRegistrationAttributes", [])
+    ]
+    records = {
+        f"Entity{e}": {
+            "id": f"{e:017x}",
+            "name": f"Record {e}",
+            "createdAt": "2024-01-01 00:00:00",
+            "description": "Lorem ipsum dolor sit amet, consectetur adipiscing élit. " * 4,
+            **{f"field{f}": f"value {f}" for f in range(40)},
+        }
+        for e in range(scale)
+    }
+    with open(FIXTURES / "kobo_data.json") as file:
+        submission = json.load(file)
+    submission["household"] = [
+        {f"household/member_{f}": f"value {i} {f}" for f in range(20)}
+        for i in range(scale * 10)
+    ]
+    submission["_geolocation"] = [[52.0 + i / 1000, 4.0 + i / 1000] for i in range(scale * 100)]
+    return {"121 program": program, "EspoCRM records": records, "Kobo submission": submission}
+
+
+def cpu_time(function, repeat: int) -> float:
+    """CPU seconds per call, best of 3 rounds."""
+    rounds = []
+    for _ in range(3):
+        start = time.process_time()
+        for _ in range(repeat):
+            function()
+        rounds.append((time.process_time() - start) / repeat)
+    return min(rounds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=20, help="size multiplier of the payloads")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    print(f"{'payload':<18}{'operation':<10}{'size':>10}{'stdlib':>12}{'orjson':>12}{'saved':>8}")
+    for name, payload in build_payloads(args.scale).items():
+        encoded = fastjson.dumps(payload)
+        cases = {
+            # response rendering, as done for every route
+            "response": (
+                lambda: JSONResponse(payload).body,
+                lambda: FastJSONResponse(payload).body,
+            ),
+            # outbound request bodies
+            "encode": (lambda: json.dumps(payload).encode(), lambda: fastjson.dumps(payload)),
+            # inbound submissions and downstream responses
+            "decode": (lambda: json.loads(encoded), lambda: fastjson.loads(encoded)),
+        }
+        for operation, (stdlib, fast) in cases.items():
+            stdlib_time = cpu_time(stdlib, args.repeat)
+            fast_time = cpu_time(fast, args.repeat)
+            print(
+                f"{name:<18}{operation:<10}{len(encoded) / 1024:>8.0f}kB"
+                f"{stdlib_time * 1e6:>10.0f}µs{fast_time * 1e6:>10.0f}µs"
+                f"{1 - fast_time / stdlib_time:>8.0%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
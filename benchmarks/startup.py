@@ -0,0 +1,91 @@
+"""Measure the time to import kobo-connect, i.e. the bulk of a cold start.
+
+Imports ``main`` in fresh interpreters with ``python -X importtime`` and
+reports the total import time and the imports of ``main`` that take the
+longest, including the modules they import in turn.
+
+Usage:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --repeat 10 --top 20 --json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def import_times(module: str) -> tuple[int, dict[str, int]]:
+    """Import time of a module and of each of its imports, in microseconds.
+
+    Times are cumulative: they include the modules imported in turn.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env={"PORT": "8000", **os.environ},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # modules are listed after their imports, indented by two spaces per level
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            imports[name.strip()] = int(cumulative)
+        elif depth == 0 and name.strip() == module:
+            return int(cumulative), imports
+        elif depth == 0:
+            imports = {}
+    raise RuntimeError(f"{module} is missing from the import times")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to report")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    totals = []
+    runs = defaultdict(list)
+    for _ in range(args.repeat):
+        total, imports = import_times(args.module)
+        totals.append(total)
+        for name, microseconds in imports.items():
+            runs[name].append(microseconds)
+    medians = {name: statistics.median(times) / 1000 for name, times in runs.items()}
+    slowest = sorted(medians.items(), key=lambda item: item[1], reverse=True)[: args.top]
+    report = {
+        "module": args.module,
+        "repeat": args.repeat,
+        "import_ms": round(statistics.median(totals) / 1000, 1),
+        "slowest_ms": {name: round(ms, 1) for name, ms in slowest},
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"import {report['module']}  {report['import_ms']} ms (median of {args.repeat})")
+    for name, ms in report["slowest_ms"].items():
+        print(f"  {name:<40} {ms:>8} ms")
+
+
+if __name__ == "__main__":
+    main()
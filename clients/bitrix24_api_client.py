@@ -1,8 +1,25 @@
+from __future__ import annotations
+
+import os
+from typing import Any
+
+from dotenv import load_dotenv
 from fastapi import HTTPException
 from utils.logger import logger
-from utils.cosmos import update_submission_status
-import json
-import requests
+from utils.write_buffer import WriteBuffer
+from clients import http_client
+from clients.query_string import http_build_query
+from clients.rate_limiter import configure_rate_limit
+from utils import fastjson
+from urllib.parse import urlsplit
+
+# load environment variables
+load_dotenv()
+
+# Bitrix24 runs at most 50 commands per call of the batch method
+BATCH_MAX_COMMANDS = 50
+# a batch is sent when full or this many seconds after its first command
+BITRIX24_BATCH_DELAY = float(os.getenv("BITRIX24_BATCH_DELAY", "0.5"))
 
 
 class Bitrix24:
@@ -12,16 +29,19 @@ class Bitrix24:
         if url.endswith("/"):
             url = url[:-1]
         self.url = url + "/rest/" + user_id + "/" + key + "/"
+        # Bitrix24 allows 2 requests per second, with bursts of up to 50
+        configure_rate_limit(urlsplit(url).netloc, rate=2, burst=50)
 
-    def request(self, method, endpoint, payload=None, params=None, logs=None):
+    async def request(self, method, endpoint, payload=None, params=None, logs=None):
         """Make a request to Bitrix24. If the request fails, update submission status in CosmosDB."""
         headers = {"Content-Type": "application/json"}
-        response = requests.request(
-            method=method,
-            url=self.url + endpoint,
+        response = await http_client.request(
+            method,
+            self.url + endpoint,
             headers=headers,
-            data=json.dumps(payload),
+            content=fastjson.dumps(payload),
             params=params,
+            entity=endpoint,
         )
 
         if response.status_code != 200:
@@ -29,9 +49,67 @@ class Bitrix24:
                 f"Failed: Bitrix24 returned {response.status_code} {response.content}",
                 extra=logs,
             )
-            # update_submission_status(submission, "failed", response.content)
             raise HTTPException(
                 status_code=response.status_code, detail=f"{response.content}"
             )
 
-        return response.json()
+        return fastjson.loads(response.content)
+
+    async def batch(self, commands: dict[str, tuple[str, dict]], halt=False, logs=None):
+        """Run up to 50 methods in a single call of the batch method.
+
+        ``commands`` maps a name to a method and its parameters. Returns the
+        results and the errors of the commands, by name.
+        """
+        if len(commands) > BATCH_MAX_COMMANDS:
+            raise ValueError(f"Bitrix24 batch is limited to {BATCH_MAX_COMMANDS} commands")
+        payload = {
+            "halt": int(halt),
+            "cmd": {
+                name: f"{method}?{http_build_query(params)}"
+                for name, (method, params) in commands.items()
+            },
+        }
+        response = await self.request("POST", "batch", payload, logs=logs)
+        # empty results are returned as lists
+        result = response.get("result") or {}
+        return result.get("result") or {}, result.get("result_error") or {}
+
+
+async def run_batch(key: str, items: list[tuple[Bitrix24, str, dict, Any]]) -> list[dict]:
+    """Send the calls of several submissions to the same webhook in one batch.
+
+    The batch carries the logs of none of them: each submission logs the
+    outcome of its own call (see ``batched_call``).
+    """
+    client = items[0][0]
+    commands = {f"cmd{i}": (method, params) for i, (_, method, params, _) in enumerate(items)}
+    results, errors = await client.batch(commands)
+    responses = []
+    for name in commands:
+        if name in results:
+            responses.append({"result": results[name]})
+        else:
+            error = errors.get(name) or {"error": "Command not executed"}
+            responses.append(error if isinstance(error, dict) else {"error": str(error)})
+    return responses
+
+
+bitrix24_batch_buffer = WriteBuffer(
+    "bitrix24", run_batch, max_batch=BATCH_MAX_COMMANDS, max_delay=BITRIX24_BATCH_DELAY
+)
+
+
+async def batched_call(client: Bitrix24, method: str, params: dict, logs=None) -> dict:
+    """Call a method through the batch of its webhook.
+
+    Returns the same response as a single call: ``{"result": ...}`` on success,
+    or the Bitrix24 error (``error``, ``error_description``) on failure.
+    The batch is sent in time for the earliest deadline of its submissions.
+    """
+    try:
+        return await bitrix24_batch_buffer.submit(client.url, (client, method, params, logs))
+    except HTTPException as e:
+        logger.error(f"Failed: Bitrix24 batch returned {e.status_code} {e.detail}", extra=logs)
+        raise
+
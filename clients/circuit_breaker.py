@@ -0,0 +1,100 @@
+"""Per-host circuit breakers for outbound requests.
+
+After CIRCUIT_FAILURE_THRESHOLD consecutive failures towards a host
+(transport errors, 502 or 504), its circuit opens: calls to it fail at once
+with ``CircuitOpenError`` for CIRCUIT_OPEN_SECONDS. Then the circuit is
+half-open: a single call is let through as a probe, which closes the circuit
+if it succeeds and opens it again if it fails.
+
+Refused requests (429, 503) are left to the rate limiter, which slows down
+instead of stopping.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+# load environment variables
+load_dotenv()
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_FAILURE_STATUS_CODES = (502, 504)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """The circuit of the target host is open, the request was not sent."""
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        # seconds until the next probe
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Circuit breaker of a target host."""
+
+    def __init__(
+        self,
+        host: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        open_seconds: float = CIRCUIT_OPEN_SECONDS,
+    ):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return "closed"
+        if time.monotonic() < self.opened_until:
+            return "open"
+        return "half-open"
+
+    def retry_after(self) -> float:
+        """Seconds until the next probe, 0 if calls are let through."""
+        if self.state == "closed":
+            return 0.0
+        return max(self.opened_until - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """Whether a call may be sent; in half-open state, only one probe at a time."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def record(self, success: bool | None, probe: bool = False):
+        """Record the outcome of a call (None if it was cancelled)."""
+        if probe:
+            self.probing = False
+        if success is None:
+            return
+        if success:
+            self.failures = 0
+            return
+        self.failures += 1
+        if probe or self.failures == self.failure_threshold:
+            self.opened_until = time.monotonic() + self.open_seconds
+
+
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(host: str) -> CircuitBreaker:
+    """Get the shared circuit breaker of a host."""
+    host = host.lower()
+    if host not in breakers:
+        breakers[host] = CircuitBreaker(host)
+    return breakers[host]
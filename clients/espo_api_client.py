@@ -1,37 +1,43 @@
-import requests
-import urllib
+import functools
+import urllib.parse
 from fastapi import HTTPException
+from clients import http_client
+from clients.query_string import CONTAINERS, http_build_query
+from utils import fastjson
 
 
-def http_build_query(data):
-    parents = list()
-    pairs = dict()
-
-    def renderKey(parents):
-        depth, outStr = 0, ""
-        for x in parents:
-            s = "[%s]" if depth > 0 or isinstance(x, int) else "%s"
-            outStr += s % str(x)
-            depth += 1
-        return outStr
-
-    def r_urlencode(data):
-        if isinstance(data, list) or isinstance(data, tuple):
-            for i in range(len(data)):
-                parents.append(i)
-                r_urlencode(data[i])
-                parents.pop()
-        elif isinstance(data, dict):
-            for key, value in data.items():
-                parents.append(key)
-                r_urlencode(value)
-                parents.pop()
-        else:
-            pairs[renderKey(parents)] = str(data)
+# search conditions have this shape: only the value changes between lookups
+WHERE_KEYS = ("type", "attribute", "value")
+
+
+@functools.lru_cache(maxsize=1024)
+def where_query_template(condition_type, attribute):
+    """Encoded query of a search condition, without its value."""
+    query = http_build_query({"where": [{"type": condition_type, "attribute": attribute}]})
+    return f"{query}&{urllib.parse.quote_plus('where[0][value]')}="
+
 
-        return pairs
+def encode_query(params):
+    """Encode the query of a GET request.
 
-    return urllib.parse.urlencode(r_urlencode(data))
+    Searches by a single field value reuse the encoded template of their
+    condition; anything else is encoded with http_build_query.
+    """
+    if len(params) == 1 and "where" in params:
+        where = params["where"]
+        if isinstance(where, list) and len(where) == 1:
+            condition = where[0]
+            if (
+                isinstance(condition, dict)
+                and tuple(condition) == WHERE_KEYS
+                and isinstance(condition["type"], str)
+                and isinstance(condition["attribute"], str)
+                and not isinstance(condition["value"], CONTAINERS)
+            ):
+                return where_query_template(
+                    condition["type"], condition["attribute"]
+                ) + urllib.parse.quote_plus(str(condition["value"]))
+    return http_build_query(params)
 
 
 class EspoAPI:
@@ -45,7 +51,7 @@ class EspoAPI:
         self.api_key = api_key
         self.status_code = None
 
-    def request(self, method, action, params=None):
+    async def request(self, method, action, params=None):
         if params is None:
             params = {}
 
@@ -59,9 +65,11 @@ class EspoAPI:
         if method in ["POST", "PATCH", "PUT"]:
             kwargs["json"] = params
         else:
-            kwargs["url"] = kwargs["url"] + "?" + http_build_query(params)
+            kwargs["url"] = kwargs["url"] + "?" + encode_query(params)
 
-        response = requests.request(method, **kwargs)
+        response = await http_client.request(
+            method, entity=action.split("/")[0], **kwargs
+        )
 
         self.status_code = response.status_code
 
@@ -73,7 +81,7 @@ class EspoAPI:
         if not data:
             raise HTTPException(status_code=204, detail=f"Content response is empty")
 
-        return response.json()
+        return fastjson.loads(data)
 
     def normalize_url(self, action):
         return self.url + self.url_path + action
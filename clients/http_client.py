@@ -0,0 +1,260 @@
+"""Shared async HTTP client for all outbound requests.
+
+Connections are pooled per host and every request goes through the rate
+limiter of its target host, so that bursts of submissions are smoothed
+instead of being rejected by EspoCRM, Bitrix24 or 121. Failed requests are
+retried according to a retry policy (see ``clients.retry``), unless the
+circuit of the host is open (see ``clients.circuit_breaker``). Every attempt has
+connect and read timeouts, capped to the deadline of the submission being
+processed (see ``utils.deadline``).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
+
+import httpx
+from clients.circuit_breaker import (
+    CIRCUIT_FAILURE_STATUS_CODES,
+    CircuitOpenError,
+    get_circuit_breaker,
+)
+from clients.rate_limiter import (
+    THROTTLE_STATUS_CODES,
+    get_rate_limiter,
+    parse_retry_after,
+)
+from clients.retry import (
+    CONNECT_ERRORS,
+    DEFAULT_RETRY_POLICY,
+    IDEMPOTENT_METHODS,
+    RetryPolicy,
+    get_retry_budget,
+    retry_reason,
+)
+from utils import fastjson
+from utils.deadline import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, get_timeout, remaining
+from utils.logger import logger
+from utils.metrics import DOWNSTREAM_ERRORS, DOWNSTREAM_LATENCY, DOWNSTREAM_TIMEOUT_SECONDS
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from utils.tracing import span_attributes, tracer
+
+shared_client = None
+shared_client_loop = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client of the running event loop."""
+    global shared_client, shared_client_loop
+
+    loop = asyncio.get_running_loop()
+    if shared_client is None or shared_client_loop is not loop:
+        shared_client = httpx.AsyncClient(
+            headers={"User-Agent": "kobo-connect"},
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+        shared_client_loop = loop
+    return shared_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client and its connection pool."""
+    global shared_client, shared_client_loop
+
+    if shared_client is not None:
+        await shared_client.aclose()
+    shared_client = None
+    shared_client_loop = None
+
+
+async def request(
+    method: str,
+    url: str,
+    *,
+    idempotent: bool | None = None,
+    idempotency_key: str | None = None,
+    lookup: Callable[[], Awaitable[httpx.Response | None]] | None = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    entity: str = "",
+    **kwargs,
+) -> httpx.Response:
+    """Send a request through the rate limiter of the target host, with retries.
+
+    Requests whose outcome is unknown after a failure (read errors, 502, 504)
+    are only retried if they are safe to repeat: ``idempotent`` (by default
+    derived from the method), sent with an ``idempotency_key`` (passed to the
+    target as ``Idempotency-Key`` header) or protected by a ``lookup``, which
+    is called before retrying and returns the response to use instead if the
+    request turns out to have been processed already.
+
+    Throttled responses (429/503) reduce the concurrency towards the host and
+    are retried after the ``Retry-After`` delay (or an exponential backoff).
+    Every retried attempt is logged. The latency and errors of every attempt
+    are recorded per host and ``entity`` (e.g. the EspoCRM entity or the
+    Bitrix24 method) in the metrics.
+
+    A ``json`` body is serialized once with orjson, not on every attempt.
+    ``timeout`` (by default HTTP_READ_TIMEOUT and HTTP_CONNECT_TIMEOUT) is
+    capped to the time left before the deadline, and no attempt is started
+    or retried after it. Raises ``CircuitOpenError`` if the circuit of the
+    host is open.
+    """
+    host = urlsplit(url).netloc
+    limiter = get_rate_limiter(host)
+    breaker = get_circuit_breaker(host)
+    budget = get_retry_budget(host)
+    client = get_http_client()
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    if kwargs.get("json") is not None:
+        headers = dict(kwargs.get("headers") or {})
+        if not any(key.lower() == "content-type" for key in headers):
+            headers["Content-Type"] = "application/json"
+        kwargs["headers"] = headers
+        kwargs["content"] = fastjson.dumps(kwargs.pop("json"))
+    if idempotency_key is not None:
+        kwargs["headers"] = {
+            **(kwargs.get("headers") or {}),
+            "Idempotency-Key": idempotency_key,
+        }
+    safe = idempotent or idempotency_key is not None or lookup is not None
+    timeout = kwargs.pop("timeout", None)
+    budget.deposit()
+
+    with tracer.start_as_current_span(
+        f"{method} {host}",
+        kind=SpanKind.CLIENT,
+        attributes={
+            **span_attributes.get(),
+            "http.request.method": method,
+            "server.address": host,
+        },
+    ) as span:
+        attempt = 1
+        while True:
+            probe = breaker.state == "half-open"
+            if not breaker.allow():
+                DOWNSTREAM_ERRORS.labels(host, entity, CircuitOpenError.__name__).inc()
+                if attempt == 1:
+                    raise CircuitOpenError(
+                        f"Circuit of {host} is open", retry_after=breaker.retry_after()
+                    )
+                logger.warning(
+                    f"Giving up {method} {host} after {attempt - 1} attempts: circuit open",
+                    extra={"http_host": host, "http_method": method, "attempt": attempt - 1},
+                )
+                break
+            response, error, retry_after = None, None, None
+            try:
+                await limiter.acquire()
+            except BaseException:
+                # e.g. cancelled while waiting: give the probe back
+                breaker.record(None, probe)
+                raise
+            start = time.perf_counter()
+            try:
+                response = await client.request(
+                    method, url, timeout=get_timeout(timeout), **kwargs
+                )
+            except httpx.TransportError as e:
+                error = e
+                limiter.release()
+                breaker.record(False, probe)
+                DOWNSTREAM_ERRORS.labels(host, entity, type(e).__name__).inc()
+                if isinstance(e, httpx.TimeoutException):
+                    DOWNSTREAM_TIMEOUT_SECONDS.labels(host).inc(time.perf_counter() - start)
+            except BaseException:
+                limiter.release()
+                breaker.record(None, probe)
+                left = remaining()
+                if left is not None and left <= 0:
+                    # cancelled at the deadline of the submission
+                    DOWNSTREAM_TIMEOUT_SECONDS.labels(host).inc(time.perf_counter() - start)
+                raise
+            else:
+                if response.status_code >= 400:
+                    DOWNSTREAM_ERRORS.labels(host, entity, str(response.status_code)).inc()
+                if response.status_code in THROTTLE_STATUS_CODES:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if retry_after is None:
+                        retry_after = retry_policy.backoff(attempt)
+                limiter.release(response.status_code, retry_after)
+                breaker.record(response.status_code not in CIRCUIT_FAILURE_STATUS_CODES, probe)
+            DOWNSTREAM_LATENCY.labels(host, entity).observe(time.perf_counter() - start)
+
+            reason = retry_reason(retry_policy, safe, response, error)
+            if reason is None:
+                break
+            # a throttled host is paused by the rate limiter, no need to wait here
+            delay = 0.0 if retry_after is not None else retry_policy.backoff(attempt)
+            left = remaining()
+            if (
+                attempt >= retry_policy.max_attempts
+                or (left is not None and left <= max(delay, retry_after or 0.0))
+                or not budget.withdraw()
+            ):
+                logger.warning(
+                    f"Giving up {method} {host} after {attempt} attempts: {reason}",
+                    extra={"http_host": host, "http_method": method, "attempt": attempt},
+                )
+                break
+
+            logger.warning(
+                f"Attempt {attempt} of {method} {host} failed: {reason}, "
+                f"retrying in {delay:.1f}s",
+                extra={
+                    "http_host": host,
+                    "http_method": method,
+                    "attempt": attempt,
+                    "retry_reason": reason,
+                },
+            )
+            await asyncio.sleep(delay)
+
+            # the target may have processed the request: check before sending it again
+            processed = (error is not None and not isinstance(error, CONNECT_ERRORS)) or (
+                response is not None
+                and response.status_code in retry_policy.ambiguous_statuses
+            )
+            if not idempotent and lookup is not None and processed:
+                existing = await lookup()
+                if existing is not None:
+                    logger.info(
+                        f"{method} {host} was already processed, not retrying",
+                        extra={"http_host": host, "http_method": method, "attempt": attempt},
+                    )
+                    return existing
+            attempt += 1
+            span.set_attribute("http.resend_count", attempt - 1)
+
+        if response is None:
+            raise error
+        span.set_attribute("http.response.status_code", response.status_code)
+        if response.status_code >= 400:
+            span.set_status(Status(StatusCode.ERROR))
+        return response
+
+
+async def get(url: str, **kwargs) -> httpx.Response:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> httpx.Response:
+    return await request("POST", url, **kwargs)
+
+
+async def put(url: str, **kwargs) -> httpx.Response:
+    return await request("PUT", url, **kwargs)
+
+
+async def patch(url: str, **kwargs) -> httpx.Response:
+    return await request("PATCH", url, **kwargs)
+
+
+async def delete(url: str, **kwargs) -> httpx.Response:
+    return await request("DELETE", url, **kwargs)
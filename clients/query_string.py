@@ -0,0 +1,52 @@
+"""PHP-style query strings, as parsed by EspoCRM and Bitrix24.
+
+Nested lists and dicts are flattened into bracketed keys, e.g.
+``{"where": [{"type": "equals"}]}`` becomes ``where[0][type]=equals``.
+"""
+
+import functools
+import urllib.parse
+
+CONTAINERS = (list, tuple, dict)
+
+
+def http_build_query(data):
+    """Encode data as a PHP-style query string, e.g. ``where[0][type]=equals``."""
+    quote_plus = urllib.parse.quote_plus
+    return "&".join(
+        f"{quote_key(key)}={quote_plus(value)}"
+        for key, value in build_query_pairs(data).items()
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def quote_key(key):
+    """URL-encoded key; the same keys recur in every query."""
+    return urllib.parse.quote_plus(key)
+
+
+def build_query_pairs(data):
+    """Flatten nested lists and dicts into {PHP-style key: string value}."""
+    if not isinstance(data, CONTAINERS):
+        return {"": str(data)}
+    pairs = {}
+    # depth-first, with one iterator per container being encoded
+    stack = [(None, iter(data.items() if isinstance(data, dict) else enumerate(data)))]
+    while stack:
+        prefix, items = stack[-1]
+        for key, value in items:
+            if prefix is not None:
+                key = f"{prefix}[{key!s}]"
+            elif isinstance(key, int):
+                key = f"[{key!s}]"
+            else:
+                key = str(key)
+            if isinstance(value, CONTAINERS):
+                stack.append(
+                    (key, iter(value.items() if isinstance(value, dict) else enumerate(value)))
+                )
+                break
+            pairs[key] = str(value)
+        else:
+            stack.pop()
+    return pairs
@@ -0,0 +1,189 @@
+"""Per-host rate limiting and adaptive concurrency for outbound requests.
+
+Each target host gets a ``HostLimiter`` combining:
+- a token bucket, which smooths bursts to a sustained rate (requests/second);
+- an AIMD concurrency limit: the number of in-flight requests grows by one
+  per window of successful responses and is halved when the host answers
+  429 or 503;
+- a pause honouring the ``Retry-After`` header of throttled responses.
+
+Rates can be configured per host with the ``RATE_LIMITS`` environment
+variable, e.g. ``RATE_LIMITS=espocrm.example.org=5/10,kobo.ifrc.org=20``
+(rate per second, optionally followed by the burst size). Other hosts get the
+default rate, except Kobo itself (the hosts of KOBO_URL and KOBO_MEDIA_URL),
+whose requests are only subject to the concurrency limit. With several worker
+processes (WEB_CONCURRENCY), each worker gets its share of the rate limits.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+# load environment variables
+load_dotenv()
+
+DEFAULT_RATE = float(os.getenv("RATE_LIMIT_DEFAULT_RPS", "10"))
+DEFAULT_BURST = float(os.getenv("RATE_LIMIT_DEFAULT_BURST", "20"))
+MAX_CONCURRENCY = int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", "16"))
+WORKERS = max(int(os.getenv("WEB_CONCURRENCY") or "1"), 1)
+THROTTLE_STATUS_CODES = (429, 503)
+# read like utils.utilsKobo, which cannot be imported by the HTTP client
+UNLIMITED_HOSTS = {
+    urlsplit(os.getenv("KOBO_URL", "https://kobo.ifrc.org")).netloc.lower(),
+    urlsplit(os.getenv("KOBO_MEDIA_URL", "https://kc.ifrc.org/media/original")).netloc.lower(),
+}
+
+
+def parse_rate_limits(value: str) -> dict[str, tuple[float, float]]:
+    """Parse ``host=rate[/burst],...`` into {host: (rate, burst)}."""
+    limits = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        host, limit = item.split("=", 1)
+        rate, _, burst = limit.partition("/")
+        limits[host.strip().lower()] = (float(rate), float(burst or rate))
+    return limits
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header (seconds or HTTP date) into seconds to wait."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of rejecting requests."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class HostLimiter:
+    """Rate limit and adaptive concurrency limit of a single target host."""
+
+    def __init__(
+        self,
+        host: str,
+        rate: float | None = DEFAULT_RATE,
+        burst: float = DEFAULT_BURST,
+        max_concurrency: int = MAX_CONCURRENCY,
+    ):
+        self.host = host
+        # no token bucket without rate limit
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.paused_until = 0.0
+
+    @property
+    def queued(self) -> int:
+        """Number of requests waiting for a concurrency slot."""
+        return len(self.waiters)
+
+    def _wake_waiters(self):
+        while self.waiters and self.in_flight < max(int(self.concurrency), 1):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # hand the slot over to the waiter
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        """Wait for a concurrency slot, a token and the end of any pause."""
+        if not self.waiters and self.in_flight < max(int(self.concurrency), 1):
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                else:
+                    self.waiters.remove(waiter)
+                raise
+
+        delay = self.paused_until - time.monotonic()
+        if self.bucket is not None:
+            delay = max(self.bucket.reserve(), delay)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.release()
+                raise
+
+    def release(self, status_code: int | None = None, retry_after: float | None = None):
+        """Release a slot and adapt the limits to the response of the host."""
+        self.in_flight -= 1
+        if status_code in THROTTLE_STATUS_CODES:
+            self.concurrency = max(self.concurrency / 2, 1.0)
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+        elif status_code is not None and status_code < 500:
+            self.concurrency = min(
+                self.concurrency + 1 / self.concurrency, float(self.max_concurrency)
+            )
+        self._wake_waiters()
+
+
+configured_limits = parse_rate_limits(os.getenv("RATE_LIMITS", ""))
+limiters: dict[str, HostLimiter] = {}
+
+
+def configure_rate_limit(host: str, rate: float, burst: float):
+    """Set the default rate limit of a host, unless configured in RATE_LIMITS."""
+    host = host.lower()
+    if host in configured_limits or host in limiters:
+        return
+    limiters[host] = HostLimiter(host, rate / WORKERS, burst / WORKERS)
+
+
+def get_rate_limiter(host: str) -> HostLimiter:
+    """Get the shared limiter of a host."""
+    host = host.lower()
+    if host not in limiters:
+        if host in configured_limits:
+            rate, burst = configured_limits[host]
+            limiters[host] = HostLimiter(host, rate / WORKERS, burst / WORKERS)
+        elif host in UNLIMITED_HOSTS:
+            limiters[host] = HostLimiter(host, rate=None)
+        else:
+            limiters[host] = HostLimiter(host, DEFAULT_RATE / WORKERS, DEFAULT_BURST / WORKERS)
+    return limiters[host]
@@ -0,0 +1,114 @@
+"""Retry policy of outbound requests.
+
+Failures are retried with exponential backoff (full jitter) according to
+what is known about the request:
+- connection errors: the request never reached the target, always retried;
+- 429/503: the target refused the request, always retried;
+- read errors, 502 and 504: the target may have processed the request, only
+  retried if it is idempotent, carries an idempotency key or can be looked up.
+
+Retries towards a host are limited by a retry budget, so that a failing target
+does not receive a multiple of its normal load.
+"""
+
+from __future__ import annotations
+
+import os
+import random
+import time
+from typing import NamedTuple
+
+import httpx
+from dotenv import load_dotenv
+
+# load environment variables
+load_dotenv()
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class RetryPolicy(NamedTuple):
+    """How often and how fast a request is retried."""
+
+    max_attempts: int = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+    backoff_base: float = float(os.getenv("RETRY_BACKOFF_BASE", "0.5"))
+    backoff_max: float = float(os.getenv("RETRY_BACKOFF_MAX", "20"))
+    refused_statuses: frozenset[int] = frozenset({429, 503})
+    ambiguous_statuses: frozenset[int] = frozenset({502, 504})
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before the given retry (1-based), with full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+NO_RETRY_POLICY = RetryPolicy(max_attempts=1)
+
+
+def retry_reason(
+    policy: RetryPolicy,
+    safe: bool,
+    response: httpx.Response | None,
+    error: Exception | None,
+) -> str | None:
+    """Return why a request should be retried, or None if it should not."""
+    if error is not None:
+        if isinstance(error, CONNECT_ERRORS):
+            return f"connect error ({type(error).__name__})"
+        if safe and isinstance(error, httpx.TransportError):
+            return f"read error ({type(error).__name__})"
+        return None
+    if response.status_code in policy.refused_statuses:
+        return f"status {response.status_code}"
+    if safe and response.status_code in policy.ambiguous_statuses:
+        return f"status {response.status_code}"
+    return None
+
+
+class RetryBudget:
+    """Token bucket limiting retries to a fraction of the requests to a host.
+
+    Every request deposits ``ratio`` tokens and every retry withdraws one; the
+    budget also refills at ``min_per_second`` so that low-traffic hosts can
+    still be retried.
+    """
+
+    def __init__(
+        self,
+        ratio: float = float(os.getenv("RETRY_BUDGET_RATIO", "0.2")),
+        min_per_second: float = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1")),
+        max_balance: float = 10.0,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self.balance = max_balance
+        self.updated = time.monotonic()
+
+    def _refill(self, amount: float):
+        now = time.monotonic()
+        amount += (now - self.updated) * self.min_per_second
+        self.updated = now
+        self.balance = min(self.max_balance, self.balance + amount)
+
+    def deposit(self):
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill(0.0)
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+retry_budgets: dict[str, RetryBudget] = {}
+
+
+def get_retry_budget(host: str) -> RetryBudget:
+    """Get the shared retry budget of a host."""
+    host = host.lower()
+    if host not in retry_budgets:
+        retry_budgets[host] = RetryBudget()
+    return retry_budgets[host]
@@ -1,11 +1,33 @@
-import uvicorn
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from fastapi.responses import RedirectResponse, JSONResponse
-import requests
+from fastapi.responses import RedirectResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST
 import os
 from dotenv import load_dotenv
-from utils.logger import logger
-from routes import routes121, routesEspo, routesGeneric, routesKobo, routesBitrix24
+import utils.tracing  # noqa: F401, sets the tracer provider used by FastAPI
+from utils.fastjson import FastJSONResponse
+from utils.logger import LogContextMiddleware
+from utils.metrics import MetricsMiddleware, generate_metrics, mark_worker_stopped
+from utils.profiling import ProfilingMiddleware
+from utils.mappings import MappingMiddleware
+from utils.deadline import DeadlineMiddleware
+from utils.circuits import CircuitBreakerMiddleware
+from utils.scheduler import SchedulerMiddleware
+from utils.server import run_server
+from utils.cosmos import init_cosmos_client, close_cosmos_client, run_lease_reaper
+from utils.health import readiness, run_health_checks
+from utils.warmup import warm_up
+from clients.http_client import close_http_client
+from routes import (
+    routes121,
+    routesEspo,
+    routesGeneric,
+    routesKobo,
+    routesBitrix24,
+    routesProfiling,
+    routesMappings,
+)
 
 # load environment variables
 load_dotenv()
@@ -28,8 +50,33 @@ tags_metadata = [
         "name": "Kobo",
         "description": "Extensions to Kobo.",
     },
+    {
+        "name": "Mappings",
+        "description": "Registry of mappings, used instead of the headers of Kobo REST services.",
+    },
+    {
+        "name": "Profiling",
+        "description": "On-demand profiling, enabled by PROFILING_KEY.",
+    },
 ]
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared clients and background tasks on startup, stop them on shutdown."""
+    background_tasks = [asyncio.create_task(run_health_checks())]
+    if init_cosmos_client() is not None:
+        background_tasks.append(asyncio.create_task(run_lease_reaper()))
+    background_tasks.append(asyncio.create_task(warm_up()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_cosmos_client()
+    await close_http_client()
+    mark_worker_stopped()
+
+
 # initialize FastAPI
 app = FastAPI(
     title="kobo-connect",
@@ -43,7 +90,16 @@ app = FastAPI(
         "url": "https://www.gnu.org/licenses/agpl-3.0.en.html",
     },
     openapi_tags=tags_metadata,
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan,
 )
+app.add_middleware(SchedulerMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(CircuitBreakerMiddleware)
+app.add_middleware(MappingMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(LogContextMiddleware)
 
 
 @app.get("/", include_in_schema=False)
@@ -58,26 +114,35 @@ app.include_router(routesEspo.router)
 app.include_router(routesGeneric.router)
 app.include_router(routesKobo.router)
 app.include_router(routesBitrix24.router)
+app.include_router(routesMappings.router)
+app.include_router(routesProfiling.router)
 
 
 @app.get("/health")
 async def health():
-    """Get health of instance."""
-    logger.info("Health check initiated")
-    try:
-        kobo = requests.get(f"https://kobo.ifrc.org/api/v2", timeout=10)
-        logger.info(f"Kobo API health check completed with status: {kobo.status_code}")
-        return JSONResponse(
-            status_code=200,
-            content={"kobo-connect": 200, "kobo.ifrc.org": kobo.status_code},
-        )
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Kobo API health check failed: {str(e)}")
-        return JSONResponse(
-            status_code=200,
-            content={"kobo-connect": 200, "kobo.ifrc.org": "unavailable"},
-        )
+    """Get liveness of instance, without checking its dependencies."""
+    return FastJSONResponse(status_code=200, content={"kobo-connect": 200})
+
+
+@app.get("/ready")
+async def ready():
+    """Get readiness of instance and the status and latency of its dependencies.
+
+    Dependencies are probed by a background task; this returns the cached
+    result, with status code 503 until the warm-up has finished and all
+    required dependencies are available.
+    """
+    return FastJSONResponse(
+        status_code=200 if readiness["status"] == "ready" else 503,
+        content=readiness,
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Expose metrics in the Prometheus text format."""
+    return Response(content=generate_metrics(), media_type=CONTENT_TYPE_LATEST)
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=int(port), reload=True)
+    run_server("main:app", port=int(port))
@@ -1,22 +1,27 @@
 from fastapi import APIRouter, Request, Depends, HTTPException
-import requests
+import asyncio
+import httpx
 import re
 import os
 import io
 import json
 import csv
 import base64
-import pandas as pd
 from datetime import datetime, timedelta
-from fastapi.responses import JSONResponse
+from utils.fastjson import FastJSONResponse
 from utils.utilsKobo import (
+    KOBO_API_URL,
     clean_kobo_data,
     get_attachment_dict,
+    find_kobo_hook,
+    parse_kobo_submission,
     required_headers_kobo,
     required_headers_121_kobo,
 )
-from utils.utils121 import login121, required_headers_121, clean_text
+from utils.utils121 import login121, required_headers_121, clean_text, kobo121_field_types
 from utils.logger import logger
+from utils.tracing import set_submission_attributes
+from clients import http_client
 
 router = APIRouter()
 
@@ -29,25 +34,26 @@ async def kobo_to_121(
 ):
     """Send a Kobo submission to 121."""
 
-    kobo_data = await request.json()
+    kobo_data = await parse_kobo_submission(request)
     extra_logs = {"environment": os.getenv("ENV")}
     try:
         extra_logs["kobo_form_id"] = str(kobo_data["_xform_id_string"])
         extra_logs["kobo_form_version"] = str(kobo_data["__version__"])
         extra_logs["kobo_submission_id"] = str(kobo_data["_id"])
     except KeyError:
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=422,
             content={"detail": "Not a valid Kobo submission"},
         )
     extra_logs["121_url"] = request.headers["url121"]
+    set_submission_attributes(kobo_data, target=request.headers["url121"])
 
     kobo_data = clean_kobo_data(kobo_data)
 
     # Check if 'skipConnect' is present and set to True in kobo_data
     if "skipconnect" in kobo_data.keys() and kobo_data["skipconnect"] == "1":
         logger.info("Skipping connection to 121", extra=extra_logs)
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200, content={"message": "Skipping connection to 121"}
         )
     kobotoken, koboasset = None, None
@@ -55,7 +61,7 @@ async def kobo_to_121(
         kobotoken = request.headers["kobotoken"]
     if "koboasset" in request.headers.keys():
         koboasset = request.headers["koboasset"]
-    attachments = get_attachment_dict(kobo_data, kobotoken, koboasset)
+    attachments = await get_attachment_dict(kobo_data, kobotoken, koboasset)
 
     if "programid" in request.headers.keys():
         programid = request.headers["programid"]
@@ -111,21 +117,35 @@ async def kobo_to_121(
 
     # If test_mode is True, return the payload without posting it
     if test_mode:
-        return JSONResponse(status_code=200, content={"payload": payload})
+        return FastJSONResponse(status_code=200, content={"payload": payload})
 
     # Continue with the POST if not in test mode
-    access_token = login121(
+    access_token = await login121(
         request.headers["url121"],
         request.headers["username121"],
         request.headers["password121"],
     )
 
     url = f"{request.headers['url121']}/api/programs/{programid}/registrations"
+    headers = {"Cookie": f"access_token_general={access_token}"}
+
+    async def find_registration():
+        """Check if the registration was imported by a previous attempt."""
+        response = await http_client.get(
+            url,
+            headers=headers,
+            params={"filter.referenceId": f"$eq:{referenceId}"},
+        )
+        if response.status_code == 200 and response.json().get("data"):
+            return response
+        return None
+
     # POST to 121 import endpoint
-    import_response = requests.post(
+    import_response = await http_client.post(
         url,
-        headers={"Cookie": f"access_token_general={access_token}"},
+        headers=headers,
         json=[payload],
+        lookup=find_registration,
     )
 
     import_response_message = import_response.content.decode("utf-8")
@@ -148,7 +168,7 @@ async def kobo_to_121(
             extra=extra_logs,
         )
 
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=import_response.status_code, content=import_response_message
     )
 
@@ -164,18 +184,19 @@ async def kobo_update_121(
 ):
     """Update a 121 record from a Kobo submission"""
 
-    kobo_data = await request.json()
+    kobo_data = await parse_kobo_submission(request)
     extra_logs = {"environment": os.getenv("ENV")}
     try:
         extra_logs["kobo_form_id"] = str(kobo_data["_xform_id_string"])
         extra_logs["kobo_form_version"] = str(kobo_data["__version__"])
         extra_logs["kobo_submission_id"] = str(kobo_data["_id"])
     except KeyError:
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=422,
             content={"detail": "Not a valid Kobo submission"},
         )
     extra_logs["121_url"] = request.headers["url121"]
+    set_submission_attributes(kobo_data, target=request.headers["url121"])
 
     kobo_data = clean_kobo_data(kobo_data)
 
@@ -184,7 +205,7 @@ async def kobo_update_121(
         kobotoken = request.headers["kobotoken"]
     if "koboasset" in request.headers.keys():
         koboasset = request.headers["koboasset"]
-    attachments = get_attachment_dict(kobo_data, kobotoken, koboasset)
+    attachments = await get_attachment_dict(kobo_data, kobotoken, koboasset)
 
     if "programid" in request.headers.keys():
         programid = request.headers["programid"]
@@ -217,9 +238,9 @@ async def kobo_update_121(
                 payload["data"][target_field] = attachments[kobo_value_url]["url"]
 
             if test_mode:
-                return JSONResponse(status_code=200, content={"payload": payload})
+                return FastJSONResponse(status_code=200, content={"payload": payload})
 
-            access_token = login121(
+            access_token = await login121(
                 request.headers["url121"],
                 request.headers["username121"],
                 request.headers["password121"],
@@ -227,7 +248,7 @@ async def kobo_update_121(
 
             # POST to target API
             if target_field != "referenceId":
-                response = requests.patch(
+                response = await http_client.patch(
                     f"{request.headers['url121']}/api/programs/{programid}/registrations/{referenceId}",
                     headers={"Cookie": f"access_token_general={access_token}"},
                     json=payload,
@@ -239,11 +260,11 @@ async def kobo_update_121(
     # Check if 'skipvalidation' is present and set to True in kobo_data
     if "skipvalidation" in kobo_data.keys() and kobo_data["skipvalidation"] == "1":
         logger.info("Skipping validation status update", extra=extra_logs)
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200, content={"message": "Skipping validation status update"}
         )
 
-    status_response = requests.patch(
+    status_response = await http_client.patch(
         f"{request.headers['url121']}/api/programs/{programid}/registrations/status?dryRun=false&filter.referenceId=$in:{referenceId}",
         headers={"Cookie": f"access_token_general={access_token}"},
         json={"status": "validated"},
@@ -275,7 +296,7 @@ async def kobo_update_121(
             extra=extra_logs,
         )
 
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=status_response.status_code, content=update_response_message
     )
 
@@ -295,10 +316,10 @@ async def create_offline_validation_form(
     modifies it for offline validation, and deploys it. It also sets up a
     Kobo Connect REST service for the new form.
     """
-    koboUrl = "https://kobo.ifrc.org/api/v2/assets/"
+    koboUrl = f"{KOBO_API_URL}/assets/"
     koboGetUrl = koboUrl + request.headers["koboasset"]
     koboheaders = {"Authorization": f"Token {request.headers['kobotoken']}"}
-    data_request = requests.get(f"{koboGetUrl}/?format=json", headers=koboheaders)
+    data_request = await http_client.get(f"{koboGetUrl}/?format=json", headers=koboheaders)
     if data_request.status_code >= 400:
         logger.error(f"Failed to get Kobo form: {data_request.content.decode('utf-8')}")
         raise HTTPException(
@@ -385,7 +406,7 @@ async def create_offline_validation_form(
     )
 
     # create new form
-    post_validation_form = requests.post(
+    post_validation_form = await http_client.post(
         koboUrl + "?format=json", headers=koboheaders, json=data
     )
     if post_validation_form.status_code >= 400:
@@ -404,7 +425,7 @@ async def create_offline_validation_form(
     deploy_url = f"{koboUrl}{formId}/deployment/"
     deploy_payload = {"active": True}
 
-    deploy_response = requests.post(
+    deploy_response = await http_client.post(
         deploy_url, headers=koboheaders, json=deploy_payload
     )
     if deploy_response.status_code >= 400:
@@ -436,18 +457,26 @@ async def create_offline_validation_form(
 
         restServicePayload["settings"]["custom_headers"] = customKoboRestHeaders
 
-        kobo_response = requests.post(
-            f"{koboUrl}{formId}/hooks/", headers=koboheaders, json=restServicePayload
+        kobo_response = await http_client.post(
+            f"{koboUrl}{formId}/hooks/",
+            headers=koboheaders,
+            json=restServicePayload,
+            lookup=lambda: find_kobo_hook(
+                formId,
+                request.headers["kobotoken"],
+                restServicePayload["name"],
+                restServicePayload["endpoint"],
+            ),
         )
 
     if kobo_response.status_code == 200 or 201:
         logger.info("Validation form created and deployed successfully")
-        return JSONResponse({"message": "Validation form created successfully"})
+        return FastJSONResponse({"message": "Validation form created successfully"})
     else:
         logger.error(
             f"Failed to create Kobo Connect rest service: {kobo_response.content.decode('utf-8')}"
         )
-        return JSONResponse(
+        return FastJSONResponse(
             content={"message": "Failed"}, status_code=kobo_response.status_code
         )
 
@@ -466,9 +495,9 @@ async def create_121_program_from_kobo(
     ***NB: if you want to duplicate an endpoint, please also use the Hook ID query param***
     """
 
-    koboUrl = f"https://kobo.ifrc.org/api/v2/assets/{request.headers['koboasset']}"
+    koboUrl = f"{KOBO_API_URL}/assets/{request.headers['koboasset']}"
     koboheaders = {"Authorization": f"Token {request.headers['kobotoken']}"}
-    data_request = requests.get(f"{koboUrl}/?format=json", headers=koboheaders)
+    data_request = await http_client.get(f"{koboUrl}/?format=json", headers=koboheaders)
     if data_request.status_code >= 400:
         raise HTTPException(
             status_code=data_request.status_code,
@@ -476,17 +505,13 @@ async def create_121_program_from_kobo(
         )
     data = data_request.json()
 
+    # imported here, it is only used by this endpoint and slow to import
+    import pandas as pd
+
     survey = pd.DataFrame(data["content"]["survey"])
     choices = pd.DataFrame(data["content"]["choices"])
 
-    type_mapping = {}
-    with open("mappings/kobo121fieldtypes.csv", newline="") as csvfile:
-        reader = csv.reader(csvfile, delimiter="\t")
-        for row in reader:
-            if len(row) == 2:
-                type_mapping[row[0]] = row[1]
-
-    mappingdf = pd.read_csv("mappings/kobo121fieldtypes.csv", delimiter="\t")
+    type_mapping = kobo121_field_types()
 
     CHECKFIELDS = [
         "validation",
@@ -603,7 +628,7 @@ async def create_121_program_from_kobo(
 
     for index, row in survey.iterrows():
         if (
-            row["type"].split()[0] in mappingdf["kobotype"].tolist()
+            row["type"].split()[0] in type_mapping
             and row["name"] not in CHECKFIELDS
             and row["name"] not in fspquestions
             and row["name"]
@@ -667,7 +692,7 @@ async def create_121_program_from_kobo(
             data["programRegistrationAttributes"].append(question)
 
     if test_mode:
-        return JSONResponse(status_code=200, content=data)
+        return FastJSONResponse(status_code=200, content=data)
 
     # Create kobo-connect rest service
     restServicePayload = {
@@ -683,14 +708,22 @@ async def create_121_program_from_kobo(
     customHeaders = dict(zip(koboConnectHeader, koboConnectHeader))
     restServicePayload["settings"]["custom_headers"] = customHeaders
 
-    kobo_response = requests.post(
-        f"{koboUrl}/hooks/", headers=koboheaders, json=restServicePayload
+    kobo_response = await http_client.post(
+        f"{koboUrl}/hooks/",
+        headers=koboheaders,
+        json=restServicePayload,
+        lookup=lambda: find_kobo_hook(
+            request.headers["koboasset"],
+            request.headers["kobotoken"],
+            restServicePayload["name"],
+            restServicePayload["endpoint"],
+        ),
     )
 
     if kobo_response.status_code == 200 or 201:
-        return JSONResponse(content=data)
+        return FastJSONResponse(content=data)
     else:
-        return JSONResponse(
+        return FastJSONResponse(
             content={"message": "Failed"}, status_code=kobo_response.status_code
         )
 
@@ -713,16 +746,16 @@ async def prepare_kobo_validation(
 
     # Delay execution if delay is set
     if delay > 0:
-        time.sleep(delay)
+        await asyncio.sleep(delay)
 
-    access_token = login121(
+    access_token = await login121(
         request.headers["url121"],
         request.headers["username121"],
         request.headers["password121"],
     )
 
     # Fetch data from 121 platform
-    response = requests.get(
+    response = await http_client.get(
         f"{request.headers['url121']}/api/programs/{programId}/metrics/export-list/registrations",
         headers={"Cookie": f"access_token_general={access_token}"},
     )
@@ -736,7 +769,7 @@ async def prepare_kobo_validation(
     json_response = response.json()
     data = json_response.get("data", [])  # Access the 'data' array from the response
 
-    project = requests.get(
+    project = await http_client.get(
         f"{request.headers['url121']}/api/programs/{programId}?formatProgramReturnDto=true",
         headers={"Cookie": f"access_token_general={access_token}"},
     )
@@ -810,8 +843,8 @@ async def prepare_kobo_validation(
         "Content-Type": "application/x-www-form-urlencoded",
     }
     # If exists, remove existing ValidationDataFrom121.csv
-    media_response = requests.get(
-        f"https://kobo.ifrc.org/api/v2/assets/{request.headers['koboasset']}/files/",
+    media_response = await http_client.get(
+        f"{KOBO_API_URL}/assets/{request.headers['koboasset']}/files/",
         headers=headers,
     )
     if media_response.status_code != 200:
@@ -830,8 +863,8 @@ async def prepare_kobo_validation(
 
     # If the file exists, delete it
     if existing_file_uid:
-        delete_response = requests.delete(
-            f"https://kobo.ifrc.org/api/v2/assets/{request.headers['koboasset']}/files/{existing_file_uid}/",
+        delete_response = await http_client.delete(
+            f"{KOBO_API_URL}/assets/{request.headers['koboasset']}/files/{existing_file_uid}/",
             headers={"Authorization": f"Token {request.headers['kobotoken']}"},
         )
         if delete_response.status_code != 204:
@@ -840,10 +873,24 @@ async def prepare_kobo_validation(
                 detail="Failed to delete existing file from Kobo",
             )
 
-    upload_response = requests.post(
-        f"https://kobo.ifrc.org/api/v2/assets/{request.headers['koboasset']}/files/",
+    async def find_uploaded_file():
+        """Check if the file was uploaded by a previous attempt."""
+        response = await http_client.get(
+            f"{KOBO_API_URL}/assets/{request.headers['koboasset']}/files/",
+            headers=headers,
+        )
+        if response.status_code != 200:
+            return None
+        for file in response.json().get("results", []):
+            if file.get("metadata", {}).get("filename") == "ValidationDataFrom121.csv":
+                return httpx.Response(201, json=file)
+        return None
+
+    upload_response = await http_client.post(
+        f"{KOBO_API_URL}/assets/{request.headers['koboasset']}/files/",
         headers=headers,
         data=payload,
+        lookup=find_uploaded_file,
     )
 
     if upload_response.status_code != 201:
@@ -853,11 +900,11 @@ async def prepare_kobo_validation(
         )
 
     # Redeploy the Kobo form
-    redeploy_url = f"https://kobo.ifrc.org/api/v2/assets/{request.headers['koboasset']}/deployment/"
+    redeploy_url = f"{KOBO_API_URL}/assets/{request.headers['koboasset']}/deployment/"
     redeploy_payload = {"active": True}
 
-    redeploy_response = requests.patch(
-        redeploy_url, headers=headers, json=redeploy_payload
+    redeploy_response = await http_client.patch(
+        redeploy_url, headers=headers, json=redeploy_payload, idempotent=True
     )
 
     if redeploy_response.status_code != 200:
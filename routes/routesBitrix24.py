@@ -1,17 +1,20 @@
 from fastapi import APIRouter, Request, HTTPException, Header, Depends
-from fastapi.responses import JSONResponse
+from utils.fastjson import FastJSONResponse
 from utils.cosmos import add_submission, update_submission_status
 from utils.utilsKobo import (
     clean_kobo_data,
     get_attachment_dict,
     get_kobo_attachment,
+    mapped_fields,
+    parse_kobo_submission,
 )
 from utils.logger import logger
-from clients.bitrix24_api_client import Bitrix24
+from utils.tracing import set_submission_attributes
+from clients.bitrix24_api_client import Bitrix24, batched_call
+import asyncio
 import os
 import re
 import base64
-import requests
 router = APIRouter()
 
 
@@ -25,7 +28,9 @@ async def kobo_to_bitrix24(
 ):
     """Send a Kobo submission to Bitrix24."""
 
-    kobo_data = await request.json()
+    kobo_data = await parse_kobo_submission(
+        request, mapped_fields(request.headers.keys())
+    )
     kobo_data["formhub/uuid"] = kobo_data.get("_uuid", "")
     extra_logs = {"environment": os.getenv("ENV")}
     try:
@@ -34,6 +39,7 @@ async def kobo_to_bitrix24(
         extra_logs["kobo_submission_id"] = str(kobo_data["_id"])
     except KeyError:
         raise HTTPException(status_code=422, detail="Not a valid Kobo submission")
+    set_submission_attributes(kobo_data, target=request.headers["targeturl"])
     kobo_data = clean_kobo_data(kobo_data)
 
     target_response = {}
@@ -42,9 +48,9 @@ async def kobo_to_bitrix24(
     if "formhub/uuid" not in kobo_data:
         kobo_data["formhub/uuid"] = kobo_data["_uuid"]
 
-    submission = add_submission(kobo_data)
+    submission = await add_submission(kobo_data)
     if submission["status"] == "success":
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={"detail": "Submission has already been successfully processed"},
         )
@@ -59,7 +65,7 @@ async def kobo_to_bitrix24(
     if "entitytypeid" not in request.headers:
         error_message = "Missing entityTypeId in headers for SPA"
         logger.error(f"Failed: {error_message}", extra=extra_logs)
-        update_submission_status(submission, "failed", error_message)
+        await update_submission_status(submission, "failed", error_message)
         raise HTTPException(status_code=422, detail=error_message)
     
     payload["entityTypeId"] = int(request.headers["entitytypeid"])
@@ -71,7 +77,7 @@ async def kobo_to_bitrix24(
         if not record_id:
             error_message = "Field 'id' not found in Kobo submission data"
             logger.error(f"Failed: {error_message}", extra=extra_logs)
-            update_submission_status(submission, "failed", error_message)
+            await update_submission_status(submission, "failed", error_message)
             raise HTTPException(status_code=422, detail=error_message)
         payload["id"] = int(record_id)
         target_entity = "crm.item.update"
@@ -79,6 +85,7 @@ async def kobo_to_bitrix24(
         target_entity = "crm.item.add.json"
 
     # Loop through headers to map Kobo data to Bitrix24 fields
+    attachment_fields = {}
     for kobo_field, target_field in request.headers.items():
         if kobo_field.lower() in ["targeturl", "targetkey", "entitytypeid", "id", "operation","kobotoken"]:
             continue
@@ -116,53 +123,78 @@ async def kobo_to_bitrix24(
             else:
                 continue
         elif attachment:
-            try:
-                print(f"RAW FIELD VALUE: {kobo_data[kobo_field]}", flush=True)
-                filename = kobo_data[kobo_field].split("/")[-1]
-                print(f"FILENAME: {filename}", flush=True)
-                attachment_dict = get_attachment_dict(kobo_data)
-                print(f"ATTACHMENT DICT KEYS: {list(attachment_dict.keys())}", flush=True)
-                if filename not in attachment_dict:
-                    print(f"ATTACHMENT NOT FOUND: {filename}", flush=True)
-                    continue
-                response = requests.get(
-                    attachment_dict[filename]["url"],
-                    headers={"Authorization": f"Token {request.headers.get('kobotoken')}"}
-                )
-                print(f"DOWNLOAD STATUS: {response.status_code}", flush=True)
-                file_bytes = response.content
-                print(f"BYTES: {len(file_bytes)}", flush=True)
-                kobo_value = [filename, base64.b64encode(file_bytes).decode("utf-8")]
-            except Exception as e:
-                print(f"ATTACHMENT ERROR: {e}", flush=True)
-                continue
+            # downloaded concurrently once all fields are mapped
+            attachment_fields[target_field] = (kobo_field, kobo_data[kobo_field])
+            continue
         else:
             kobo_value = kobo_data[kobo_field]
 
         payload["fields"][target_field] = kobo_value
 
+    if attachment_fields:
+        kobotoken = request.headers.get("kobotoken")
+        attachments = await get_attachment_dict(kobo_data)
+        files = await asyncio.gather(
+            *(
+                download_attachment(kobo_field, value, attachments, kobotoken, extra_logs)
+                for kobo_field, value in attachment_fields.values()
+            )
+        )
+        for target_field, file in zip(attachment_fields, files):
+            if file is not None:
+                payload["fields"][target_field] = file
+
     if len(payload["fields"]) == 0:
         error_message = "No fields found in submission or no mappings found in headers"
         logger.error(f"Failed: {error_message}", extra=extra_logs)
-        update_submission_status(submission, "failed", error_message)
-
-    import json
+        await update_submission_status(submission, "failed", error_message)
+        return FastJSONResponse(status_code=400, content={"detail": error_message})
 
     # Send to Bitrix24
-    response = client.request(
-        "POST",
-        target_entity,
-        payload,
-        logs=extra_logs,
-    )
+    if request.headers.get("batchwrites", "").lower() == "true":
+        response = await batched_call(
+            client, target_entity.removesuffix(".json"), payload, logs=extra_logs
+        )
+    else:
+        response = await client.request(
+            "POST",
+            target_entity,
+            payload,
+            logs=extra_logs,
+        )
 
     if "result" not in response.keys():
-        error_message = response.content.decode("utf-8")
+        error_message = str(
+            response.get("error_description") or response.get("error") or response
+        )
         logger.error(f"Failed: {error_message}", extra=extra_logs)
-        update_submission_status(submission, "failed", error_message)
-    else:
-        target_response[target_entity] = response
+        await update_submission_status(submission, "failed", error_message)
+        return FastJSONResponse(status_code=400, content={"detail": error_message})
+    target_response[target_entity] = response
 
     logger.info("Success", extra=extra_logs)
-    update_submission_status(submission, "success")
-    return JSONResponse(status_code=200, content=target_response)
+    await update_submission_status(submission, "success")
+    return FastJSONResponse(status_code=200, content=target_response)
+
+
+async def download_attachment(kobo_field, value, attachments, kobotoken, extra_logs):
+    """Download the attachment of a field, as [filename, base64 content]."""
+    try:
+        filename = value.split("/")[-1]
+        if filename not in attachments:
+            logger.warning(f"Attachment of field {kobo_field} not found", extra=extra_logs)
+            return None
+        file_bytes = await get_kobo_attachment(attachments[filename]["url"], kobotoken)
+        logger.debug(
+            "Downloaded attachment of field %s (%s bytes)",
+            kobo_field,
+            len(file_bytes),
+            extra=extra_logs,
+        )
+        return [filename, base64.b64encode(file_bytes).decode("utf-8")]
+    except Exception as e:
+        logger.error(
+            f"Failed to get attachment of field {kobo_field}: {e}",
+            extra=extra_logs,
+        )
+        return None
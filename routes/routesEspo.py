@@ -1,17 +1,24 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from typing import Any, NamedTuple
 
 from fastapi import APIRouter, Request, Depends
-from fastapi.responses import JSONResponse
+from utils.fastjson import FastJSONResponse
 from utils.cosmos import add_submission, update_submission_status
 from utils.utilsKobo import (
     clean_kobo_data,
     get_attachment_dict,
     get_kobo_attachment,
+    mapped_fields,
+    parse_kobo_submission,
 )
-from utils.utilsEspo import espo_request, required_headers_espocrm
+from utils.utilsEspo import create_records, espo_request, required_headers_espocrm
 from utils.logger import logger
+from utils.cache import TTLCache
+from utils.attachment_cache import attachment_cache, cache_key
+from utils.tracing import set_submission_attributes
+from utils.tracing import traced
 from clients.espo_api_client import EspoAPI
 import os
 import re
@@ -19,6 +26,12 @@ import base64
 
 router = APIRouter()
 
+# Related-entity lookups are repeated for every submission of a form, and the
+# records they point to (e.g. coding levels, branches) rarely change
+related_entity_cache = TTLCache(
+    "related_entity", ttl=float(os.getenv("RELATED_ENTITY_CACHE_SECONDS", "60"))
+)
+
 
 class FieldType(NamedTuple):
     """Parsed field-type prefix from a Kobo header key."""
@@ -49,15 +62,16 @@ class TargetField(NamedTuple):
     related_entity_field: str
 
 
-def fail_response(
+async def fail_response(
     submission: dict[str, Any], error_message: str, extra_logs: dict[str, Any]
-) -> JSONResponse:
-    """Log error, mark submission as failed, and return a 400 JSONResponse."""
+) -> FastJSONResponse:
+    """Log error, mark submission as failed, and return a 400 FastJSONResponse."""
     logger.error(f"Failed: {error_message}", extra=extra_logs)
-    update_submission_status(submission, "failed", error_message)
-    return JSONResponse(status_code=400, content={"detail": error_message})
+    await update_submission_status(submission, "failed", error_message)
+    return FastJSONResponse(status_code=400, content={"detail": error_message})
 
 
+@lru_cache(maxsize=4096)
 def parse_field_type(kobo_field: str) -> FieldType:
     """Parse a kobo_field header key to extract its type prefix and actual field name.
 
@@ -99,6 +113,7 @@ def parse_field_type(kobo_field: str) -> FieldType:
     )
 
 
+@lru_cache(maxsize=4096)
 def parse_target_field(
     target_field: str,
 ) -> TargetField | None:
@@ -183,7 +198,8 @@ def get_kobo_value(
     return kobo_data[ft.field], False
 
 
-def resolve_related_entity(
+@traced()
+async def resolve_related_entity(
     client: EspoAPI,
     related_entity: str,
     related_entity_field: str,
@@ -196,7 +212,14 @@ def resolve_related_entity(
     - On success: record_id is set, error is None.
     - Entity not found: entity_name is None, error describes the failure.
     - Ambiguous match (!= 1 record): entity_name is set, error describes the ambiguity.
+
+    Successful lookups are cached for RELATED_ENTITY_CACHE_SECONDS.
     """
+    cache_key = (client.url, related_entity, related_entity_field, str(kobo_value))
+    cached = related_entity_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     params = {
         "where": [
             {"type": "equals", "attribute": related_entity_field, "value": kobo_value}
@@ -204,7 +227,7 @@ def resolve_related_entity(
     }
 
     # Try the entity name as-is
-    response = espo_request(
+    response = await espo_request(
         client, "GET", related_entity, params=params, logs=extra_logs
     )
 
@@ -224,12 +247,60 @@ def resolve_related_entity(
             f"with field {related_entity_field} equal to {kobo_value}: record must be unique",
         )
 
-    return RelatedEntityResult(
+    result = RelatedEntityResult(
         record_id=records[0]["id"], entity_name=related_entity, error=None
     )
+    related_entity_cache.set(cache_key, result)
+    return result
 
 
-def upload_attachment(
+# largest page of records returned by the EspoCRM API
+RELATED_ENTITY_PRELOAD_SIZE = 200
+
+
+async def preload_related_entities(
+    client: EspoAPI,
+    related_entity: str,
+    related_entity_field: str,
+    extra_logs: dict[str, Any],
+) -> int:
+    """Fill the related-entity cache with all records of a small related entity.
+
+    Only done if all records fit in one page, so that a value seen once is
+    known to match a single record (compared case-insensitively, as EspoCRM
+    does). Returns the number of cached lookups.
+    """
+    response = await espo_request(
+        client,
+        "GET",
+        related_entity,
+        params={"select": related_entity_field, "maxSize": RELATED_ENTITY_PRELOAD_SIZE},
+        logs=extra_logs,
+    )
+    if response is None or response.get("total", 0) > len(response["list"]):
+        return 0
+    records: dict[str, list[dict[str, Any]]] = {}
+    for record in response["list"]:
+        value = record.get(related_entity_field)
+        if value is not None:
+            records.setdefault(str(value).casefold(), []).append(record)
+    cached = 0
+    for matches in records.values():
+        if len(matches) != 1:
+            continue
+        value = str(matches[0][related_entity_field])
+        related_entity_cache.set(
+            (client.url, related_entity, related_entity_field, value),
+            RelatedEntityResult(
+                record_id=matches[0]["id"], entity_name=related_entity, error=None
+            ),
+        )
+        cached += 1
+    return cached
+
+
+@traced()
+async def upload_attachment(
     client: EspoAPI,
     kobo_field: str,
     kobo_value: Any,
@@ -242,6 +313,9 @@ def upload_attachment(
 ) -> tuple[str | None, str | None]:
     """Download a Kobo attachment and upload it to EspoCRM.
 
+    An attachment already uploaded for the same field, e.g. by a previous
+    attempt of the submission, is reused (see utils.attachment_cache).
+
     Returns (attachment_id, None) on success, or (None, error_message) on failure.
     """
     if not kobotoken:
@@ -250,8 +324,14 @@ def upload_attachment(
             "'kobotoken' needs to be specified in headers to upload attachments to EspoCRM",
         )
 
+    upload_key = cache_key(client.url, target_entity, target_field, file_url, kobotoken)
+    attachment_id = await attachment_cache.get_upload(upload_key)
+    if attachment_id is not None:
+        logger.info(f"Reusing uploaded attachment of field: {kobo_field}", extra=extra_logs)
+        return attachment_id, None
+
     logger.info(f"Getting attachment of field: {kobo_field}", extra=extra_logs)
-    file = get_kobo_attachment(file_url, kobotoken)
+    file = await get_kobo_attachment(file_url, kobotoken)
 
     if not file:
         return None, f"Attachment retrieval failed for field: {kobo_field}"
@@ -269,7 +349,7 @@ def upload_attachment(
         "field": target_field,
         "file": f"data:{mimetype};base64,{file_b64}",
     }
-    record = espo_request(
+    record = await espo_request(
         client,
         "POST",
         "Attachment",
@@ -280,6 +360,7 @@ def upload_attachment(
     if record is None:
         return None, f"Failed to upload attachment for field: {kobo_field}"
 
+    await attachment_cache.set_upload(upload_key, record["id"])
     return record["id"], None
 
 
@@ -300,6 +381,7 @@ async def kobo_to_espocrm(
         kobotoken / koboasset: Kobo credentials for attachment retrieval.
         updaterecordby: ``Entity.field`` — update an existing record instead of
             creating a new one.
+        batchwrites: ``true`` — create the records of all entities concurrently.
 
     Flow:
         1. Validate the submission and check for duplicates via Cosmos DB.
@@ -308,7 +390,9 @@ async def kobo_to_espocrm(
         4. Create or update records in EspoCRM.
     """
 
-    kobo_data = await request.json()
+    kobo_data = await parse_kobo_submission(
+        request, mapped_fields(request.headers.keys())
+    )
     extra_logs = {"environment": os.getenv("ENV")}
 
     # Validate submission
@@ -317,14 +401,15 @@ async def kobo_to_espocrm(
         extra_logs["kobo_form_version"] = str(kobo_data["__version__"])
         extra_logs["kobo_submission_id"] = str(kobo_data["_id"])
     except KeyError:
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=422, content={"detail": "Not a valid Kobo submission"}
         )
 
+    set_submission_attributes(kobo_data, target=request.headers["targeturl"])
     logger.info("Successfully received submission from Kobo", extra=extra_logs)
 
     # Check for duplicate submissions
-    submission = add_submission(kobo_data)
+    submission = await add_submission(kobo_data)
     logger.info(
         "Successfully created/retrieved submission from Cosmos DB", extra=extra_logs
     )
@@ -333,7 +418,7 @@ async def kobo_to_espocrm(
         logger.info(
             "Submission has already been successfully processed", extra=extra_logs
         )
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={"detail": "Submission has already been successfully processed"},
         )
@@ -343,7 +428,7 @@ async def kobo_to_espocrm(
     # Check if submission should be skipped
     if kobo_data.get("skipconnect") == "1":
         logger.info("Skipping submission", extra=extra_logs)
-        return JSONResponse(status_code=200, content={"message": "Skipping submission"})
+        return FastJSONResponse(status_code=200, content={"message": "Skipping submission"})
 
     # Initialize EspoCRM client
     kobotoken = request.headers.get("kobotoken")
@@ -352,7 +437,7 @@ async def kobo_to_espocrm(
 
     # Get attachment URLs
     logger.info("Getting attachment urls", extra=extra_logs)
-    attachments = get_attachment_dict(kobo_data, kobotoken, koboasset)
+    attachments = await get_attachment_dict(kobo_data, kobotoken, koboasset)
     logger.info(
         f"Successfully retrieved urls of {len(attachments)} attachments",
         extra=extra_logs,
@@ -397,7 +482,7 @@ async def kobo_to_espocrm(
 
         # Resolve related entity lookup
         if parsed.related:
-            result = resolve_related_entity(
+            result = await resolve_related_entity(
                 client,
                 parsed.related_entity,
                 parsed.related_entity_field,
@@ -408,7 +493,7 @@ async def kobo_to_espocrm(
                 if result.entity_name is None:
                     # Entity doesn't exist at all — skip this field
                     continue
-                return fail_response(submission, result.error, extra_logs)
+                return await fail_response(submission, result.error, extra_logs)
             kobo_value = result.record_id
             target_field = parsed.linked_field + "Id"
 
@@ -419,7 +504,7 @@ async def kobo_to_espocrm(
             payload[target_entity][target_field] = kobo_value
         else:
             attachment_info = attachments[kobo_value_url]
-            attachment_id, error = upload_attachment(
+            attachment_id, error = await upload_attachment(
                 client,
                 kobo_field,
                 kobo_value,
@@ -431,12 +516,12 @@ async def kobo_to_espocrm(
                 extra_logs,
             )
             if error:
-                return fail_response(submission, error, extra_logs)
+                return await fail_response(submission, error, extra_logs)
             payload[target_entity][f"{target_field}Id"] = attachment_id
 
     # Validate payload
     if not payload:
-        return fail_response(
+        return await fail_response(
             submission,
             "No fields found in submission or no entities found in headers",
             extra_logs,
@@ -445,19 +530,30 @@ async def kobo_to_espocrm(
     # Send payload to EspoCRM
     target_response: dict[str, Any] = {}
 
+    created: dict[str, Any] = {}
+    if request.headers.get("batchwrites", "").lower() == "true":
+        created = await create_records(
+            client,
+            {name: payload[name] for name in payload if name not in update_record_payload},
+            extra_logs,
+        )
+
     for entity_name, entity_payload in payload.items():
 
         if entity_name not in update_record_payload:
             # Create new record
-            response = espo_request(
-                client,
-                "POST",
-                entity_name,
-                params=entity_payload,
-                logs=extra_logs,
-            )
+            if entity_name in created:
+                response = created[entity_name]
+            else:
+                response = await espo_request(
+                    client,
+                    "POST",
+                    entity_name,
+                    params=entity_payload,
+                    logs=extra_logs,
+                )
             if response is None:
-                return fail_response(
+                return await fail_response(
                     submission,
                     f"Failed to create record in entity '{entity_name}'",
                     extra_logs,
@@ -473,7 +569,7 @@ async def kobo_to_espocrm(
                     }
                 ]
             }
-            find_response = espo_request(
+            find_response = await espo_request(
                 client,
                 "GET",
                 entity_name,
@@ -481,7 +577,7 @@ async def kobo_to_espocrm(
                 logs=extra_logs,
             )
             if find_response is None:
-                return fail_response(
+                return await fail_response(
                     submission,
                     f"Failed to search for records in entity '{entity_name}'",
                     extra_logs,
@@ -489,7 +585,7 @@ async def kobo_to_espocrm(
 
             records = find_response["list"]
             if len(records) != 1:
-                return fail_response(
+                return await fail_response(
                     submission,
                     f"Found {len(records)} records of entity {entity_name} "
                     f"with field {update_record_payload[entity_name]['field']} "
@@ -497,7 +593,7 @@ async def kobo_to_espocrm(
                     extra_logs,
                 )
 
-            response = espo_request(
+            response = await espo_request(
                 client,
                 "PUT",
                 f"{entity_name}/{records[0]['id']}",
@@ -505,14 +601,14 @@ async def kobo_to_espocrm(
                 logs=extra_logs,
             )
             if response is None:
-                return fail_response(
+                return await fail_response(
                     submission,
                     f"Failed to update record in entity '{entity_name}'",
                     extra_logs,
                 )
 
         if "id" not in response:
-            return fail_response(
+            return await fail_response(
                 submission,
                 f"Unexpected response from EspoCRM for entity '{entity_name}': missing 'id'",
                 extra_logs,
@@ -521,5 +617,5 @@ async def kobo_to_espocrm(
         target_response[entity_name] = response
 
     logger.info("Success", extra=extra_logs)
-    update_submission_status(submission, "success")
-    return JSONResponse(status_code=200, content=target_response)
+    await update_submission_status(submission, "success")
+    return FastJSONResponse(status_code=200, content=target_response)
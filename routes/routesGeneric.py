@@ -1,7 +1,15 @@
 from fastapi import APIRouter, Request, Depends, HTTPException
-from fastapi.responses import JSONResponse
-from utils.utilsKobo import clean_kobo_data, get_attachment_dict
-import requests
+from utils.fastjson import FastJSONResponse
+from utils.utilsKobo import (
+    clean_kobo_data,
+    get_attachment_dict,
+    get_kobo_attachment,
+    mapped_fields,
+    parse_kobo_submission,
+)
+from clients import http_client
+from utils.tracing import set_submission_attributes
+import base64
 
 router = APIRouter()
 
@@ -10,9 +18,12 @@ async def kobo_to_generic(request: Request):
     """Send a Kobo submission to a generic API.
     API Key is passed as 'x-api-key' in headers."""
 
-    kobo_data = await request.json()
+    kobo_data = await parse_kobo_submission(
+        request, mapped_fields(request.headers.keys())
+    )
+    set_submission_attributes(kobo_data, target=request.headers.get("targeturl"))
     kobo_data = clean_kobo_data(kobo_data)
-    attachments = get_attachment_dict(kobo_data)
+    attachments = await get_attachment_dict(kobo_data)
 
     # Create API payload body
     payload = {}
@@ -29,18 +40,18 @@ async def kobo_to_generic(request: Request):
                         detail=f"'kobotoken' needs to be specified in headers to upload attachments",
                     )
                 # encode attachment in base64
-                file = get_kobo_attachment(file_url, request.headers["kobotoken"])
+                file = await get_kobo_attachment(file_url, request.headers["kobotoken"])
                 file_b64 = base64.b64encode(file).decode("utf8")
                 payload[target_field] = (
                     f"data:{attachments[kobo_value]['mimetype']};base64,{file_b64}"
                 )
 
     # POST to target API
-    response = requests.post(
+    response = await http_client.post(
         request.headers["targeturl"],
         headers={"x-api-key": request.headers["targetkey"]},
         data=payload,
     )
     target_response = response.content.decode("utf-8")
 
-    return JSONResponse(status_code=200, content=target_response)
\ No newline at end of file
+    return FastJSONResponse(status_code=200, content=target_response)
\ No newline at end of file
@@ -1,22 +1,36 @@
-from fastapi import APIRouter, Request, Depends, HTTPException
-from fastapi.responses import JSONResponse
-import requests
+from fastapi import APIRouter, Request, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from utils import fastjson
+from utils.fastjson import FastJSONResponse
+from clients import http_client
 import base64
 import csv
 import io
 import os
 import uuid
-import json
 from enum import Enum
 from utils.utils121 import login121
-from utils.cosmos import add_submission, update_submission_status
+from utils.cosmos import (
+    add_submission,
+    update_submission_status,
+    get_cosmos_container_client,
+)
 from utils.utilsKobo import (
+    KOBO_API_URL,
     clean_kobo_data,
     get_attachment_dict,
     get_kobo_attachment,
+    find_kobo_hook,
+    load_kobo_submission,
+    parse_kobo_submission,
+    read_body,
+    required_headers_kobo,
     required_headers_linked_kobo,
 )
+from utils.backfill import backfill_submissions, get_hook_route, get_kobo_hook
+from utils.fanout import fan_out
 from utils.logger import logger
+from utils.tracing import set_submission_attributes
 import time
 
 router = APIRouter()
@@ -44,7 +58,7 @@ async def create_kobo_headers(
     if json_data is None:
         raise HTTPException(status_code=400, detail="JSON data is required")
 
-    target_url = f"https://kobo.ifrc.org/api/v2/assets/{koboassetId}/hooks/"
+    target_url = f"{KOBO_API_URL}/assets/{koboassetId}/hooks/"
     koboheaders = {"Authorization": f"Token {kobotoken}"}
 
     if hookId is None:
@@ -62,8 +76,8 @@ async def create_kobo_headers(
 
         payload["settings"]["custom_headers"] = json_data
     else:
-        get_url = f"https://kobo.ifrc.org/api/v2/assets/{koboassetId}/hooks/{hookId}"
-        hook = requests.get(get_url, headers=koboheaders)
+        get_url = f"{KOBO_API_URL}/assets/{koboassetId}/hooks/{hookId}"
+        hook = await http_client.get(get_url, headers=koboheaders)
         hook = hook.json()
         hook["name"] = "Duplicate of " + hook["name"]
 
@@ -85,12 +99,19 @@ async def create_kobo_headers(
         ]
         payload = remove_keys(hook, keys_to_remove)
 
-    response = requests.post(target_url, headers=koboheaders, json=payload)
+    response = await http_client.post(
+        target_url,
+        headers=koboheaders,
+        json=payload,
+        lookup=lambda: find_kobo_hook(
+            koboassetId, kobotoken, payload.get("name"), payload.get("endpoint")
+        ),
+    )
 
     if response.status_code == 200 or 201:
-        return JSONResponse(content={"message": "Sucess"})
+        return FastJSONResponse(content={"message": "Sucess"})
     else:
-        return JSONResponse(
+        return FastJSONResponse(
             content={"message": "Failed to post data to the target endpoint"},
             status_code=response.status_code,
         )
@@ -102,38 +123,42 @@ async def kobo_to_linked_kobo(
 ):
     """Update a multiple-choice question in a Kobo form (child) based on the submissions of another one (parent)."""
 
-    kobo_data = await request.json()
+    kobo_data = await parse_kobo_submission(request)
     extra_logs = {"environment": os.getenv("ENV")}
     try:
         extra_logs["kobo_form_id"] = str(kobo_data["_xform_id_string"])
         extra_logs["kobo_form_version"] = str(kobo_data["__version__"])
         extra_logs["kobo_submission_id"] = str(kobo_data["_id"])
     except KeyError:
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=422,
             content={"detail": "Not a valid Kobo submission"},
         )
 
+    set_submission_attributes(
+        kobo_data, **{"target.kobo_asset": request.headers["childasset"]}
+    )
+
     # store the submission uuid and status, to avoid duplicate submissions
     kobo_data["_uuid"] = kobo_data["_uuid"] + request.headers["childasset"]
-    submission = add_submission(kobo_data)
+    submission = await add_submission(kobo_data)
     if submission["status"] == "success":
         logger.info(
             "Submission has already been successfully processed", extra=extra_logs
         )
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={"detail": "Submission has already been successfully processed"},
         )
 
     # get submissions of parent form
-    target_url = f"https://kobo.ifrc.org/api/v2/assets/{request.headers['parentasset']}/data.json"
+    target_url = f"{KOBO_API_URL}/assets/{request.headers['parentasset']}/data.json"
     koboheaders = {"Authorization": f"Token {request.headers['kobotoken']}"}
     start, limit = 0, 100
     parent_submissions = []
     while True:
         params = {"limit": limit, "start": start}
-        resp = requests.get(target_url, headers=koboheaders, params=params)
+        resp = await http_client.get(target_url, headers=koboheaders, params=params)
         resp.raise_for_status()
         data = resp.json()
         parent_submissions.extend(data["results"])
@@ -142,9 +167,9 @@ async def kobo_to_linked_kobo(
         start += limit
 
     # get child form
-    target_url = f"https://kobo.ifrc.org/api/v2/assets/{request.headers['childasset']}/?format=json"
-    response = requests.get(target_url, headers=koboheaders)
-    assetdata = json.loads(response.content)
+    target_url = f"{KOBO_API_URL}/assets/{request.headers['childasset']}/?format=json"
+    response = await http_client.get(target_url, headers=koboheaders)
+    assetdata = fastjson.loads(response.content)
     len_choices = []
     for choice in assetdata["content"]["choices"]:
         if choice["list_name"] == request.headers["childlist"]:
@@ -186,24 +211,113 @@ async def kobo_to_linked_kobo(
     ]
     assetdata["content"]["choices"].extend(new_choices_form)
     logger.info("update child form with new choice list")
-    logger.info(assetdata)
-    response = requests.patch(target_url, headers=koboheaders, json=assetdata)
+    logger.info(
+        f"Updating {len(new_choices_form)} choices of child form",
+        extra=extra_logs,
+    )
+    # replacing the form content is idempotent
+    response = await http_client.patch(
+        target_url, headers=koboheaders, json=assetdata, idempotent=True
+    )
 
     # get latest form version id
-    target_url = f"https://kobo.ifrc.org/api/v2/assets/{request.headers['childasset']}/?format=json"
-    response = requests.get(target_url, headers=koboheaders)
-    newassetdata = json.loads(response.content)
+    target_url = f"{KOBO_API_URL}/assets/{request.headers['childasset']}/?format=json"
+    response = await http_client.get(target_url, headers=koboheaders)
+    newassetdata = fastjson.loads(response.content)
     newversionid = newassetdata["version_id"]
 
     # deploy latest form version id
-    target_url = f"https://kobo.ifrc.org/api/v2/assets/{request.headers['childasset']}/deployment/"
+    target_url = f"{KOBO_API_URL}/assets/{request.headers['childasset']}/deployment/"
     payload = {"version_id": newversionid, "active": True}
-    response = requests.patch(target_url, headers=koboheaders, data=payload)
+    response = await http_client.patch(
+        target_url, headers=koboheaders, data=payload, idempotent=True
+    )
 
     if response.status_code == 200:
         logger.info("Success", extra=extra_logs)
-        update_submission_status(submission, "success")
-        return JSONResponse(status_code=200, content={"detail": "Success"})
+        await update_submission_status(submission, "success")
+        return FastJSONResponse(status_code=200, content={"detail": "Success"})
     else:
         logger.error("Failed", extra=extra_logs)
-        update_submission_status(submission, "failed")
+        await update_submission_status(submission, "failed")
+
+
+@router.post("/kobo-to-many", tags=["Kobo"])
+async def kobo_to_many(request: Request, mappingids: str = Header()):
+    """Send a Kobo submission to several targets, each configured by a mapping. \n
+    `mappingids` is a comma-separated list of mapping IDs (see `/mappings`) of EspoCRM or
+    Bitrix24 targets. The submission is read, deduplicated and its attachments downloaded
+    once, then it is sent to all targets concurrently; each target has its own status in the submission store. \n
+    Returns the status code and response of each target; fails if any target failed.
+    """
+    body = await read_body(request)
+    kobo_data = load_kobo_submission(body, fields=frozenset())
+    extra_logs = {"environment": os.getenv("ENV")}
+    try:
+        extra_logs["kobo_form_id"] = str(kobo_data["_xform_id_string"])
+        extra_logs["kobo_submission_id"] = str(kobo_data["_id"])
+        extra_logs["kobo_submission_uuid"] = str(kobo_data["_uuid"])
+    except KeyError:
+        return FastJSONResponse(
+            status_code=422,
+            content={"detail": "Not a valid Kobo submission"},
+        )
+    set_submission_attributes(kobo_data)
+
+    mapping_ids = [i.strip() for i in mappingids.split(",") if i.strip()]
+    if not mapping_ids:
+        raise HTTPException(status_code=400, detail="No mapping IDs in 'mappingids'")
+    results = await fan_out(
+        request.app, dict(request.headers), body, kobo_data, mapping_ids, extra_logs
+    )
+    failed = [r["status_code"] for r in results.values() if r["status_code"] >= 300]
+    if failed:
+        logger.error(f"Failed for {len(failed)} of {len(results)} targets", extra=extra_logs)
+    return FastJSONResponse(status_code=max(failed, default=200), content=results)
+
+
+@router.post("/kobo-backfill", tags=["Kobo"])
+async def kobo_backfill(
+    request: Request,
+    hookId: str,
+    start_date: str = None,
+    end_date: str = None,
+    only_failed: bool = False,
+    concurrency: int = Query(default=4, ge=1, le=32),
+    rate_limit: float = Query(default=2.0, gt=0, le=50),
+    dependencies=Depends(required_headers_kobo),
+):
+    """Replay historical submissions of a Kobo form through one of its REST services. \n
+    Submissions are pushed through the same kobo-connect route and with the same headers as the
+    REST service with ID `hookId`, optionally filtered by submission date (`start_date`, `end_date`)
+    and/or by `failed` status in the submission store (`only_failed`). \n
+    Returns newline-delimited JSON with progress per page of submissions and a final throughput summary.
+    """
+    kobotoken = request.headers["kobotoken"]
+    koboasset = request.headers["koboasset"]
+    if only_failed:
+        get_cosmos_container_client()
+
+    hook = await get_kobo_hook(koboasset, kobotoken, hookId)
+    path = get_hook_route(request.app, hook)
+    headers = {
+        str(key): str(value)
+        for key, value in hook.get("settings", {}).get("custom_headers", {}).items()
+    }
+    logger.info(f"Starting backfill of {koboasset} through {path}")
+
+    return StreamingResponse(
+        backfill_submissions(
+            request.app,
+            path,
+            headers,
+            koboasset,
+            kobotoken,
+            start_date=start_date,
+            end_date=end_date,
+            only_failed=only_failed,
+            concurrency=concurrency,
+            rate_limit=rate_limit,
+        ),
+        media_type="application/x-ndjson",
+    )
@@ -0,0 +1,157 @@
+import asyncio
+from enum import Enum
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from utils.fastjson import FastJSONResponse
+from utils.cache import TTLCache
+from utils.logger import logger
+from utils.mappings import (
+    create_mapping,
+    delete_mapping,
+    get_mapping,
+    list_mappings,
+    redact_mapping,
+    update_mapping,
+)
+from utils.utilsKobo import KOBO_API_URL, KOBO_URL, required_headers_kobo
+from clients import http_client
+
+router = APIRouter()
+
+# access of Kobo tokens to assets: "view" or "change"
+kobo_access_cache = TTLCache("kobo_access", ttl=300)
+
+# Kobo permissions that allow changing the mappings of an asset
+KOBO_CHANGE_PERMISSIONS = {"change_asset", "manage_asset"}
+
+
+class target(str, Enum):
+    target_espo = "espocrm"
+    target_bitrix24 = "bitrix24"
+    target_121 = "121"
+    target_generic = "generic"
+
+
+async def get_kobo_access(kobotoken: str, koboasset: str) -> str | None:
+    """Access of a Kobo token to a Kobo asset: "change", "view" or None."""
+    access = kobo_access_cache.get((kobotoken, koboasset))
+    if access is not None:
+        return access
+    headers = {"Authorization": f"Token {kobotoken}"}
+    asset, user = await asyncio.gather(
+        http_client.get(f"{KOBO_API_URL}/assets/{koboasset}/?format=json", headers=headers),
+        http_client.get(f"{KOBO_URL}/me/?format=json", headers=headers),
+    )
+    if asset.status_code != 200:
+        return None
+    access = "view"
+    username = user.json().get("username") if user.status_code == 200 else None
+    if username and username != "AnonymousUser":
+        asset = asset.json()
+        if asset.get("owner__username") == username:
+            access = "change"
+        for permission in asset.get("permissions", []):
+            if (
+                permission.get("user", "").rstrip("/").endswith(f"/users/{username}")
+                and permission.get("permission", "").rstrip("/").rsplit("/", 1)[-1]
+                in KOBO_CHANGE_PERMISSIONS
+            ):
+                access = "change"
+    kobo_access_cache.set((kobotoken, koboasset), access)
+    return access
+
+
+def required_own_credentials(
+    request: Request, dependencies=Depends(required_headers_kobo)
+) -> tuple[str, str]:
+    """Kobo credentials sent by the client, never the ones stored in a mapping."""
+    if request.scope.get("state", {}).get("mapping") is not None:
+        raise HTTPException(status_code=400, detail="Mappings cannot be used here")
+    return dependencies
+
+
+async def required_kobo_access(dependencies=Depends(required_own_credentials)):
+    """Check that the Kobo token can view the Kobo asset."""
+    kobotoken, koboasset = dependencies
+    if await get_kobo_access(kobotoken, koboasset) is None:
+        raise HTTPException(status_code=403, detail="No access to Kobo asset")
+    return koboasset
+
+
+async def required_kobo_change_access(dependencies=Depends(required_own_credentials)):
+    """Check that the Kobo token can change the Kobo asset."""
+    kobotoken, koboasset = dependencies
+    access = await get_kobo_access(kobotoken, koboasset)
+    if access is None:
+        raise HTTPException(status_code=403, detail="No access to Kobo asset")
+    if access != "change":
+        raise HTTPException(status_code=403, detail="No permission to change Kobo asset")
+    return koboasset
+
+
+@router.post("/mappings", tags=["Mappings"])
+async def post_mapping(
+    headers: dict,
+    target: target,
+    koboasset: str = Depends(required_kobo_change_access),
+):
+    """Store the headers of a Kobo REST service as a mapping. \n
+    The REST service then only needs the header `mappingid` with the returned ID;
+    headers sent by the REST service override the ones of the mapping.
+    """
+    try:
+        mapping = await create_mapping(koboasset, target.value, headers)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    logger.info(f"Created mapping {mapping['id']} of asset {koboasset}")
+    return FastJSONResponse(status_code=201, content=redact_mapping(mapping))
+
+
+@router.get("/mappings", tags=["Mappings"])
+async def get_mappings(koboasset: str = Depends(required_kobo_access)):
+    """Get the latest version of all mappings of a Kobo asset."""
+    mappings = await list_mappings(koboasset)
+    return FastJSONResponse(status_code=200, content=[redact_mapping(m) for m in mappings])
+
+
+@router.get("/mappings/{mapping_id}", tags=["Mappings"])
+async def get_mapping_version(
+    mapping_id: str,
+    version: int = Query(None, ge=1),
+    koboasset: str = Depends(required_kobo_access),
+):
+    """Get a mapping, by default its latest version."""
+    mapping = await get_mapping(mapping_id, version)
+    if mapping is None or mapping["koboasset"] != koboasset:
+        raise HTTPException(status_code=404, detail="Mapping not found")
+    return FastJSONResponse(status_code=200, content=redact_mapping(mapping))
+
+
+@router.put("/mappings/{mapping_id}", tags=["Mappings"])
+async def put_mapping(
+    mapping_id: str,
+    headers: dict,
+    koboasset: str = Depends(required_kobo_change_access),
+):
+    """Update a mapping, which creates a new version. \n
+    REST services without `mappingversion` use the new version within MAPPING_CACHE_SECONDS.
+    """
+    try:
+        mapping = await update_mapping(mapping_id, koboasset, headers)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if mapping is None:
+        raise HTTPException(status_code=404, detail="Mapping not found")
+    logger.info(f"Updated mapping {mapping_id} to version {mapping['version']}")
+    return FastJSONResponse(status_code=200, content=redact_mapping(mapping))
+
+
+@router.delete("/mappings/{mapping_id}", tags=["Mappings"])
+async def remove_mapping(
+    mapping_id: str,
+    koboasset: str = Depends(required_kobo_change_access),
+):
+    """Delete all versions of a mapping."""
+    if not await delete_mapping(mapping_id, koboasset):
+        raise HTTPException(status_code=404, detail="Mapping not found")
+    logger.info(f"Deleted mapping {mapping_id} of asset {koboasset}")
+    return FastJSONResponse(status_code=200, content={"detail": "Mapping deleted"})
@@ -0,0 +1,50 @@
+import asyncio
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import FileResponse, PlainTextResponse
+from utils.logger import logger
+from utils.profiling import (
+    PROFILE_MAX_SECONDS,
+    format_folded,
+    is_authorized,
+    profile_path,
+    sample_stacks,
+)
+
+router = APIRouter()
+
+
+def required_headers_profiling(profilingkey: str = Header()):
+    if not is_authorized(profilingkey):
+        raise HTTPException(status_code=403, detail="Invalid profiling key")
+    return profilingkey
+
+
+@router.get("/profiling/sample", tags=["Profiling"])
+async def sample_profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval: float = Query(0.01, ge=0.001, le=1),
+    dependencies=Depends(required_headers_profiling),
+):
+    """Sample the stacks of the running server for some seconds.
+
+    Returns folded stacks, one ``thread;outer;...;inner count`` per line,
+    which can be rendered with flame graph tools (e.g. speedscope).
+    """
+    logger.info(f"Sampling stacks for {seconds} seconds")
+    samples = await asyncio.to_thread(sample_stacks, seconds, interval)
+    return PlainTextResponse(format_folded(samples))
+
+
+@router.get("/profiling/{profile_id}", tags=["Profiling"])
+async def get_profile(
+    profile_id: str,
+    format: str = Query("text", pattern="^(text|pstats)$"),
+    dependencies=Depends(required_headers_profiling),
+):
+    """Get a stored request profile, as a text report or as raw cProfile stats."""
+    path = profile_path(profile_id, ".txt" if format == "text" else ".prof")
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "text":
+        return PlainTextResponse(path.read_text())
+    return FileResponse(path, filename=path.name, media_type="application/octet-stream")
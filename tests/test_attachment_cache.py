@@ -0,0 +1,140 @@
+import sys
+import os
+import asyncio
+import time
+from unittest.mock import patch
+import httpx
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.attachment_cache import AttachmentCache, attachment_cache
+from utils.utilsKobo import get_kobo_attachment
+from routes.routesEspo import upload_attachment
+
+
+def test_attachments_are_content_addressed(tmp_path):
+    cache = AttachmentCache(tmp_path, max_bytes=10_000)
+    asyncio.run(cache.put("a", b"x" * 100))
+    asyncio.run(cache.put("b", b"x" * 100))
+
+    assert asyncio.run(cache.get("a"))[:] == b"x" * 100
+    assert asyncio.run(cache.get("b"))[:] == b"x" * 100
+    assert asyncio.run(cache.get("c")) is None
+    assert len(list((tmp_path / "objects").glob("*/*"))) == 1
+
+
+def test_least_recently_used_attachments_are_evicted(tmp_path):
+    cache = AttachmentCache(tmp_path, max_bytes=250)
+    for key in "abc":
+        asyncio.run(cache.put(key, key.encode() * 100))
+        # mtime is used for recency
+        time.sleep(0.01)
+        asyncio.run(cache.get("a"))
+        time.sleep(0.01)
+
+    assert asyncio.run(cache.get("a")) is not None
+    assert asyncio.run(cache.get("b")) is None
+    assert asyncio.run(cache.get("c")) is not None
+
+
+def test_upload_ids_expire(tmp_path):
+    cache = AttachmentCache(tmp_path, upload_ttl=60)
+    asyncio.run(cache.set_upload("a", "attachment-id"))
+    assert asyncio.run(cache.get_upload("a")) == "attachment-id"
+
+    with patch("utils.attachment_cache.time.time", return_value=time.time() + 61):
+        assert asyncio.run(cache.get_upload("a")) is None
+    assert not (tmp_path / "uploads" / "a").exists()
+
+
+def kobo_media(calls, content, status_code=200, content_type="image/jpeg"):
+    async def get(url, **kwargs):
+        calls.append(url)
+        return httpx.Response(
+            status_code, content=content, headers={"content-type": content_type}
+        )
+
+    return get
+
+
+def test_kobo_attachment_is_downloaded_once(tmp_path):
+    calls = []
+    with patch.object(attachment_cache, "directory", tmp_path), patch(
+        "clients.http_client.get", kobo_media(calls, b"x" * 2000)
+    ):
+        first = asyncio.run(get_kobo_attachment("https://kobo/media/a.jpg", "token"))
+        second = asyncio.run(get_kobo_attachment("https://kobo/media/a.jpg", "token"))
+        # another token does not read the attachment downloaded by the first one
+        asyncio.run(get_kobo_attachment("https://kobo/media/a.jpg", "other"))
+
+    assert first == second[:] == b"x" * 2000
+    assert len(calls) == 2
+
+
+def test_incomplete_kobo_attachment_is_not_cached(tmp_path):
+    calls = []
+    with patch.object(attachment_cache, "directory", tmp_path), patch(
+        "clients.http_client.get", kobo_media(calls, b"Not found" * 200, status_code=404)
+    ), patch("utils.utilsKobo.KOBO_ATTACHMENT_RETRY_TIMEOUT", 0):
+        asyncio.run(get_kobo_attachment("https://kobo/media/b.jpg", "token"))
+        asyncio.run(get_kobo_attachment("https://kobo/media/b.jpg", "token"))
+
+    assert len(calls) == 2
+
+
+def test_small_kobo_attachment_is_not_retried(tmp_path):
+    calls = []
+    with patch.object(attachment_cache, "directory", tmp_path), patch(
+        "clients.http_client.get", kobo_media(calls, b"signature", content_type="image/png")
+    ), patch("utils.utilsKobo.KOBO_ATTACHMENT_RETRY_DELAY", 60):
+        file = asyncio.run(get_kobo_attachment("https://kobo/media/c.png", "token"))
+
+    assert file == b"signature"
+    assert len(calls) == 1
+
+
+def test_kobo_placeholder_is_retried(tmp_path):
+    calls = []
+    responses = [
+        httpx.Response(200, content=b"<html></html>", headers={"content-type": "text/html"}),
+        httpx.Response(200, content=b"image", headers={"content-type": "image/jpeg"}),
+    ]
+
+    async def get(url, **kwargs):
+        calls.append(url)
+        return responses[len(calls) - 1]
+
+    with patch.object(attachment_cache, "directory", tmp_path), patch(
+        "clients.http_client.get", get
+    ), patch("utils.utilsKobo.KOBO_ATTACHMENT_RETRY_DELAY", 0):
+        assert asyncio.run(get_kobo_attachment("https://kobo/media/d.jpg", "token")) == b"image"
+
+    assert len(calls) == 2
+
+
+class FakeEspoClient:
+    url = "https://espocrm.example"
+
+    def __init__(self):
+        self.uploads = 0
+
+    async def request(self, method, action, params=None):
+        self.uploads += 1
+        return {"id": f"attachment-{self.uploads}"}
+
+
+def test_espo_attachment_is_uploaded_once(tmp_path):
+    client = FakeEspoClient()
+
+    async def upload():
+        return await upload_attachment(
+            client, "photo", "a.jpg", "https://kobo/media/a.jpg", "image/jpeg",
+            "Contact", "photo", "token", {},
+        )
+
+    with patch.object(attachment_cache, "directory", tmp_path), patch(
+        "clients.http_client.get", kobo_media([], b"x" * 2000)
+    ):
+        assert asyncio.run(upload()) == ("attachment-1", None)
+        assert asyncio.run(upload()) == ("attachment-1", None)
+    assert client.uploads == 1
@@ -0,0 +1,99 @@
+import sys
+import os
+import json
+import asyncio
+from unittest.mock import patch
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.backfill import backfill_submissions, get_hook_route, stored_submission_ids
+
+app = FastAPI()
+received = []
+
+
+@app.post("/kobo-to-test")
+async def kobo_to_test(request: Request):
+    kobo_data = await request.json()
+    received.append((request.headers["targeturl"], kobo_data["_id"]))
+    if kobo_data["_id"] == 2:
+        return JSONResponse(status_code=400, content={"detail": "Mapping error"})
+    return JSONResponse(status_code=200, content={"detail": "Success"})
+
+
+async def kobo_pages(*args, **kwargs):
+    yield [{"_id": 1, "_uuid": "a"}, {"_id": 2, "_uuid": "b"}]
+    yield [{"_id": 3, "_uuid": "c"}]
+
+
+async def collect(generator):
+    return [json.loads(line) async for line in generator]
+
+
+def test_get_hook_route():
+    hook = {"endpoint": "https://kobo-connect.azurewebsites.net/kobo-to-test"}
+    assert get_hook_route(app, hook) == "/kobo-to-test"
+
+
+@patch("utils.backfill.iter_kobo_submissions", kobo_pages)
+def test_backfill_submissions():
+    received.clear()
+    lines = asyncio.run(
+        collect(
+            backfill_submissions(
+                app,
+                "/kobo-to-test",
+                {"targeturl": "https://espocrm.example"},
+                "asset",
+                "token",
+                concurrency=2,
+                rate_limit=50,
+            )
+        )
+    )
+
+    assert sorted(received) == [("https://espocrm.example", i) for i in (1, 2, 3)]
+    assert [line["progress"]["total"] for line in lines[:-1]] == [2, 3]
+    summary = lines[-1]["summary"]
+    assert summary["succeeded"] == 2
+    assert summary["failed"] == 1
+    assert summary["errors"][0]["kobo_submission_id"] == 2
+
+
+@patch("utils.backfill.iter_kobo_submissions", kobo_pages)
+@patch("utils.backfill.get_submission_ids_with_status")
+def test_backfill_only_failed(get_ids):
+    async def failed_ids(ids, status):
+        return {"c"}
+
+    get_ids.side_effect = failed_ids
+    received.clear()
+    lines = asyncio.run(
+        collect(
+            backfill_submissions(
+                app,
+                "/kobo-to-test",
+                {"targeturl": "https://espocrm.example"},
+                "asset",
+                "token",
+                only_failed=True,
+                rate_limit=50,
+            )
+        )
+    )
+
+    assert received == [("https://espocrm.example", 3)]
+    assert lines[-1]["summary"]["skipped"] == 2
+
+
+def test_stored_submission_ids_match_routes():
+    submission = {"_id": 1, "_uuid": "a"}
+    assert stored_submission_ids("/kobo-to-espocrm", {}, submission) == ["a"]
+    assert stored_submission_ids(
+        "/kobo-to-linked-kobo", {"ChildAsset": "child"}, submission
+    ) == ["achild"]
+    assert stored_submission_ids(
+        "/kobo-to-many", {"mappingids": "m1, m2"}, submission
+    ) == ["a-m1", "a-m2"]
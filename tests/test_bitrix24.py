@@ -0,0 +1,128 @@
+import sys
+import os
+import asyncio
+import json
+import time
+import pytest
+from unittest.mock import patch
+import httpx
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from clients.bitrix24_api_client import Bitrix24, batched_call, bitrix24_batch_buffer
+from utils.deadline import deadline, remaining
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def batch_handler(calls):
+    def handler(request):
+        body = json.loads(request.content)
+        calls.append((request.url.path, body))
+        results = {
+            name: {"item": {"id": i}}
+            for i, (name, command) in enumerate(body["cmd"].items())
+            if "INVALID" not in command
+        }
+        errors = {
+            name: {"error": "400", "error_description": "Invalid field"}
+            for name, command in body["cmd"].items()
+            if "INVALID" in command
+        }
+        return httpx.Response(
+            200, json={"result": {"result": results, "result_error": errors or []}}
+        )
+
+    return handler
+
+
+def test_batch_commands():
+    calls = []
+
+    async def run():
+        client = Bitrix24("https://b24.example/", "key")
+        with patch(
+            "clients.http_client.get_http_client", return_value=mock_client(batch_handler(calls))
+        ):
+            return await client.batch(
+                {
+                    "a": ("crm.item.add", {"entityTypeId": 1, "fields": {"TITLE": "A & B"}}),
+                    "b": ("crm.item.add", {"entityTypeId": 1, "fields": {"INVALID": "x"}}),
+                }
+            )
+
+    results, errors = asyncio.run(run())
+    assert calls[0][0] == "/rest/1/key/batch"
+    assert calls[0][1] == {
+        "halt": 0,
+        "cmd": {
+            "a": "crm.item.add?entityTypeId=1&fields%5BTITLE%5D=A+%26+B",
+            "b": "crm.item.add?entityTypeId=1&fields%5BINVALID%5D=x",
+        },
+    }
+    assert results == {"a": {"item": {"id": 0}}}
+    assert errors["b"]["error_description"] == "Invalid field"
+
+
+def test_batch_limit():
+    client = Bitrix24("https://b24.example", "key")
+    commands = {f"c{i}": ("crm.item.add", {}) for i in range(51)}
+    with pytest.raises(ValueError):
+        asyncio.run(client.batch(commands))
+
+
+def test_batched_call_groups_submissions():
+    calls = []
+
+    async def run():
+        client = Bitrix24("https://b24-batched.example", "key")
+        with patch(
+            "clients.http_client.get_http_client", return_value=mock_client(batch_handler(calls))
+        ), patch.object(bitrix24_batch_buffer, "max_delay", 0.01):
+            return await asyncio.gather(
+                *(
+                    batched_call(client, "crm.item.add", {"fields": {"TITLE": str(i)}})
+                    for i in range(3)
+                ),
+                batched_call(client, "crm.item.add", {"fields": {"INVALID": "x"}}),
+            )
+
+    *ok, failed = asyncio.run(run())
+    assert len(calls) == 1
+    assert all("result" in response for response in ok)
+    assert failed == {"error": "400", "error_description": "Invalid field"}
+
+
+def test_batched_call_deadlines():
+    remaining_in_batch = []
+
+    async def batch(commands, halt=False, logs=None):
+        remaining_in_batch.append(remaining())
+        await asyncio.sleep(0.05)
+        return {name: {"item": {}} for name in commands}, {}
+
+    async def call(client, seconds):
+        deadline.set(time.monotonic() + seconds)
+        return await batched_call(client, "crm.item.add", {"fields": {}}, logs={"s": seconds})
+
+    async def run():
+        client = Bitrix24("https://b24-deadlines.example", "key")
+        with patch.object(client, "batch", batch), patch.object(
+            bitrix24_batch_buffer, "max_delay", 60
+        ):
+            late = asyncio.create_task(call(client, 60))
+            early = asyncio.create_task(call(client, 1))
+            # cancelled at its deadline while the batch is sent
+            expired = asyncio.create_task(call(client, 0.04))
+            await asyncio.sleep(0.03)
+            expired.cancel()
+            return await asyncio.gather(late, early, expired, return_exceptions=True)
+
+    late, early, expired = asyncio.run(run())
+    assert late == early == {"result": {"item": {}}}
+    assert isinstance(expired, asyncio.CancelledError)
+    # the batch is sent before the earliest deadline, not after the delay
+    [left] = remaining_in_batch
+    assert left is not None and left < 0.04
@@ -0,0 +1,127 @@
+import sys
+import os
+import asyncio
+import time
+import pytest
+from unittest.mock import patch
+import httpx
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from clients import http_client
+from clients.circuit_breaker import CircuitBreaker, CircuitOpenError, get_circuit_breaker
+from clients.retry import NO_RETRY_POLICY
+from utils.circuits import CircuitBreakerMiddleware
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("a.example", failure_threshold=3, open_seconds=30)
+    for _ in range(2):
+        breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert 29 < breaker.retry_after() <= 30
+
+
+def test_half_open_circuit_lets_one_probe_through():
+    breaker = CircuitBreaker("b.example", failure_threshold=1, open_seconds=30)
+    breaker.record(False)
+    breaker.opened_until = time.monotonic()
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # a failed probe opens the circuit again
+    breaker.record(False, probe=True)
+    assert breaker.state == "open"
+
+    breaker.opened_until = time.monotonic()
+    assert breaker.allow()
+    breaker.record(True, probe=True)
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_requests_fail_fast_once_circuit_is_open():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(502)
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+            for _ in range(5):
+                await http_client.get("https://circuit.example/a", retry_policy=NO_RETRY_POLICY)
+            with pytest.raises(CircuitOpenError):
+                await http_client.get("https://circuit.example/a")
+
+    asyncio.run(run())
+    assert len(calls) == 5
+    assert get_circuit_breaker("circuit.example").state == "open"
+
+
+def circuit_app():
+    app = FastAPI()
+    app.add_middleware(CircuitBreakerMiddleware)
+
+    @app.post("/kobo-to-generic")
+    async def submission():
+        return {"processed": True}
+
+    return app
+
+
+def test_submission_to_open_target_is_rejected():
+    breaker = get_circuit_breaker("down.example")
+    for _ in range(breaker.failure_threshold):
+        breaker.record(False)
+
+    async def run(url):
+        transport = httpx.ASGITransport(app=circuit_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/kobo-to-generic", headers={"targeturl": url})
+
+    rejected = asyncio.run(run("https://down.example/api"))
+    assert rejected.status_code == 503
+    assert 0 < int(rejected.headers["retry-after"]) <= 30
+    assert asyncio.run(run("https://up.example/api")).status_code == 200
+
+
+def test_cancelled_probe_does_not_keep_circuit_half_open():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200)
+
+    breaker = get_circuit_breaker("probe.example")
+    for _ in range(breaker.failure_threshold):
+        breaker.record(False)
+    breaker.opened_until = time.monotonic()
+    limiter = http_client.get_rate_limiter("probe.example")
+    limiter.paused_until = time.monotonic() + 60
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+            # the probe is cancelled while waiting for the rate limiter
+            with pytest.raises(TimeoutError):
+                async with asyncio.timeout(0.05):
+                    await http_client.get("https://probe.example/a")
+            limiter.paused_until = 0.0
+            return await http_client.get("https://probe.example/a")
+
+    assert asyncio.run(run()).status_code == 200
+    assert len(calls) == 1
+    assert breaker.state == "closed"
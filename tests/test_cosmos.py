@@ -0,0 +1,148 @@
+import sys
+import os
+import asyncio
+import time
+from unittest.mock import AsyncMock, patch
+import pytest
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+)
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.cosmos import (
+    WORKER_ID,
+    add_submission,
+    reap_expired_leases,
+    update_submission_status,
+)
+
+kobo_data = {"_uuid": "submission-uuid", "formhub/uuid": "form-uuid"}
+
+
+@patch("utils.cosmos.get_cosmos_container_client")
+def test_add_submission_still_pending(get_container):
+    container = get_container.return_value
+    container.create_item = AsyncMock(side_effect=CosmosResourceExistsError())
+    container.read_item = AsyncMock(
+        return_value={
+            "id": "submission-uuid",
+            "uuid": "form-uuid",
+            "status": "pending",
+            "lease_owner": "other-worker",
+            "lease_expires_at": time.time() + 60,
+        }
+    )
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(add_submission(kobo_data))
+    assert e.value.status_code == 400
+    container.patch_item.assert_not_called()
+
+
+@patch("utils.cosmos.get_cosmos_container_client")
+def test_add_submission_takes_over_expired_lease(get_container):
+    container = get_container.return_value
+    container.create_item = AsyncMock(side_effect=CosmosResourceExistsError())
+    container.read_item = AsyncMock(
+        return_value={
+            "id": "submission-uuid",
+            "uuid": "form-uuid",
+            "status": "pending",
+            "lease_owner": "crashed-worker",
+            "lease_expires_at": time.time() - 60,
+            "_etag": "etag-1",
+        }
+    )
+    container.patch_item = AsyncMock(
+        side_effect=lambda **kwargs: {
+            op["path"][1:]: op["value"] for op in kwargs["patch_operations"]
+        }
+    )
+
+    submission = asyncio.run(add_submission(kobo_data))
+
+    assert container.patch_item.call_args.kwargs["etag"] == "etag-1"
+    assert submission["status"] == "pending"
+    assert submission["lease_owner"] == WORKER_ID
+    assert submission["lease_expires_at"] > time.time()
+
+
+@patch("utils.cosmos.get_cosmos_container_client")
+def test_add_submission_lease_claimed_by_other_worker(get_container):
+    container = get_container.return_value
+    container.create_item = AsyncMock(side_effect=CosmosResourceExistsError())
+    container.read_item = AsyncMock(
+        return_value={
+            "id": "submission-uuid",
+            "uuid": "form-uuid",
+            "status": "failed",
+            "_etag": "etag-1",
+        }
+    )
+    container.patch_item = AsyncMock(side_effect=CosmosAccessConditionFailedError())
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(add_submission(kobo_data))
+    assert e.value.status_code == 400
+
+
+@patch("utils.cosmos.get_cosmos_container_client")
+def test_update_submission_status_patch_with_etag(get_container):
+    container = get_container.return_value
+    container.patch_item = AsyncMock(
+        return_value={"status": "success", "error_message": None, "_etag": "etag-2"}
+    )
+    submission = {
+        "id": "submission-uuid",
+        "uuid": "form-uuid",
+        "status": "pending",
+        "_etag": "etag-1",
+    }
+
+    asyncio.run(update_submission_status(submission, "success"))
+
+    kwargs = container.patch_item.call_args.kwargs
+    assert kwargs["partition_key"] == "form-uuid"
+    assert kwargs["etag"] == "etag-1"
+    assert kwargs["match_condition"] == MatchConditions.IfNotModified
+    assert {"op": "set", "path": "/status", "value": "success"} in kwargs[
+        "patch_operations"
+    ]
+    assert submission["status"] == "success"
+    assert submission["_etag"] == "etag-2"
+
+
+@patch("utils.cosmos.get_cosmos_container_client")
+def test_update_submission_status_conflict(get_container):
+    container = get_container.return_value
+    container.patch_item = AsyncMock(side_effect=CosmosAccessConditionFailedError())
+    submission = {"id": "submission-uuid", "uuid": "form-uuid", "_etag": "etag-1"}
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(update_submission_status(submission, "failed", "error"))
+    assert e.value.status_code == 409
+
+
+@patch("utils.cosmos.get_cosmos_container_client")
+def test_reap_expired_leases(get_container):
+    async def expired_submissions():
+        for i in range(2):
+            yield {
+                "id": f"submission-{i}",
+                "uuid": "form-uuid",
+                "status": "pending",
+                "_etag": f"etag-{i}",
+            }
+
+    container = get_container.return_value
+    container.query_items.return_value = expired_submissions()
+    container.patch_item = AsyncMock(
+        side_effect=[{"status": "failed"}, CosmosAccessConditionFailedError()]
+    )
+
+    assert asyncio.run(reap_expired_leases()) == 1
+    assert container.patch_item.call_count == 2
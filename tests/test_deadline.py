@@ -0,0 +1,156 @@
+import sys
+import os
+import asyncio
+import time
+import pytest
+from unittest.mock import patch
+import httpx
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from clients import http_client
+from clients.circuit_breaker import CircuitOpenError
+from utils import cosmos
+from utils.deadline import DeadlineMiddleware, deadline, get_timeout, has_deadline, remaining
+from routes import routes121, routesBitrix24, routesEspo, routesGeneric, routesKobo
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_timeout_is_capped_to_deadline():
+    assert remaining() is None
+    assert get_timeout(30).read == 30
+
+    token = deadline.set(time.monotonic() + 5)
+    try:
+        timeout = get_timeout(30)
+        assert 4 < timeout.read <= 5
+        assert timeout.connect <= 5
+    finally:
+        deadline.reset(token)
+
+    token = deadline.set(time.monotonic() - 1)
+    try:
+        with pytest.raises(TimeoutError):
+            get_timeout()
+    finally:
+        deadline.reset(token)
+
+
+def test_deadline_covers_submission_routes():
+    paths = {
+        route.path
+        for module in (routes121, routesBitrix24, routesEspo, routesGeneric, routesKobo)
+        for route in module.router.routes
+    }
+    assert {path for path in paths if has_deadline(path)} == {
+        "/kobo-to-121",
+        "/kobo-to-bitrix24",
+        "/kobo-to-espocrm",
+        "/kobo-to-generic",
+        "/kobo-to-many",
+        "/kobo-update-121",
+    }
+
+
+def test_request_uses_remaining_time():
+    timeouts = []
+
+    def handler(request):
+        timeouts.append(request.extensions["timeout"])
+        return httpx.Response(200)
+
+    async def run():
+        token = deadline.set(time.monotonic() + 2)
+        try:
+            with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+                await http_client.get("https://deadline.example/a")
+        finally:
+            deadline.reset(token)
+
+    asyncio.run(run())
+    assert timeouts[0]["read"] <= 2
+    assert timeouts[0]["connect"] <= 2
+
+
+def test_no_retry_after_deadline():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, headers={"Retry-After": "5"})
+
+    async def run():
+        token = deadline.set(time.monotonic() + 0.2)
+        try:
+            with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+                return await http_client.get("https://deadline-retry.example/a")
+        finally:
+            deadline.reset(token)
+
+    assert asyncio.run(run()).status_code == 503
+    assert len(calls) == 1
+
+
+def deadline_app(leased):
+    app = FastAPI()
+    app.add_middleware(DeadlineMiddleware)
+
+    @app.post("/kobo-to-slow")
+    async def slow():
+        cosmos.leased_submissions.get().append(leased)
+        await asyncio.sleep(10)
+
+    @app.post("/kobo-to-down")
+    async def down():
+        cosmos.leased_submissions.get().append(leased)
+        raise CircuitOpenError("Circuit of down.example is open", retry_after=12.5)
+
+    @app.post("/other")
+    async def other():
+        return {"deadline": remaining()}
+
+    return app
+
+
+def test_submission_fails_at_deadline():
+    submission = {"id": "a", "status": "pending", "lease_owner": cosmos.WORKER_ID}
+    released = []
+
+    async def update_submission_status(submission, status, error_message=None):
+        released.append((submission["id"], status, error_message))
+
+    async def run():
+        transport = httpx.ASGITransport(app=deadline_app(submission))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            with patch("utils.deadline.SUBMISSION_DEADLINE_SECONDS", 0.1), patch(
+                "utils.cosmos.update_submission_status", update_submission_status
+            ):
+                return await client.post("/kobo-to-slow"), await client.post("/other")
+
+    slow, other = asyncio.run(run())
+    assert slow.status_code == 504
+    assert released == [("a", "failed", "Deadline exceeded")]
+    assert other.json() == {"deadline": None}
+
+
+def test_submission_fails_fast_when_target_unavailable():
+    submission = {"id": "b", "status": "pending", "lease_owner": cosmos.WORKER_ID}
+    released = []
+
+    async def update_submission_status(submission, status, error_message=None):
+        released.append((submission["id"], status, error_message))
+
+    async def run():
+        transport = httpx.ASGITransport(app=deadline_app(submission))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            with patch("utils.cosmos.update_submission_status", update_submission_status):
+                return await client.post("/kobo-to-down")
+
+    response = asyncio.run(run())
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "13"
+    assert released == [("b", "failed", "Target unavailable")]
@@ -0,0 +1,60 @@
+import sys
+import os
+import random
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from benchmarks.query_string import PARAMS, legacy_http_build_query
+from clients.espo_api_client import encode_query, http_build_query
+
+CASES = [
+    {},
+    [],
+    "plain",
+    42,
+    None,
+    [1, "two", None, True],
+    ("a", ("b", "c")),
+    {1: "int key", True: "bool key", "x y": "a&b=c", "": "empty key"},
+    {"a": {"": {"b": []}}, "c": {}, "d": [[], [[1]]]},
+    {"where": [{"type": "equals", "attribute": "name", "value": None}]},
+    {"where": [{"type": "in", "attribute": "status", "value": ["A", "B"]}]},
+    {"where": [{"attribute": "name", "type": "equals", "value": "reordered"}]},
+    {"where": [{"type": "equals", "attribute": "name", "value": "Zoë & Co/+?"}]},
+    {"where": [{"type": "equals", "attribute": 1, "value": "x"}]},
+    {"where": [{"type": "equals", "attribute": "name", "value": 1.5}], "maxSize": 1},
+    *PARAMS.values(),
+]
+
+
+def random_data(depth=0):
+    kind = random.random()
+    if depth < 4 and kind < 0.3:
+        return [random_data(depth + 1) for _ in range(random.randint(0, 4))]
+    if depth < 4 and kind < 0.6:
+        return {
+            random.choice(["a", "b", "c d", "é", "", 0, 1, 2.5]): random_data(depth + 1)
+            for _ in range(random.randint(0, 4))
+        }
+    return random.choice(["x", "y z", "&=", "ü", 0, 7, -1.25, None, False])
+
+
+def test_http_build_query_matches_legacy():
+    for case in CASES:
+        assert http_build_query(case) == legacy_http_build_query(case), case
+
+
+def test_http_build_query_matches_legacy_random():
+    random.seed(0)
+    for _ in range(2000):
+        data = random_data()
+        assert http_build_query(data) == legacy_http_build_query(data), data
+
+
+def test_encode_query_matches_legacy():
+    for case in CASES:
+        if isinstance(case, dict):
+            assert encode_query(case) == legacy_http_build_query(case), case
+    for value in ["a", "b c", "Zoë", 3, None, True]:
+        params = {"where": [{"type": "equals", "attribute": "name", "value": value}]}
+        assert encode_query(params) == legacy_http_build_query(params)
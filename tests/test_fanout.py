@@ -0,0 +1,179 @@
+import sys
+import os
+import asyncio
+import pytest
+from unittest.mock import patch
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import mappings
+from utils.cosmos import submission_id, submission_target
+from utils.attachment_cache import attachment_cache
+from utils.fanout import run_shared, shared_stages
+from utils.utilsKobo import get_attachment_dict, get_kobo_attachment, parse_kobo_submission
+from routes import routesKobo
+
+SUBMISSION = {"_id": 1, "_uuid": "uuid-1", "_xform_id_string": "form", "q1": "photo.jpg"}
+
+# submissions received by the targets, and their status by submission id
+received = []
+statuses = {}
+
+
+@pytest.fixture(autouse=True)
+def mappings_db(tmp_path):
+    mappings.latest_versions.clear()
+    received.clear()
+    statuses.clear()
+    with patch.object(mappings, "MAPPINGS_DB", str(tmp_path / "mappings.db")), patch.object(
+        attachment_cache, "directory", tmp_path / "attachments"
+    ):
+        yield
+
+
+def fanout_app():
+    app = FastAPI()
+    app.add_middleware(mappings.MappingMiddleware)
+    app.include_router(routesKobo.router)
+
+    async def target(request: Request):
+        kobo_data = await parse_kobo_submission(request)
+        attachments = await get_attachment_dict(
+            kobo_data, request.headers["kobotoken"], request.headers["koboasset"]
+        )
+        file = await get_kobo_attachment(attachments["photo.jpg"]["url"], "token")
+        received.append(submission_target.get())
+        if request.headers.get("fail"):
+            statuses[submission_id(kobo_data)] = "failed"
+            raise HTTPException(status_code=400, detail="Failed")
+        statuses[submission_id(kobo_data)] = "success"
+        return {"target": submission_target.get(), "field": request.headers["q1"], "size": len(file)}
+
+    app.post("/kobo-to-bitrix24")(target)
+    app.post("/kobo-to-espocrm")(target)
+    return app
+
+
+def kobo_api(calls):
+    async def get(url, **kwargs):
+        calls.append(url)
+        if "/data/" in url:
+            return httpx.Response(
+                200,
+                json={"_attachments": [{"filename": "u/photo.jpg", "mimetype": "image/jpeg"}]},
+                request=httpx.Request("GET", url),
+            )
+        return httpx.Response(200, content=b"x" * 2000, request=httpx.Request("GET", url))
+
+    return get
+
+
+def post_fanout(mapping_ids):
+    calls = []
+
+    async def get_submission_ids_with_status(ids, status):
+        return {i for i in ids if statuses.get(i) == status}
+
+    async def run():
+        transport = httpx.ASGITransport(app=fanout_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            with patch("clients.http_client.get", kobo_api(calls)), patch(
+                "utils.utilsKobo.KOBO_ATTACHMENT_DELAY", 0
+            ), patch(
+                "utils.fanout.get_submission_ids_with_status", get_submission_ids_with_status
+            ):
+                return await client.post(
+                    "/kobo-to-many",
+                    headers={
+                        "mappingids": ",".join(mapping_ids),
+                        "kobotoken": "token",
+                        "koboasset": "asset",
+                    },
+                    json=SUBMISSION,
+                )
+
+    return asyncio.run(run()), calls
+
+
+def create_mapping(target, headers):
+    return asyncio.run(mappings.create_mapping("asset", target, headers))["id"]
+
+
+def test_fanout_shares_attachments():
+    espo = create_mapping("espocrm", {"q1": "Contact.name"})
+    bitrix = create_mapping("bitrix24", {"q1": "NAME"})
+    response, calls = post_fanout([espo, bitrix])
+
+    assert response.status_code == 200
+    results = response.json()
+    assert results[espo]["response"] == {"target": espo, "field": "Contact.name", "size": 2000}
+    assert results[bitrix]["response"] == {"target": bitrix, "field": "NAME", "size": 2000}
+    assert results[bitrix]["target"] == "bitrix24"
+    # the attachment list and the attachment are fetched once for both targets
+    assert len(calls) == 2
+
+
+def test_fanout_skips_processed_targets():
+    espo = create_mapping("espocrm", {"q1": "Contact.name"})
+    bitrix = create_mapping("bitrix24", {"q1": "NAME"})
+    statuses[submission_id(SUBMISSION, espo)] = "success"
+    response, _ = post_fanout([espo, bitrix])
+
+    results = response.json()
+    assert "already been successfully processed" in results[espo]["response"]["detail"]
+    assert results[bitrix]["response"]["target"] == bitrix
+
+
+def test_fanout_retry_only_resends_failed_target():
+    espo = create_mapping("espocrm", {"q1": "Contact.name", "fail": "true"})
+    bitrix = create_mapping("bitrix24", {"q1": "NAME"})
+    response, _ = post_fanout([espo, bitrix])
+
+    assert response.status_code == 400
+    assert response.json()[bitrix]["status_code"] == 200
+    assert sorted(received) == sorted([espo, bitrix])
+
+    # Kobo retries the submission: only the failed target receives it again
+    received.clear()
+    response, _ = post_fanout([espo, bitrix])
+    assert received == [espo]
+    assert "already been successfully processed" in response.json()[bitrix]["response"]["detail"]
+
+
+def test_fanout_rejects_targets_without_status():
+    for target in ("121", "generic"):
+        mapping = create_mapping(target, {"q1": "name"})
+        response, _ = post_fanout([mapping])
+        assert response.status_code == 400
+
+
+def test_fanout_unknown_mapping():
+    response, _ = post_fanout(["unknown"])
+    assert response.status_code == 404
+
+
+def test_run_shared():
+    runs = []
+
+    async def stage():
+        runs.append(1)
+        await asyncio.sleep(0)
+        return "result"
+
+    async def run():
+        assert await run_shared("key", stage) == "result"
+        token = shared_stages.set({})
+        try:
+            return await asyncio.gather(*(run_shared("key", stage) for _ in range(3)))
+        finally:
+            shared_stages.reset(token)
+
+    assert asyncio.run(run()) == ["result"] * 3
+    assert len(runs) == 2
+
+
+def test_submission_id_per_target():
+    assert submission_id(SUBMISSION) == "uuid-1"
+    assert submission_id(SUBMISSION, "mapping") == "uuid-1-mapping"
@@ -0,0 +1,36 @@
+import sys
+import os
+import json
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fastapi.responses import JSONResponse
+from utils import fastjson
+from utils.fastjson import FastJSONResponse
+
+with open(os.path.join(os.path.dirname(__file__), "program121.json"), "r") as file:
+    program = json.load(file)
+
+
+def test_fast_json_response_matches_json_response():
+    assert json.loads(FastJSONResponse(program).body) == json.loads(JSONResponse(program).body)
+    response = FastJSONResponse(status_code=201, content={"detail": "ok"})
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+
+
+def test_dumps_types():
+    data = {
+        1: Decimal("1.5"),
+        "date": datetime(2024, 7, 3),
+        "tags": frozenset(["a"]),
+        "text": "Zoë",
+    }
+    assert fastjson.loads(fastjson.dumps(data)) == {
+        "1": "1.5",
+        "date": "2024-07-03T00:00:00",
+        "tags": ["a"],
+        "text": "Zoë",
+    }
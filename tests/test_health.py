@@ -1,21 +1,69 @@
 import sys
 import os
+import asyncio
 from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from main import app
+from utils import health
 
 client = TestClient(app)
 
 
-@patch("main.requests.get")
-def test_health(requests_get):
-    mock_response = Mock()
-    mock_response.status_code = 200
-    requests_get.return_value = mock_response
-
+def test_health():
     response = client.get("/health")
     assert response.status_code == 200
-    assert response.json() == {"kobo-connect": 200, "kobo.ifrc.org": 200}
+    assert response.json() == {"kobo-connect": 200}
+
+
+@patch.dict(
+    os.environ,
+    {"COSMOS_URL": "", "HEALTH_CHECK_TARGETS": "espocrm=https://espocrm.example"},
+)
+@patch("utils.health.probe_url")
+def test_ready(probe_url):
+    async def probe(url):
+        if url == "https://espocrm.example":
+            raise RuntimeError("status 502")
+        return 200
+
+    probe_url.side_effect = probe
+    with patch.dict(health.readiness, {"warmup": "done"}):
+        asyncio.run(health.check_dependencies())
+        response = client.get("/ready")
+    assert response.status_code == 200
+    dependencies = response.json()["dependencies"]
+    assert dependencies["kobo.ifrc.org"]["status"] == "ok"
+    assert dependencies["espocrm"]["status"] == "unavailable"
+    assert dependencies["espocrm"]["required"] is False
+    assert "latency_ms" in dependencies["kobo.ifrc.org"]
+
+
+@patch.dict(os.environ, {"COSMOS_URL": "", "HEALTH_CHECK_TARGETS": ""})
+@patch("utils.health.probe_url")
+def test_not_ready_when_kobo_unavailable(probe_url):
+    async def probe(url):
+        raise RuntimeError("status 503")
+
+    probe_url.side_effect = probe
+    asyncio.run(health.check_dependencies())
+
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unavailable"
+
+
+@patch.dict(os.environ, {"COSMOS_URL": "", "HEALTH_CHECK_TARGETS": ""})
+@patch("utils.health.probe_url")
+def test_not_ready_before_warmup(probe_url):
+    async def probe(url):
+        return 200
+
+    probe_url.side_effect = probe
+    with patch.dict(health.readiness, {"warmup": "pending"}):
+        asyncio.run(health.check_dependencies())
+        response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "warming up"
@@ -0,0 +1,208 @@
+import sys
+import os
+import asyncio
+import time
+from unittest.mock import patch
+import httpx
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from clients import http_client, rate_limiter
+from clients.rate_limiter import HostLimiter, TokenBucket, parse_rate_limits
+from clients.retry import RetryBudget
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("a.example=5/10, B.example=2") == {
+        "a.example": (5.0, 10.0),
+        "b.example": (2.0, 2.0),
+    }
+
+
+def test_token_bucket_smooths_bursts():
+    bucket = TokenBucket(rate=10, burst=2)
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[:2] == [0.0, 0.0]
+    assert 0.05 < delays[2] <= 0.1
+    assert 0.15 < delays[3] <= 0.2
+
+
+def test_host_limiter_aimd():
+    async def run():
+        limiter = HostLimiter("target.example", rate=1000, burst=1000, max_concurrency=8)
+        await limiter.acquire()
+        limiter.release(429, retry_after=0.2)
+        assert limiter.concurrency == 4
+        assert limiter.paused_until > 0
+        for _ in range(40):
+            await limiter.acquire()
+            limiter.release(200)
+        assert limiter.concurrency == 8
+
+    asyncio.run(run())
+
+
+def test_host_limiter_caps_concurrency():
+    async def run():
+        limiter = HostLimiter("target.example", rate=1000, burst=1000, max_concurrency=2)
+        in_flight, peak = 0, 0
+
+        async def call():
+            nonlocal in_flight, peak
+            await limiter.acquire()
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            limiter.release(200)
+
+        await asyncio.gather(*(call() for _ in range(6)))
+        return peak
+
+    assert asyncio.run(run()) == 2
+
+
+def test_request_retries_throttled_response():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0"})
+        return httpx.Response(200, json={"id": "1"})
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+            return await http_client.post("https://throttled.example/api", json={})
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert len(calls) == 2
+
+
+def test_request_retries_connect_error_for_post():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(201, json={"id": "1"})
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)), \
+                patch("clients.retry.random.uniform", return_value=0):
+            return await http_client.post("https://connect.example/api", json={})
+
+    response = asyncio.run(run())
+    assert response.status_code == 201
+    assert len(calls) == 2
+
+
+def test_request_does_not_retry_ambiguous_post():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(502)
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+            return await http_client.post("https://ambiguous.example/api", json={})
+
+    response = asyncio.run(run())
+    assert response.status_code == 502
+    assert len(calls) == 1
+
+
+def test_request_lookup_prevents_duplicate():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(504)
+
+    async def lookup():
+        return httpx.Response(201, json={"id": "existing"})
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)), \
+                patch("clients.retry.random.uniform", return_value=0):
+            return await http_client.post(
+                "https://lookup.example/api", json={}, lookup=lookup
+            )
+
+    response = asyncio.run(run())
+    assert response.json() == {"id": "existing"}
+    assert len(calls) == 1
+
+
+def test_request_idempotency_key_header():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(502)
+        return httpx.Response(201)
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)), \
+                patch("clients.retry.random.uniform", return_value=0):
+            return await http_client.post(
+                "https://key.example/api", json={}, idempotency_key="abc"
+            )
+
+    response = asyncio.run(run())
+    assert response.status_code == 201
+    assert [c.headers["Idempotency-Key"] for c in calls] == ["abc", "abc"]
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_balance=2)
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_request_json_body():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200)
+
+    async def run():
+        with patch("clients.http_client.get_http_client", return_value=mock_client(handler)):
+            await http_client.post(
+                "https://json.example/api",
+                json={"name": "Zoë", "ids": {1, 2}},
+                headers={"X-Api-Key": "key"},
+            )
+
+    asyncio.run(run())
+    assert calls[0].headers["Content-Type"] == "application/json"
+    assert calls[0].headers["X-Api-Key"] == "key"
+    assert calls[0].content == '{"name":"Zoë","ids":[1,2]}'.encode()
+
+
+def test_kobo_is_not_rate_limited_by_default():
+    with patch.object(rate_limiter, "UNLIMITED_HOSTS", {"kobo.example"}):
+        kobo = rate_limiter.get_rate_limiter("kobo.example")
+    assert kobo.bucket is None
+    assert rate_limiter.get_rate_limiter("crm.example").bucket.rate == rate_limiter.DEFAULT_RATE
+
+    async def run():
+        for _ in range(100):
+            await kobo.acquire()
+            kobo.release(200)
+
+    start = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - start < 1
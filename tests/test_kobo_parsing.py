@@ -0,0 +1,92 @@
+import sys
+import os
+import asyncio
+import json
+import pytest
+from fastapi import HTTPException, Request
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.utilsKobo import clean_kobo_data, mapped_fields, parse_kobo_submission
+
+with open(os.path.join(os.path.dirname(__file__), "kobo_data_espo.json"), "r") as file:
+    kobo_data = json.load(file)
+
+
+def make_request(body: bytes, chunk_size: int = 1024, headers=None) -> Request:
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+
+    async def receive():
+        return messages.pop(0)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [(k.encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+    return Request(scope, receive)
+
+
+def test_parse_kobo_submission():
+    parsed = asyncio.run(parse_kobo_submission(make_request(json.dumps(kobo_data).encode())))
+    assert parsed == kobo_data
+
+
+def test_parse_kobo_submission_mapped_fields():
+    submission = {
+        **kobo_data,
+        "group/first-name": "Ada",
+        "household": [{"household/name": "Ada"}],
+        "unused/geodata": "x" * 10000,
+        "skipconnect": "0",
+    }
+    fields = mapped_fields(["targeturl", "first-name", "repeat.household.0.name"])
+    parsed = asyncio.run(
+        parse_kobo_submission(make_request(json.dumps(submission).encode()), fields)
+    )
+    assert "unused/geodata" not in parsed
+    assert parsed["group/first-name"] == "Ada"
+    assert parsed["household"] == submission["household"]
+    assert parsed["skipconnect"] == "0"
+    assert parsed["_id"] == kobo_data["_id"]
+    assert parsed["__version__"] == kobo_data["__version__"]
+    expected = clean_kobo_data(submission)
+    for key, value in clean_kobo_data(parsed).items():
+        assert expected[key] == value
+
+
+def test_mapped_fields_bitrix24_prefixes():
+    fields = mapped_fields(["multi:Services", "repeat:household:0:name", "attachment-photo"])
+    assert {"services", "household", "photo"} <= fields
+
+
+def test_parse_kobo_submission_too_large():
+    body = json.dumps(kobo_data).encode()
+    with patch("utils.utilsKobo.KOBO_MAX_BODY_BYTES", len(body) - 1):
+        # rejected on the declared length before reading
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(
+                parse_kobo_submission(
+                    make_request(body, headers={"content-length": str(len(body))})
+                )
+            )
+        assert e.value.status_code == 413
+        # rejected while streaming when the length is not declared
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(parse_kobo_submission(make_request(body, chunk_size=100)))
+        assert e.value.status_code == 413
+
+
+def test_parse_kobo_submission_invalid():
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(parse_kobo_submission(make_request(b"{not json")))
+    assert e.value.status_code == 400
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(parse_kobo_submission(make_request(b"[1, 2]")))
+    assert e.value.status_code == 422
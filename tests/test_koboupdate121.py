@@ -1,7 +1,7 @@
 import sys
 import os
 import json
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 from fastapi.testclient import TestClient
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -38,8 +38,8 @@ def test_kobo_to_121_payload():
     }
 
 
-@patch("routes.routes121.login121")
-@patch("routes.routes121.requests.patch")
+@patch("routes.routes121.login121", new_callable=AsyncMock)
+@patch("routes.routes121.http_client.patch", new_callable=AsyncMock)
 def test_kobo_update_121_skip_validation(mock_patch, mock_login):
     """Test that skipvalidation=1 skips the validation status PATCH call."""
     mock_login.return_value = "fake_token"
@@ -0,0 +1,104 @@
+import sys
+import os
+import logging
+import threading
+from opentelemetry.sdk._logs import LoggerProvider
+from opentelemetry.sdk._logs.export import InMemoryLogRecordExporter, SimpleLogRecordProcessor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.logger import (
+    ContextLoggingHandler,
+    LazyQueueHandler,
+    RedactionFilter,
+    SamplingFilter,
+    log_route,
+    parse_sample_rates,
+    redact,
+)
+from utils.tracing import tracer
+
+
+def make_record(msg, *args, level=logging.INFO, **extra):
+    record = logging.LogRecord("test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_redact_credentials():
+    assert redact("headers {'kobotoken': 'abc123', 'targeturl': 'x'}") == (
+        "headers {'kobotoken': '[REDACTED]', 'targeturl': 'x'}"
+    )
+    assert redact("Authorization: Token abc123") == "Authorization: [REDACTED]"
+    assert redact("https://b24.example/rest/1/secret/crm.item.add") == (
+        "https://b24.example/rest/1/[REDACTED]/crm.item.add"
+    )
+
+
+def test_redaction_filter_formats_and_truncates():
+    record = make_record("payload %s", "x" * 5000)
+    RedactionFilter().filter(record)
+    assert record.args is None
+    assert record.msg.startswith("payload xxx")
+    assert record.msg.endswith("[truncated 3008 characters]")
+
+
+def test_queue_handler_captures_arguments():
+    payload = [1, 2]
+    record = LazyQueueHandler(None).prepare(make_record("payload %s", payload))
+    payload.append(3)
+    assert (record.msg, record.args) == ("payload [1, 2]", None)
+
+
+def test_queue_handler_defers_formatting():
+    try:
+        raise ValueError("failed")
+    except ValueError:
+        record = make_record("received")
+        record.exc_info = sys.exc_info()
+    record = LazyQueueHandler(None).prepare(record)
+    # only records with arguments are formatted on the request path
+    assert (record.msg, record.exc_text) == ("received", None)
+
+
+def test_exported_records_keep_trace_context():
+    exporter = InMemoryLogRecordExporter()
+    provider = LoggerProvider()
+    provider.add_log_record_processor(SimpleLogRecordProcessor(exporter))
+    handler = ContextLoggingHandler(logger_provider=provider)
+
+    with tracer.start_as_current_span("request") as span:
+        record = LazyQueueHandler(None).prepare(make_record("received"))
+    # exported from another thread, like the queue listener
+    thread = threading.Thread(target=handler.emit, args=(record,))
+    thread.start()
+    thread.join()
+
+    exported = exporter.get_finished_logs()[0]
+    log_record = getattr(exported, "log_record", exported)
+    assert log_record.trace_id == span.get_span_context().trace_id
+    assert log_record.span_id == span.get_span_context().span_id
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates("INFO=0.1, /kobo-to-espocrm:DEBUG=0") == {
+        (None, logging.INFO): 0.1,
+        ("/kobo-to-espocrm", logging.DEBUG): 0.0,
+    }
+
+
+def test_sampling_per_route_level_and_submission():
+    sampling = SamplingFilter(parse_sample_rates("INFO=0.5,/kobo-to-espocrm:INFO=0"))
+    assert sampling.filter(make_record("failed", level=logging.ERROR))
+
+    token = log_route.set("/kobo-to-espocrm")
+    assert not sampling.filter(make_record("received", kobo_submission_id="1"))
+    log_route.reset(token)
+
+    # all records of a submission are kept or dropped together
+    for submission_id in range(20):
+        decisions = {
+            sampling.filter(make_record(msg, kobo_submission_id=str(submission_id)))
+            for msg in ("received", "success")
+        }
+        assert len(decisions) == 1
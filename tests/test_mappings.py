@@ -0,0 +1,239 @@
+import sys
+import os
+import asyncio
+import pytest
+from unittest.mock import patch
+import httpx
+from fastapi import FastAPI, Request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import mappings
+from routes import routesMappings
+
+
+@pytest.fixture(autouse=True)
+def mappings_db(tmp_path):
+    mappings.latest_versions.clear()
+    with patch.object(mappings, "MAPPINGS_DB", str(tmp_path / "mappings.db")):
+        yield
+
+
+def echo_app():
+    app = FastAPI()
+    app.add_middleware(mappings.MappingMiddleware)
+    app.include_router(routesMappings.router)
+
+    @app.post("/kobo-to-echo")
+    async def echo(request: Request):
+        return dict(request.headers)
+
+    @app.post("/other")
+    async def other(request: Request):
+        return dict(request.headers)
+
+    return app
+
+
+def kobo_access(username, permissions=()):
+    """Mock of the Kobo API for a token of ``username`` with ``permissions`` on the asset."""
+
+    async def get(url, **kwargs):
+        if url.endswith("/me/?format=json"):
+            return httpx.Response(200, json={"username": username})
+        return httpx.Response(
+            200,
+            json={
+                "owner__username": "owner",
+                "permissions": [
+                    {
+                        "user": f"https://kobo.example/api/v2/users/{username}/",
+                        "permission": f"https://kobo.example/api/v2/permissions/{permission}/",
+                    }
+                    for permission in permissions
+                ],
+            },
+        )
+
+    return get
+
+
+def request(method, path, access=kobo_access("owner"), **kwargs):
+    async def run():
+        routesMappings.kobo_access_cache.clear()
+        transport = httpx.ASGITransport(app=echo_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            with patch("clients.http_client.get", access):
+                return await client.request(method, path, **kwargs)
+
+    return asyncio.run(run())
+
+
+KOBO_HEADERS = {"kobotoken": "token", "koboasset": "asset"}
+
+
+def test_mapping_versions():
+    mapping = asyncio.run(
+        mappings.create_mapping("asset", "espocrm", {"TargetUrl": "https://a", "q1": "Contact.name"})
+    )
+    assert mapping["version"] == 1
+    assert mapping["headers"] == {"targeturl": "https://a", "q1": "Contact.name"}
+
+    updated = asyncio.run(mappings.update_mapping(mapping["id"], "asset", {"targeturl": "https://b"}))
+    assert updated["version"] == 2
+    assert asyncio.run(mappings.get_mapping(mapping["id"]))["headers"] == {"targeturl": "https://b"}
+    assert asyncio.run(mappings.get_mapping(mapping["id"], 1))["headers"]["targeturl"] == "https://a"
+    assert asyncio.run(mappings.update_mapping(mapping["id"], "other", {"a": "b"})) is None
+    assert [m["version"] for m in asyncio.run(mappings.list_mappings("asset"))] == [2]
+
+
+def test_invalid_headers():
+    for headers in ({}, {"content-length": "1"}, {"a b": "c"}, {"a": 1}, {"a": "b\nc"}):
+        with pytest.raises(ValueError):
+            asyncio.run(mappings.create_mapping("asset", "generic", headers))
+
+
+def test_compiled_plan_is_cached():
+    mapping = asyncio.run(mappings.create_mapping("asset", "generic", {"q1": "field"}))
+    plan = asyncio.run(mappings.get_mapping_plan(mapping["id"]))
+    assert plan.headers == ((b"q1", b"field"),)
+    with patch.object(mappings, "get_mapping", side_effect=AssertionError):
+        assert asyncio.run(mappings.get_mapping_plan(mapping["id"])) is plan
+
+
+def test_middleware_adds_mapping_headers():
+    mapping = asyncio.run(
+        mappings.create_mapping("asset", "generic", {"targeturl": "https://a", "q1": "field"})
+    )
+    response = request(
+        "POST", "/kobo-to-echo", headers={"mappingid": mapping["id"], "targeturl": "https://override"}
+    )
+    assert response.status_code == 200
+    assert response.json()["q1"] == "field"
+    assert response.json()["targeturl"] == "https://override"
+
+    asyncio.run(mappings.update_mapping(mapping["id"], "asset", {"q1": "other"}))
+    response = request("POST", "/kobo-to-echo", headers={"mappingid": mapping["id"]})
+    assert response.json()["q1"] == "other"
+    response = request("POST", "/kobo-to-echo", headers={"mappingid": mapping["id"], "mappingversion": "1"})
+    assert response.json()["q1"] == "field"
+
+
+def test_middleware_unknown_mapping():
+    assert request("POST", "/kobo-to-echo", headers={"mappingid": "unknown"}).status_code == 404
+    assert request("POST", "/kobo-to-echo").status_code == 200
+
+
+def test_mapping_routes():
+    response = request(
+        "POST", "/mappings?target=espocrm", headers=KOBO_HEADERS, json={"q1": "Contact.name"}
+    )
+    assert response.status_code == 201
+    mapping_id = response.json()["id"]
+
+    response = request("PUT", f"/mappings/{mapping_id}", headers=KOBO_HEADERS, json={"q1": "Lead.name"})
+    assert response.json()["version"] == 2
+    response = request("GET", f"/mappings/{mapping_id}?version=1", headers=KOBO_HEADERS)
+    assert response.json()["headers"] == {"q1": "Contact.name"}
+    other_asset = {"kobotoken": "token", "koboasset": "other"}
+    assert request("GET", f"/mappings/{mapping_id}", headers=other_asset).status_code == 404
+    assert request("DELETE", f"/mappings/{mapping_id}", headers=KOBO_HEADERS).status_code == 200
+    assert request("GET", "/mappings", headers=KOBO_HEADERS).json() == []
+
+
+def test_mapping_routes_require_kobo_access():
+    async def no_access(*args, **kwargs):
+        return httpx.Response(404)
+
+    async def run():
+        transport = httpx.ASGITransport(app=echo_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            with patch("clients.http_client.get", no_access):
+                return await client.get(
+                    "/mappings", headers={"kobotoken": "wrong", "koboasset": "asset"}
+                )
+
+    assert asyncio.run(run()).status_code == 403
+
+
+def test_changing_mappings_requires_change_permission():
+    mapping = asyncio.run(mappings.create_mapping("asset", "generic", {"q1": "field"}))
+    viewer = kobo_access("viewer", ["view_asset", "view_submissions"])
+    editor = kobo_access("editor", ["view_asset", "change_asset"])
+
+    assert request("GET", f"/mappings/{mapping['id']}", viewer, headers=KOBO_HEADERS).status_code == 200
+    for method, path in (
+        ("POST", "/mappings?target=generic"),
+        ("PUT", f"/mappings/{mapping['id']}"),
+        ("DELETE", f"/mappings/{mapping['id']}"),
+    ):
+        response = request(method, path, viewer, headers=KOBO_HEADERS, json={"q1": "other"})
+        assert response.status_code == 403
+    response = request(
+        "PUT", f"/mappings/{mapping['id']}", editor, headers=KOBO_HEADERS, json={"q1": "other"}
+    )
+    assert response.json()["version"] == 2
+
+
+def test_secret_headers_are_redacted():
+    response = request(
+        "POST",
+        "/mappings?target=espocrm",
+        headers=KOBO_HEADERS,
+        json={"targeturl": "https://a", "targetkey": "secret"},
+    )
+    mapping_id = response.json()["id"]
+    assert response.json()["headers"] == {"targeturl": "https://a", "targetkey": "********"}
+    response = request("GET", f"/mappings/{mapping_id}", headers=KOBO_HEADERS)
+    assert response.json()["headers"]["targetkey"] == "********"
+
+    # sending the redacted value back keeps the stored secret
+    request(
+        "PUT",
+        f"/mappings/{mapping_id}",
+        headers=KOBO_HEADERS,
+        json={"targeturl": "https://b", "targetkey": "********"},
+    )
+    assert asyncio.run(mappings.get_mapping(mapping_id))["headers"]["targetkey"] == "secret"
+
+
+def test_stored_credentials_do_not_authorize_other_routes():
+    mapping = asyncio.run(
+        mappings.create_mapping(
+            "asset",
+            "espocrm",
+            {"kobotoken": "token", "koboasset": "asset", "targeturl": "https://a", "targetkey": "SECRET"},
+        )
+    )
+    response = request(
+        "PUT",
+        f"/mappings/{mapping['id']}",
+        headers={"mappingid": mapping["id"]},
+        json={"targeturl": "https://attacker.example", "targetkey": "********"},
+    )
+    assert response.status_code == 422
+    assert asyncio.run(mappings.get_mapping(mapping["id"]))["headers"]["targeturl"] == "https://a"
+    assert "targetkey" not in request("POST", "/other", headers={"mappingid": mapping["id"]}).json()
+
+
+def test_middleware_keeps_route_in_scope():
+    mapping = asyncio.run(mappings.create_mapping("asset", "generic", {"q1": "field"}))
+    scopes = []
+
+    def outer(app):
+        async def middleware(scope, receive, send):
+            scopes.append(scope)
+            await app(scope, receive, send)
+
+        return middleware
+
+    app = echo_app()
+    app.add_middleware(outer)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/kobo-to-echo", headers={"mappingid": mapping["id"]})
+
+    assert asyncio.run(run()).status_code == 200
+    assert scopes[0]["route"].path == "/kobo-to-echo"
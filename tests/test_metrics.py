@@ -0,0 +1,61 @@
+import sys
+import os
+import asyncio
+from unittest.mock import patch
+import httpx
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from main import app
+from clients import http_client
+from utils.cache import TTLCache
+
+client = TestClient(app)
+
+
+def sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_metrics_endpoint_counts_requests():
+    labels = {"method": "GET", "route": "/", "status": "307"}
+    before = sample("kobo_connect_requests_total", labels)
+    client.get("/", follow_redirects=False)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "kobo_connect_request_duration_seconds_bucket" in response.text
+    assert sample("kobo_connect_requests_total", labels) == before + 1
+
+
+def test_downstream_metrics_per_host_and_entity():
+    labels = {"host": "metrics.example", "entity": "Contact"}
+
+    def handler(request):
+        return httpx.Response(500)
+
+    async def run():
+        mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch("clients.http_client.get_http_client", return_value=mock_client):
+            return await http_client.post(
+                "https://metrics.example/api/v1/Contact", entity="Contact"
+            )
+
+    asyncio.run(run())
+    assert sample("kobo_connect_downstream_duration_seconds_count", labels) == 1
+    assert sample("kobo_connect_downstream_errors_total", {**labels, "error": "500"}) == 1
+    assert "kobo_connect_downstream_in_flight" in client.get("/metrics").text
+
+
+def test_ttl_cache_hit_ratio():
+    cache = TTLCache("test", ttl=60)
+    assert cache.get("key") is None
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert sample("kobo_connect_cache_requests_total", {"cache": "test", "result": "hit"}) == 1
+    assert sample("kobo_connect_cache_requests_total", {"cache": "test", "result": "miss"}) == 1
+
+    cache.entries["key"] = (0, "expired")
+    assert cache.get("key") is None
@@ -0,0 +1,91 @@
+import sys
+import os
+import threading
+import time
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from main import app
+from utils.profiling import sample_stacks
+
+client = TestClient(app)
+
+
+def test_profile_request(tmp_path):
+    with patch("utils.profiling.PROFILING_KEY", "secret"), patch(
+        "utils.profiling.PROFILE_DIR", tmp_path
+    ):
+        response = client.get(
+            "/health", params={"profile": "true"}, headers={"profilingkey": "secret"}
+        )
+        assert response.status_code == 200
+        profile_id = response.headers["x-profile-id"]
+        assert (tmp_path / f"{profile_id}.prof").exists()
+
+        report = client.get(f"/profiling/{profile_id}", headers={"profilingkey": "secret"})
+        assert report.status_code == 200
+        assert "GET /health" in report.text
+        assert "cumulative time" in report.text
+
+        raw = client.get(
+            f"/profiling/{profile_id}",
+            params={"format": "pstats"},
+            headers={"profilingkey": "secret"},
+        )
+        assert raw.status_code == 200
+
+
+def test_profile_request_unauthorized(tmp_path):
+    with patch("utils.profiling.PROFILING_KEY", "secret"), patch(
+        "utils.profiling.PROFILE_DIR", tmp_path
+    ):
+        response = client.get(
+            "/health", headers={"profile": "true", "profilingkey": "wrong"}
+        )
+        assert response.status_code == 403
+        assert client.get(
+            "/profiling/sample", headers={"profilingkey": "wrong"}
+        ).status_code == 403
+        assert list(tmp_path.iterdir()) == []
+
+
+def test_profiling_disabled():
+    with patch("utils.profiling.PROFILING_KEY", ""):
+        response = client.get("/health", params={"profile": "true"})
+        assert response.status_code == 200
+        assert "x-profile-id" not in response.headers
+        assert client.get(
+            "/profiling/sample", headers={"profilingkey": ""}
+        ).status_code == 403
+
+
+def test_sample_stacks():
+    stop = threading.Event()
+
+    def busy_worker():
+        while not stop.is_set():
+            time.sleep(0.001)
+
+    worker = threading.Thread(target=busy_worker, name="busy")
+    worker.start()
+    try:
+        samples = sample_stacks(0.1, interval=0.005)
+    finally:
+        stop.set()
+        worker.join()
+    assert any(
+        stack.startswith("busy;") and "busy_worker" in stack for stack in samples
+    )
+
+
+def test_sample_profile_endpoint():
+    with patch("utils.profiling.PROFILING_KEY", "secret"):
+        response = client.get(
+            "/profiling/sample",
+            params={"seconds": 0.05},
+            headers={"profilingkey": "secret"},
+        )
+    assert response.status_code == 200
+    assert response.text.strip().split("\n")[0].rsplit(" ", 1)[1].isdigit()
@@ -0,0 +1,152 @@
+import sys
+import os
+import asyncio
+import pytest
+from unittest.mock import patch
+import httpx
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.scheduler import (
+    FairScheduler,
+    QueueFullError,
+    SchedulerMiddleware,
+    get_tenant,
+    parse_tenants,
+)
+
+
+def test_tenant_of_request():
+    assert get_tenant([(b"koboasset", b"aXk2"), (b"targeturl", b"https://a.example")]) == "aXk2"
+    assert get_tenant([(b"targeturl", b"https://A.example/rest/1/key/")]) == "a.example"
+    assert get_tenant([]) == "default"
+    assert parse_tenants("aXk2=4/16, b.example=0.5") == {"aXk2": (4.0, 16), "b.example": (0.5, None)}
+
+
+def test_invalid_tenant_settings_are_rejected():
+    for value in ("a=0", "a=-1", "a=nan", "a=1/0"):
+        with pytest.raises(ValueError):
+            parse_tenants(value)
+
+
+def test_slots_are_shared_by_weight():
+    scheduler = FairScheduler(max_concurrency=1, tenants={"a": (2.0, None)})
+    order = []
+
+    async def submission(tenant):
+        async with scheduler.slot(tenant):
+            order.append(tenant)
+            await asyncio.sleep(0)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def blocker():
+            async with scheduler.slot("x"):
+                await release.wait()
+
+        blocking = asyncio.create_task(blocker())
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(submission(tenant)) for tenant in "a" * 6 + "b" * 6]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocking, *tasks)
+
+    asyncio.run(run())
+    # while both are waiting, a gets twice the slots of b
+    assert order[:6].count("a") == 4
+    assert sorted(order) == sorted("a" * 6 + "b" * 6)
+
+
+def test_tenant_concurrency_is_capped():
+    scheduler = FairScheduler(max_concurrency=10, tenant_max_concurrency=2)
+    running = {"a": 0, "b": 0}
+    peaks = {"a": 0, "b": 0}
+
+    async def submission(tenant):
+        async with scheduler.slot(tenant):
+            running[tenant] += 1
+            peaks[tenant] = max(peaks[tenant], running[tenant])
+            await asyncio.sleep(0.01)
+            running[tenant] -= 1
+
+    async def run():
+        await asyncio.gather(*(submission(t) for t in "a" * 5 + "b"))
+
+    asyncio.run(run())
+    assert peaks == {"a": 2, "b": 1}
+    assert scheduler.in_flight == 0
+
+
+def test_cancelled_submission_leaves_queue():
+    scheduler = FairScheduler(max_concurrency=1)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("a"):
+                await release.wait()
+
+        holding = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            async with asyncio.timeout(0.01):
+                async with scheduler.slot("a"):
+                    pass
+        assert not scheduler.tenants["a"].waiters
+        release.set()
+        await holding
+
+    asyncio.run(run())
+    assert scheduler.in_flight == 0
+
+
+def test_full_queue_is_rejected():
+    scheduler = FairScheduler(max_concurrency=1, max_queue=1)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def submission():
+            async with scheduler.slot("a"):
+                await release.wait()
+
+        tasks = [asyncio.create_task(submission()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            async with scheduler.slot("a"):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert scheduler.tenants["a"].rejected == 1
+
+
+def test_middleware_rejects_when_queue_is_full():
+    app = FastAPI()
+    app.add_middleware(SchedulerMiddleware)
+    release = asyncio.Event()
+
+    @app.post("/kobo-to-generic")
+    async def submission():
+        await release.wait()
+        return {"processed": True}
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            headers = {"koboasset": "large-form"}
+            first = asyncio.create_task(client.post("/kobo-to-generic", headers=headers))
+            await asyncio.sleep(0.01)
+            rejected = await client.post("/kobo-to-generic", headers=headers)
+            release.set()
+            return await first, rejected
+
+    with patch("utils.scheduler.scheduler", FairScheduler(max_concurrency=1, max_queue=0)):
+        first, rejected = asyncio.run(run())
+    assert first.status_code == 200
+    assert rejected.status_code == 503
+    assert rejected.headers["retry-after"] == "30"
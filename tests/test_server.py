@@ -0,0 +1,45 @@
+import sys
+import os
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from clients import rate_limiter
+from utils import server
+
+
+def test_server_runs_workers():
+    with patch.dict(os.environ, {"SUBMISSION_DEADLINE_SECONDS": "240"}), patch(
+        "utils.server.uvicorn.run"
+    ) as run:
+        server.run_server("main:app", port=8000, workers=4)
+        directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+        assert os.environ["WEB_CONCURRENCY"] == "4"
+
+    kwargs = run.call_args.kwargs
+    assert kwargs["workers"] == 4
+    assert kwargs["timeout_graceful_shutdown"] == 240
+    assert kwargs["timeout_keep_alive"] == server.SERVER_KEEP_ALIVE_SECONDS
+    assert "reload" not in kwargs
+    # the temporary metrics directory is removed on exit
+    assert not os.path.exists(directory)
+
+
+def test_single_worker_keeps_single_process_metrics():
+    with patch.dict(os.environ, {}), patch("utils.server.uvicorn.run") as run:
+        os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        server.run_server("main:app", workers=1)
+        assert "PROMETHEUS_MULTIPROC_DIR" not in os.environ
+    assert run.call_args.kwargs["workers"] == 1
+
+
+def test_reload_runs_single_worker():
+    with patch.object(server, "RELOAD", True), patch("utils.server.uvicorn.run") as run:
+        server.run_server("main:app", workers=4)
+    assert run.call_args.kwargs == {"host": "0.0.0.0", "port": 8000, "reload": True}
+
+
+def test_rate_limits_are_split_among_workers():
+    with patch.object(rate_limiter, "WORKERS", 4):
+        limiter = rate_limiter.get_rate_limiter("split.example")
+    assert limiter.bucket.rate == rate_limiter.DEFAULT_RATE / 4
@@ -0,0 +1,29 @@
+import sys
+import os
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def imported_modules(*modules):
+    """Which of the modules are imported by importing main, in a fresh interpreter."""
+    env = {**os.environ, "PORT": "8000", "APPLICATIONINSIGHTS_CONNECTION_STRING": ""}
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, main; print([m for m in {list(modules)!r} if m in sys.modules])",
+        ],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+def test_heavy_modules_are_imported_lazily():
+    assert imported_modules("pandas", "azure.monitor.opentelemetry.exporter") == "[]"
@@ -0,0 +1,74 @@
+import sys
+import os
+import asyncio
+from unittest.mock import patch
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from clients import http_client
+from utils.tracing import set_submission_attributes, traced, tracer_provider
+
+exporter = InMemorySpanExporter()
+tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+app = FastAPI()
+
+
+@traced()
+async def process_stage():
+    return "done"
+
+
+@app.post("/kobo-to-test/{target}")
+async def kobo_to_test(request: Request, target: str):
+    kobo_data = await request.json()
+    set_submission_attributes(kobo_data, target=request.headers["targeturl"])
+    return {"detail": await process_stage()}
+
+
+def spans_by_name():
+    return {span.name: span for span in exporter.get_finished_spans()}
+
+
+def test_route_and_stage_spans():
+    exporter.clear()
+    client = TestClient(app)
+    response = client.post(
+        "/kobo-to-test/espocrm",
+        json={"_id": 1, "_uuid": "a", "_xform_id_string": "form"},
+        headers={"targeturl": "https://espocrm.example/api/v1"},
+    )
+    assert response.status_code == 200
+
+    spans = spans_by_name()
+    server = spans["POST /kobo-to-test/{target}"]
+    stage = spans["process_stage"]
+    assert stage.context.trace_id == server.context.trace_id
+    assert stage.attributes["kobo.submission_id"] == "1"
+    assert stage.attributes["kobo.form_id"] == "form"
+    assert stage.attributes["target.host"] == "espocrm.example"
+    assert server.attributes["http.response.status_code"] == 200
+
+
+def test_downstream_call_span():
+    exporter.clear()
+
+    def handler(request):
+        return httpx.Response(404)
+
+    async def run():
+        set_submission_attributes({"_id": 2})
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch("clients.http_client.get_http_client", return_value=client):
+            return await http_client.get("https://traced.example/api/Contact")
+
+    asyncio.run(run())
+    span = spans_by_name()["GET traced.example"]
+    assert span.attributes["server.address"] == "traced.example"
+    assert span.attributes["http.response.status_code"] == 404
+    assert span.attributes["kobo.submission_id"] == "2"
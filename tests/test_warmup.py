@@ -0,0 +1,94 @@
+import sys
+import os
+import asyncio
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import health, mappings, warmup
+from routes.routesEspo import preload_related_entities, related_entity_cache
+
+
+class FakeEspoClient:
+    url = "https://espocrm.example"
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    async def request(self, method, action, params=None):
+        self.requests.append((method, action, params))
+        return self.response
+
+
+def test_related_entities_are_preloaded():
+    related_entity_cache.clear()
+    client = FakeEspoClient(
+        {
+            "total": 3,
+            "list": [
+                {"id": "1", "name": "North"},
+                {"id": "2", "name": "South"},
+                {"id": "3", "name": "south"},
+            ],
+        }
+    )
+    assert asyncio.run(preload_related_entities(client, "Branch", "name", {})) == 1
+    cached = related_entity_cache.get((client.url, "Branch", "name", "North"))
+    assert cached.record_id == "1"
+    # ambiguous values are still looked up, and reported as such
+    assert related_entity_cache.get((client.url, "Branch", "name", "South")) is None
+
+
+def test_large_related_entities_are_not_preloaded():
+    related_entity_cache.clear()
+    client = FakeEspoClient({"total": 500, "list": [{"id": "1", "name": "North"}]})
+    assert asyncio.run(preload_related_entities(client, "Branch", "name", {})) == 0
+
+
+def test_warm_up(tmp_path):
+    probed, logins, preloaded = [], [], []
+
+    async def probe_url(url):
+        probed.append(url)
+        if url == "https://down.example":
+            raise RuntimeError("status 502")
+        return 200
+
+    async def login121(url, username, password):
+        logins.append((url, username, password))
+
+    async def preload(client, entity, field, logs):
+        preloaded.append((client.url, entity, field))
+        return 1
+
+    async def check_dependencies():
+        return health.readiness
+
+    env = {
+        "WARMUP_URLS": "https://espocrm.example, https://down.example",
+        "WARMUP_121": "https://121.example=user:pass:word",
+    }
+    with patch.object(mappings, "MAPPINGS_DB", str(tmp_path / "mappings.db")), patch.dict(
+        os.environ, env
+    ), patch.dict(health.readiness, {"warmup": "pending"}), patch(
+        "utils.health.probe_url", probe_url
+    ), patch("utils.warmup.login121", login121), patch(
+        "utils.warmup.preload_related_entities", preload
+    ), patch("utils.health.check_dependencies", check_dependencies):
+        mapping = asyncio.run(
+            mappings.create_mapping(
+                "asset",
+                "espocrm",
+                {"targeturl": "https://espocrm.example", "q1": "Contact.branch.name"},
+            )
+        )
+        mappings.latest_versions.clear()
+        asyncio.run(warmup.warm_up())
+        status = health.readiness["warmup"]
+
+    assert status == "done"
+    assert "https://espocrm.example" in probed and "https://down.example" in probed
+    assert logins == [("https://121.example", "user", "pass:word")]
+    assert preloaded == [("https://espocrm.example", "Branch", "name")]
+    assert mappings.latest_versions.get(mapping["id"]).version == 1
@@ -0,0 +1,107 @@
+import sys
+import os
+import asyncio
+import time
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.deadline import deadline
+from utils.tracing import span_attributes
+from utils.write_buffer import WriteBuffer
+from utils import utilsEspo
+
+
+def test_write_buffer_flushes_full_batches():
+    batches = []
+
+    async def flush(key, items):
+        batches.append((key, items))
+        return [item * 10 for item in items]
+
+    async def run():
+        buffer = WriteBuffer("test", flush, max_batch=3, max_delay=60)
+        return await asyncio.gather(*(buffer.submit("a", i) for i in range(6)))
+
+    assert asyncio.run(run()) == [0, 10, 20, 30, 40, 50]
+    assert batches == [("a", [0, 1, 2]), ("a", [3, 4, 5])]
+
+
+def test_write_buffer_flushes_after_delay_per_key():
+    batches = []
+
+    async def flush(key, items):
+        batches.append((key, items))
+        return items
+
+    async def run():
+        buffer = WriteBuffer("test", flush, max_batch=100, max_delay=0.01)
+        return await asyncio.gather(
+            buffer.submit("a", 1), buffer.submit("b", 2), buffer.submit("a", 3)
+        )
+
+    assert asyncio.run(run()) == [1, 2, 3]
+    assert sorted(batches) == [("a", [1, 3]), ("b", [2])]
+
+
+def test_write_buffer_per_item_outcome():
+    async def flush(key, items):
+        return [ValueError("rejected") if item == "bad" else item for item in items]
+
+    async def run():
+        buffer = WriteBuffer("test", flush, max_batch=100, max_delay=0.01)
+        return await asyncio.gather(
+            buffer.submit("a", "good"), buffer.submit("a", "bad"), return_exceptions=True
+        )
+
+    good, bad = asyncio.run(run())
+    assert good == "good"
+    assert isinstance(bad, ValueError)
+
+
+class FakeEspoClient:
+    url = "https://espocrm.example"
+    api_key = "key"
+
+    def __init__(self):
+        self.calls = []
+
+    async def request(self, method, action, params=None):
+        self.calls.append((method, action, params))
+        if params.get("fail"):
+            raise HTTPException(status_code=400, detail="Bad Request")
+        return {"id": f"{action}-{len(self.calls)}"}
+
+
+def test_create_records():
+    client = FakeEspoClient()
+    payload = {"CTask": {"name": "a"}, "CFailed": {"fail": True}, "CNote": {"name": "b"}}
+    created = asyncio.run(utilsEspo.create_records(client, payload))
+
+    assert created["CTask"]["id"].startswith("CTask-")
+    assert created["CFailed"] is None
+    assert created["CNote"]["id"].startswith("CNote-")
+    assert sorted(call[1] for call in client.calls) == ["CFailed", "CNote", "CTask"]
+
+
+def test_write_buffer_flushes_in_own_context():
+    flushed = []
+
+    async def flush(key, items):
+        flushed.append((span_attributes.get(), deadline.get()))
+        return items
+
+    async def submit(buffer, item, seconds):
+        span_attributes.set({"submission": item})
+        deadline.set(time.monotonic() + seconds)
+        return await buffer.submit("a", item)
+
+    async def run():
+        buffer = WriteBuffer("test", flush, max_batch=100, max_delay=0.01)
+        return await asyncio.gather(submit(buffer, "late", 60), submit(buffer, "early", 30))
+
+    assert asyncio.run(run()) == ["late", "early"]
+    [(attributes, batch_deadline)] = flushed
+    # no submission's attributes leak into the batch, bound by the earliest deadline
+    assert attributes == {}
+    assert batch_deadline - time.monotonic() < 31
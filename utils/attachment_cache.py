@@ -0,0 +1,174 @@
+"""Content-addressed cache of Kobo attachments on local disk.
+
+Attachments are stored once per content hash under ``objects/``. They are
+found through a reference per attachment (download URL and Kobo token, so a
+token never reads an attachment it could not download) under ``refs/``.
+When the attachments exceed ATTACHMENT_CACHE_MAX_BYTES, the least recently
+used ones are evicted. Cached attachments are read as memory maps, so they are
+not copied into memory before being encoded for upload.
+
+The IDs of attachments uploaded to a target are kept under ``uploads/`` for
+ATTACHMENT_UPLOAD_TTL seconds, so that a retried submission reuses them
+instead of uploading the same file again.
+
+The directory can be shared by the worker processes of an instance. A
+ATTACHMENT_CACHE_MAX_BYTES or ATTACHMENT_UPLOAD_TTL of 0 disables the cache
+of attachments or of uploads.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from utils.logger import logger
+from utils.metrics import record_cache
+
+# load environment variables
+load_dotenv()
+
+ATTACHMENT_CACHE_DIR = os.getenv("ATTACHMENT_CACHE_DIR", "attachment-cache")
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(2**30)))
+ATTACHMENT_UPLOAD_TTL = float(os.getenv("ATTACHMENT_UPLOAD_TTL", "86400"))
+
+
+def cache_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def write_atomic(path: Path, data) -> None:
+    """Write a file, so that other processes never read it half-written."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class AttachmentCache:
+    """Attachments and upload IDs, cached in a local directory."""
+
+    def __init__(
+        self,
+        directory: str | os.PathLike,
+        max_bytes: int = ATTACHMENT_CACHE_MAX_BYTES,
+        upload_ttl: float = ATTACHMENT_UPLOAD_TTL,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.upload_ttl = upload_ttl
+        # estimate of the size of objects/, None until the directory is scanned
+        self.size: int | None = None
+
+    def object_path(self, digest: str) -> Path:
+        return self.directory / "objects" / digest[:2] / digest
+
+    def read(self, key: str) -> mmap.mmap | None:
+        try:
+            digest = (self.directory / "refs" / key).read_text()
+            path = self.object_path(digest)
+            with open(path, "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            # mark as recently used, for eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return data
+
+    def write(self, key: str, data: bytes) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if path.exists():
+            os.utime(path)
+        else:
+            write_atomic(path, data)
+            if self.size is not None:
+                self.size += len(data)
+        write_atomic(self.directory / "refs" / key, digest.encode())
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used attachments above max_bytes.
+
+        Expired upload IDs are deleted too.
+        """
+        for path in (self.directory / "uploads").glob("*"):
+            self.read_upload(path.name)
+        objects = []
+        for path in (self.directory / "objects").glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            objects.append((stat.st_mtime, stat.st_size, path))
+        self.size = sum(size for _, size, _ in objects)
+        objects.sort()
+        evicted = 0
+        for _, size, path in objects:
+            if self.size <= self.max_bytes:
+                break
+            # references to evicted attachments are dropped when read
+            path.unlink(missing_ok=True)
+            self.size -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} attachments from the attachment cache")
+
+    async def get(self, key: str) -> mmap.mmap | None:
+        """Get a cached attachment, or None."""
+        if self.max_bytes <= 0:
+            return None
+        data = await asyncio.to_thread(self.read, key)
+        record_cache("attachment", data is not None)
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        """Cache an attachment; failures to write are logged, not raised."""
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self.write, key, data)
+        except OSError as e:
+            logger.warning(f"Failed to cache attachment: {e}")
+
+    def read_upload(self, key: str) -> str | None:
+        path = self.directory / "uploads" / key
+        try:
+            if path.stat().st_mtime + self.upload_ttl < time.time():
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_text()
+        except FileNotFoundError:
+            return None
+
+    async def get_upload(self, key: str) -> str | None:
+        """Get the ID of an attachment already uploaded to a target, or None."""
+        if self.upload_ttl <= 0:
+            return None
+        upload_id = await asyncio.to_thread(self.read_upload, key)
+        record_cache("attachment_upload", upload_id is not None)
+        return upload_id
+
+    async def set_upload(self, key: str, upload_id: str) -> None:
+        if self.upload_ttl <= 0:
+            return
+        try:
+            await asyncio.to_thread(
+                write_atomic, self.directory / "uploads" / key, upload_id.encode()
+            )
+        except OSError as e:
+            logger.warning(f"Failed to cache attachment upload: {e}")
+
+
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_DIR)
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator
+from urllib.parse import urlsplit
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from clients import http_client
+from clients.rate_limiter import TokenBucket
+from utils.cosmos import get_submission_ids_with_status, submission_id
+from utils.logger import logger
+from utils.utilsKobo import KOBO_API_URL
+
+PAGE_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+
+async def get_kobo_hook(koboasset: str, kobotoken: str, hook_id: str) -> dict[str, Any]:
+    """Get the configuration of a Kobo REST service (endpoint and custom headers)."""
+    response = await http_client.get(
+        f"{KOBO_API_URL}/assets/{koboasset}/hooks/{hook_id}/",
+        headers={"Authorization": f"Token {kobotoken}"},
+    )
+    if response.status_code >= 400:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Failed to get Kobo REST service: {response.content.decode('utf-8')}",
+        )
+    return response.json()
+
+
+def get_hook_route(app: FastAPI, hook: dict[str, Any]) -> str:
+    """Return the path of the kobo-connect route a Kobo REST service posts to."""
+    path = urlsplit(hook.get("endpoint", "")).path.rstrip("/")
+    routes = {getattr(route, "path", None) for route in app.routes}
+    if (
+        not path.startswith(("/kobo-to-", "/kobo-update-"))
+        or path not in routes
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"REST service endpoint '{hook.get('endpoint')}' is not a kobo-connect route",
+        )
+    return path
+
+
+def stored_submission_ids(
+    path: str, headers: dict[str, str], submission: dict[str, Any]
+) -> list[str]:
+    """IDs under which a route stores a submission, built as the route builds them."""
+    headers = {key.lower(): value for key, value in headers.items()}
+    uuid = str(submission.get("_uuid"))
+    if path == "/kobo-to-linked-kobo":
+        return [uuid + headers.get("childasset", "")]
+    if path == "/kobo-to-many":
+        mapping_ids = [i.strip() for i in headers.get("mappingids", "").split(",") if i.strip()]
+        return [submission_id({"_uuid": uuid}, mapping_id) for mapping_id in mapping_ids]
+    return [uuid]
+
+
+async def iter_kobo_submissions(
+    koboasset: str,
+    kobotoken: str,
+    start_date: str | None = None,
+    end_date: str | None = None,
+) -> AsyncIterator[list[dict[str, Any]]]:
+    """Page through the submissions of a Kobo form, optionally within a date range.
+
+    Dates are compared with the submission time, e.g. ``2025-01-31`` or
+    ``2025-01-31T12:00:00``.
+    """
+    query: dict[str, Any] = {}
+    if start_date:
+        query.setdefault("_submission_time", {})["$gte"] = start_date
+    if end_date:
+        query.setdefault("_submission_time", {})["$lte"] = end_date
+    params = {"limit": PAGE_SIZE, "start": 0, "sort": json.dumps({"_id": 1})}
+    if query:
+        params["query"] = json.dumps(query)
+
+    while True:
+        response = await http_client.get(
+            f"{KOBO_API_URL}/assets/{koboasset}/data.json",
+            headers={"Authorization": f"Token {kobotoken}"},
+            params=params,
+        )
+        response.raise_for_status()
+        data = response.json()
+        yield data["results"]
+        if not data.get("next"):
+            break
+        params["start"] += PAGE_SIZE
+
+
+async def backfill_submissions(
+    app: FastAPI,
+    path: str,
+    headers: dict[str, str],
+    koboasset: str,
+    kobotoken: str,
+    start_date: str | None = None,
+    end_date: str | None = None,
+    only_failed: bool = False,
+    concurrency: int = 4,
+    rate_limit: float = 2.0,
+) -> AsyncIterator[str]:
+    """Replay Kobo submissions through a kobo-connect route.
+
+    Submissions are posted to ``path`` in-process, with the given (REST
+    service) headers, so they go through exactly the same pipeline as a
+    webhook from Kobo, including duplicate detection in the submission store.
+    At most ``concurrency`` submissions are processed at the same time and at
+    most ``rate_limit`` submissions are started per second.
+
+    Yields newline-delimited JSON: one progress line per page of submissions
+    and a summary line at the end.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(rate_limit, burst=1)
+    summary: dict[str, Any] = {
+        "total": 0,
+        "skipped": 0,
+        "succeeded": 0,
+        "failed": 0,
+        "errors": [],
+    }
+    started = time.monotonic()
+
+    async def replay(internal_client: httpx.AsyncClient, submission: dict[str, Any]):
+        async with semaphore:
+            wait = bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                response = await internal_client.post(
+                    path, headers=headers, json=submission
+                )
+                status_code, detail = response.status_code, response.text
+            except Exception as e:
+                status_code, detail = 500, str(e)
+        if 200 <= status_code <= 299:
+            summary["succeeded"] += 1
+        else:
+            summary["failed"] += 1
+            if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+                summary["errors"].append(
+                    {
+                        "kobo_submission_id": submission.get("_id"),
+                        "status_code": status_code,
+                        "detail": detail[:500],
+                    }
+                )
+
+    def progress() -> dict[str, Any]:
+        elapsed = time.monotonic() - started
+        processed = summary["succeeded"] + summary["failed"]
+        return {
+            "total": summary["total"],
+            "skipped": summary["skipped"],
+            "succeeded": summary["succeeded"],
+            "failed": summary["failed"],
+            "elapsed_seconds": round(elapsed, 2),
+            "submissions_per_second": round(processed / elapsed, 2) if elapsed else 0,
+        }
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://kobo-connect", timeout=None
+    ) as internal_client:
+        try:
+            async for page in iter_kobo_submissions(
+                koboasset, kobotoken, start_date, end_date
+            ):
+                summary["total"] += len(page)
+                if only_failed:
+                    ids = [stored_submission_ids(path, headers, s) for s in page]
+                    failed_ids = await get_submission_ids_with_status(
+                        [i for submission_ids in ids for i in submission_ids], "failed"
+                    )
+                    # a fan-out is replayed if any of its targets failed
+                    selected = [
+                        s
+                        for s, submission_ids in zip(page, ids)
+                        if failed_ids.intersection(submission_ids)
+                    ]
+                    summary["skipped"] += len(page) - len(selected)
+                    page = selected
+                await asyncio.gather(
+                    *(replay(internal_client, submission) for submission in page)
+                )
+                logger.info(f"Backfill of {koboasset} through {path}: {progress()}")
+                yield json.dumps({"progress": progress()}) + "\n"
+        except httpx.HTTPError as e:
+            logger.error(f"Backfill of {koboasset} aborted: {e}")
+            yield json.dumps({"error": f"Failed to get submissions from Kobo: {e}"}) + "\n"
+
+    result = progress()
+    result["errors"] = summary["errors"]
+    logger.info(
+        f"Backfill of {koboasset} through {path} completed: "
+        f"{result['succeeded']} succeeded, {result['failed']} failed, "
+        f"{result['submissions_per_second']} submissions per second"
+    )
+    yield json.dumps({"summary": result}) + "\n"
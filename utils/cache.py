@@ -0,0 +1,48 @@
+"""Small in-memory caches whose hits and misses are reported in the metrics."""
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from utils.metrics import record_cache
+
+
+class TTLCache:
+    """Cache whose entries expire ``ttl`` seconds after being set.
+
+    The least recently set entry is evicted once ``maxsize`` entries are
+    stored. A ``ttl`` of 0 disables the cache.
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int = 1024):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any | None:
+        """Return the cached value of a key, or None if missing or expired."""
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.entries[key]
+            entry = None
+        record_cache(self.name, entry is not None)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: Hashable, value: Any):
+        if self.ttl <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a key, returning its value (even if expired) or ``default``."""
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def clear(self):
+        self.entries.clear()
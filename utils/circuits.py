@@ -0,0 +1,53 @@
+"""Fail fast on submissions to a target whose circuit is open.
+
+While the circuit of a target host is open (see ``clients.circuit_breaker``),
+its submissions are rejected with 503 and a ``Retry-After`` header before
+anything is stored or downloaded, instead of failing at the last step. Kobo
+retries them later; once a probe succeeds, submissions are processed again.
+"""
+
+from __future__ import annotations
+
+import math
+from urllib.parse import urlsplit
+
+from clients.circuit_breaker import breakers
+from utils.deadline import has_deadline
+from utils.fastjson import FastJSONResponse
+from utils.logger import logger
+from utils.metrics import CIRCUIT_REJECTIONS
+
+# headers with the URL of the target of a submission
+TARGET_HEADERS = (b"targeturl", b"url121")
+
+
+class CircuitBreakerMiddleware:
+    """ASGI middleware rejecting submissions to targets whose circuit is open."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not has_deadline(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        for name in TARGET_HEADERS:
+            url = headers.get(name)
+            if url is None:
+                continue
+            host = urlsplit(url.decode("latin-1").strip()).netloc.lower()
+            breaker = breakers.get(host)
+            if breaker is None or breaker.state != "open":
+                continue
+            retry_after = breaker.retry_after()
+            CIRCUIT_REJECTIONS.labels(host).inc()
+            logger.warning(f"Rejecting submission to {host}: circuit open")
+            response = FastJSONResponse(
+                status_code=503,
+                content={"detail": f"Target {host} is unavailable"},
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -1,18 +1,46 @@
 import os
+import time
+import socket
+import asyncio
+from contextvars import ContextVar
 from dotenv import load_dotenv
-import azure.cosmos.cosmos_client as cosmos_client
-from azure.cosmos.exceptions import CosmosResourceExistsError
+from azure.core import MatchConditions
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+)
 from fastapi import HTTPException
+from utils.logger import logger
+from utils.tracing import traced
 
 # load environment variables
 load_dotenv()
 
+cosmos_client = None
 cosmos_container_client = None
 
+# pending submissions are leased to the worker processing them; when the lease
+# expires (e.g. the worker crashed) the submission can be taken over
+LEASE_SECONDS = int(os.getenv("SUBMISSION_LEASE_SECONDS", "300"))
+LEASE_REAPER_INTERVAL = int(os.getenv("SUBMISSION_LEASE_REAPER_INTERVAL", "60"))
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+# set while a submission is sent to one of several targets (see utils.fanout),
+# so that each target has its own status
+submission_target: ContextVar[str | None] = ContextVar("submission_target", default=None)
+
+# submissions leased while processing the current request (see utils.deadline)
+leased_submissions: ContextVar[list | None] = ContextVar("leased_submissions", default=None)
+
 
 def get_cosmos_container_client():
-    """Get the configured CosmosDB container client."""
-    global cosmos_container_client
+    """Get the configured CosmosDB container client.
+
+    The async client is normally created once at FastAPI startup (see
+    ``init_cosmos_client``); it is created lazily here if startup was skipped.
+    """
+    global cosmos_client, cosmos_container_client
 
     if cosmos_container_client is None:
         cosmos_url = os.getenv("COSMOS_URL")
@@ -23,43 +51,215 @@ def get_cosmos_container_client():
                 detail="CosmosDB is not configured.",
             )
 
-        client_ = cosmos_client.CosmosClient(
+        cosmos_client = CosmosClient(
             cosmos_url,
             {"masterKey": cosmos_key},
             user_agent="kobo-connect",
             user_agent_overwrite=True,
         )
-        cosmos_db = client_.get_database_client("kobo-connect")
+        cosmos_db = cosmos_client.get_database_client("kobo-connect")
         cosmos_container_client = cosmos_db.get_container_client("kobo-submissions")
 
     return cosmos_container_client
 
 
-def add_submission(kobo_data):
-    """Add submission to CosmosDB. If submission already exists and status is pending, raise HTTPException."""
+def init_cosmos_client():
+    """Create the shared CosmosDB client at startup, if CosmosDB is configured."""
+    try:
+        return get_cosmos_container_client()
+    except HTTPException:
+        logger.warning("CosmosDB is not configured, submissions will not be stored")
+        return None
+
+
+async def close_cosmos_client():
+    """Close the shared CosmosDB client and its connection pool."""
+    global cosmos_client, cosmos_container_client
+
+    if cosmos_client is not None:
+        await cosmos_client.close()
+    cosmos_client = None
+    cosmos_container_client = None
+
+
+def submission_id(kobo_data, target=None):
+    """ID of a submission in CosmosDB, per target if it is sent to several."""
+    target = submission_target.get() if target is None else target
+    if target is None:
+        return str(kobo_data["_uuid"])
+    return f"{kobo_data['_uuid']}-{target}"
+
+
+def lease_operations(now=None):
+    """Patch operations that (re)claim a submission for this worker."""
+    now = time.time() if now is None else now
+    return [
+        {"op": "set", "path": "/status", "value": "pending"},
+        {"op": "set", "path": "/lease_owner", "value": WORKER_ID},
+        {"op": "set", "path": "/lease_expires_at", "value": now + LEASE_SECONDS},
+    ]
+
+
+@traced()
+async def add_submission(kobo_data):
+    """Add submission to CosmosDB and lease it to this worker.
+
+    If the submission already exists and is pending with a valid lease, raise
+    HTTPException. If it failed or its lease expired, take over processing.
+    """
+    now = time.time()
     submission = {
-        "id": str(kobo_data["_uuid"]),
+        "id": submission_id(kobo_data),
         "uuid": str(kobo_data["formhub/uuid"]),
         "status": "pending",
+        "lease_owner": WORKER_ID,
+        "lease_expires_at": now + LEASE_SECONDS,
     }
     cosmos_container_client = get_cosmos_container_client()
     try:
-        submission = cosmos_container_client.create_item(body=submission)
+        submission = await cosmos_container_client.create_item(body=submission)
     except CosmosResourceExistsError:
-        submission = cosmos_container_client.read_item(
-            item=str(kobo_data["_uuid"]),
+        submission = await cosmos_container_client.read_item(
+            item=submission["id"],
             partition_key=str(kobo_data["formhub/uuid"]),
         )
+        if submission["status"] == "success":
+            return submission
+        if (
+            submission["status"] == "pending"
+            and (submission.get("lease_expires_at") or 0) > now
+        ):
+            raise HTTPException(
+                status_code=400, detail="Submission is still being processed."
+            )
         if submission["status"] == "pending":
+            logger.warning(
+                f"Taking over submission {submission['id']} with expired lease "
+                f"of {submission.get('lease_owner')}",
+                extra={"kobo_submission_uuid": str(submission["id"])},
+            )
+        try:
+            submission = await patch_submission(submission, lease_operations(now))
+        except HTTPException:
+            # another worker claimed the submission first
             raise HTTPException(
                 status_code=400, detail="Submission is still being processed."
             )
+    leased = leased_submissions.get()
+    if leased is not None and submission["status"] == "pending":
+        leased.append(submission)
     return submission
 
 
-def update_submission_status(submission, status, error_message=None):
+async def patch_submission(submission, operations):
+    """Apply a partial update to a submission in CosmosDB.
+
+    The patch is conditional on the ETag of the stored submission, so that a
+    submission changed by another worker in the meantime is never overwritten.
+    The submission dict is updated in place with the stored document.
+    """
+    cosmos_container_client = get_cosmos_container_client()
+    etag = submission.get("_etag")
+    try:
+        updated = await cosmos_container_client.patch_item(
+            item=str(submission["id"]),
+            partition_key=str(submission["uuid"]),
+            patch_operations=operations,
+            etag=etag,
+            match_condition=MatchConditions.IfNotModified if etag else None,
+        )
+    except CosmosAccessConditionFailedError:
+        logger.warning(
+            f"Submission {submission['id']} was updated by another worker",
+            extra={"kobo_submission_uuid": str(submission["id"])},
+        )
+        raise HTTPException(
+            status_code=409, detail="Submission was updated by another worker."
+        )
+    submission.update(updated)
+    return submission
+
+
+@traced()
+async def update_submission_status(submission, status, error_message=None):
     """Update submission status in CosmosDB."""
-    submission["status"] = status
-    submission["error_message"] = error_message
+    return await patch_submission(
+        submission,
+        [
+            {"op": "set", "path": "/status", "value": status},
+            {"op": "set", "path": "/error_message", "value": error_message},
+            {"op": "set", "path": "/lease_expires_at", "value": None},
+        ],
+    )
+
+
+async def release_submissions(submissions, error_message):
+    """Mark the submissions still leased to this worker as failed."""
+    for submission in submissions or []:
+        if submission["status"] != "pending" or submission.get("lease_owner") != WORKER_ID:
+            continue
+        try:
+            await update_submission_status(submission, "failed", error_message)
+        except Exception as e:
+            # the lease reaper releases it once the lease expires
+            logger.error(
+                f"Failed to release submission {submission['id']}: {e}",
+                extra={"kobo_submission_uuid": str(submission["id"])},
+            )
+
+
+async def get_submission_ids_with_status(ids, status):
+    """Return which of the given submission ids are stored with the given status."""
+    cosmos_container_client = get_cosmos_container_client()
+    submissions = cosmos_container_client.query_items(
+        query="SELECT c.id FROM c WHERE c.status = @status AND ARRAY_CONTAINS(@ids, c.id)",
+        parameters=[
+            {"name": "@status", "value": status},
+            {"name": "@ids", "value": list(ids)},
+        ],
+    )
+    return {submission["id"] async for submission in submissions}
+
+
+async def reap_expired_leases():
+    """Mark pending submissions with an expired lease as failed.
+
+    Failed submissions are picked up again by the next Kobo retry or by a
+    backfill of failed submissions. Returns the number of reaped submissions.
+    """
     cosmos_container_client = get_cosmos_container_client()
-    cosmos_container_client.replace_item(item=str(submission["id"]), body=submission)
+    expired = cosmos_container_client.query_items(
+        query="SELECT * FROM c WHERE c.status = 'pending' "
+        "AND IS_NUMBER(c.lease_expires_at) AND c.lease_expires_at < @now",
+        parameters=[{"name": "@now", "value": time.time()}],
+    )
+    reaped = 0
+    async for submission in expired:
+        logger.warning(
+            f"Lease of {submission.get('lease_owner')} on submission "
+            f"{submission['id']} expired, releasing it",
+            extra={"kobo_submission_uuid": str(submission["id"])},
+        )
+        try:
+            await update_submission_status(
+                submission, "failed", "Processing lease expired"
+            )
+            reaped += 1
+        except HTTPException:
+            # taken over by another worker in the meantime
+            continue
+    return reaped
+
+
+async def run_lease_reaper(interval=LEASE_REAPER_INTERVAL):
+    """Periodically release submissions whose lease expired."""
+    while True:
+        try:
+            reaped = await reap_expired_leases()
+            if reaped:
+                logger.info(f"Released {reaped} submissions with expired lease")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to release submissions with expired lease: {e}")
+        await asyncio.sleep(interval)
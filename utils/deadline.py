@@ -0,0 +1,136 @@
+"""Deadlines of submissions and timeouts of outbound calls.
+
+A submission (a ``/kobo-to-*`` or ``/kobo-update-*`` request, except
+``/kobo-to-linked-kobo``) must be processed within SUBMISSION_DEADLINE_SECONDS. The deadline is kept in a
+context variable, so it applies to every stage of the submission:
+- outbound calls get connect and read timeouts capped to the remaining time
+  (see ``get_timeout``);
+- retries stop when the remaining time is too short;
+- the request is cancelled when the deadline passes.
+
+The submissions leased by a cancelled request are then marked as failed, so
+that the next Kobo retry or a backfill processes them again, and the request
+fails with 504. Likewise, when a target cannot be reached (its circuit is open,
+or the connection failed after the retries), the leased submissions are marked
+as failed and the request fails fast with 503 and a ``Retry-After`` header.
+
+The deadline should stay below SUBMISSION_LEASE_SECONDS, so that a submission
+is never taken over while it is still being processed.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import time
+from contextvars import ContextVar
+
+import httpx
+from dotenv import load_dotenv
+from clients.circuit_breaker import CIRCUIT_OPEN_SECONDS
+from utils.cosmos import leased_submissions, release_submissions
+from utils.fastjson import FastJSONResponse
+from utils.logger import logger
+from utils.metrics import DEADLINES_EXCEEDED
+
+# load environment variables
+load_dotenv()
+
+SUBMISSION_DEADLINE_SECONDS = float(os.getenv("SUBMISSION_DEADLINE_SECONDS", "240"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+DEADLINE_PATHS = ("/kobo-to-", "/kobo-update-")
+# pages through the whole parent form, which can take longer than any deadline
+NO_DEADLINE_PATHS = ("/kobo-to-linked-kobo",)
+
+# time.monotonic() at which the current submission must be processed
+deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+def has_deadline(path: str) -> bool:
+    """Whether requests to the path are submissions with a deadline."""
+    return path.startswith(DEADLINE_PATHS) and not path.startswith(NO_DEADLINE_PATHS)
+
+
+def remaining() -> float | None:
+    """Seconds left before the deadline, or None without deadline."""
+    value = deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def get_timeout(timeout: float | httpx.Timeout | None = None) -> httpx.Timeout:
+    """Timeout of an outbound call, capped to the time left before the deadline.
+
+    Raises TimeoutError if the deadline has passed.
+    """
+    if isinstance(timeout, httpx.Timeout):
+        connect, read = timeout.connect, timeout.read
+    else:
+        connect, read = HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT if timeout is None else timeout
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise TimeoutError("Deadline exceeded")
+        connect = left if connect is None else min(connect, left)
+        read = left if read is None else min(read, left)
+    return httpx.Timeout(read, connect=connect)
+
+
+class DeadlineMiddleware:
+    """ASGI middleware enforcing the deadline of submissions."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not has_deadline(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        # a submission sent to several targets keeps the deadline of the fan-out
+        seconds = SUBMISSION_DEADLINE_SECONDS
+        left = remaining()
+        if left is not None:
+            seconds = min(seconds, left)
+        deadline_token = deadline.set(time.monotonic() + seconds)
+        leased = leased_submissions.get()
+        leased_token = leased_submissions.set([] if leased is None else leased)
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            async with asyncio.timeout(seconds):
+                await self.app(scope, receive, send_wrapper)
+        except TimeoutError:
+            if remaining() > 0:
+                raise
+            route = getattr(scope.get("route"), "path", scope["path"])
+            DEADLINES_EXCEEDED.labels(route).inc()
+            logger.error(f"Deadline of {seconds:.0f}s exceeded on {route}")
+            await release_submissions(leased_submissions.get(), "Deadline exceeded")
+            if not response_started:
+                response = FastJSONResponse(
+                    status_code=504, content={"detail": "Deadline exceeded"}
+                )
+                await response(scope, receive, send)
+        except httpx.TransportError as e:
+            # also CircuitOpenError, whose retry_after is the time until the next probe
+            retry_after = getattr(e, "retry_after", 0.0) or CIRCUIT_OPEN_SECONDS
+            logger.error(f"Target unavailable: {str(e) or type(e).__name__}")
+            await release_submissions(leased_submissions.get(), "Target unavailable")
+            if not response_started:
+                response = FastJSONResponse(
+                    status_code=503,
+                    content={"detail": "Target unavailable"},
+                    headers={"Retry-After": str(math.ceil(retry_after))},
+                )
+                await response(scope, receive, send)
+        finally:
+            leased_submissions.reset(leased_token)
+            deadline.reset(deadline_token)
@@ -0,0 +1,140 @@
+"""Fan-out of a Kobo submission to several targets.
+
+A submission is sent, in-process, to the route of each target (like a
+backfill), with the headers of the target's mapping (see utils.mappings). The
+stages that are the same for every target run once: the body is read and
+validated once, the targets that already processed the submission are looked
+up in one query and skipped, and the attachment URLs and the attachments
+themselves are fetched once and shared by all targets (see ``run_shared``).
+Each target has its own status in the submission store.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Hashable
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from utils import fastjson
+from utils.cosmos import get_submission_ids_with_status, submission_id, submission_target
+from utils.logger import logger
+from utils.mappings import MappingPlan, get_mapping_plan
+
+# routes that store the status of each submission (per target, see
+# ``submission_target``), so that a target is not sent a submission twice
+TARGET_ROUTES = {
+    "espocrm": "/kobo-to-espocrm",
+    "bitrix24": "/kobo-to-bitrix24",
+}
+
+# headers of the fan-out request that are not forwarded to the targets
+FANOUT_HEADERS = {"host", "content-length", "mappingids"}
+
+# results of the shared stages of the submission being fanned out
+shared_stages: ContextVar[dict[Hashable, asyncio.Future] | None] = ContextVar(
+    "shared_stages", default=None
+)
+
+
+async def run_shared(key: Hashable, stage: Callable[[], Awaitable[Any]]) -> Any:
+    """Run a stage once for all targets of a fan-out.
+
+    Outside of a fan-out, the stage is just run. Within one, the first target
+    runs it and the others wait for its result.
+    """
+    stages = shared_stages.get()
+    if stages is None:
+        return await stage()
+    if key not in stages:
+        stages[key] = asyncio.ensure_future(stage())
+    # a target that is cancelled must not cancel the stage for the others
+    return await asyncio.shield(stages[key])
+
+
+async def get_plans(mapping_ids: list[str]) -> list[MappingPlan]:
+    plans = await asyncio.gather(*(get_mapping_plan(i) for i in mapping_ids))
+    for mapping_id, plan in zip(mapping_ids, plans):
+        if plan is None:
+            raise HTTPException(status_code=404, detail=f"Mapping {mapping_id} not found")
+        if plan.target not in TARGET_ROUTES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Target {plan.target} of mapping {mapping_id} does not support fan-out",
+            )
+    return plans
+
+
+async def get_processed_targets(kobo_data: dict[str, Any], plans: list[MappingPlan]) -> set[str]:
+    """Mapping IDs of the targets that already processed the submission."""
+    ids = {submission_id(kobo_data, plan.id): plan.id for plan in plans}
+    try:
+        processed = await get_submission_ids_with_status(list(ids), "success")
+    except HTTPException:
+        # CosmosDB is not configured
+        return set()
+    return {ids[i] for i in processed}
+
+
+async def send_to_target(
+    client: httpx.AsyncClient, plan: MappingPlan, headers: dict[str, str], body: bytes
+) -> dict[str, Any]:
+    submission_target.set(plan.id)
+    response = await client.post(
+        TARGET_ROUTES[plan.target],
+        headers={**headers, "mappingid": plan.id, "mappingversion": str(plan.version)},
+        content=body,
+    )
+    try:
+        detail = fastjson.loads(response.content)
+    except ValueError:
+        detail = response.text
+    return {"status_code": response.status_code, "response": detail}
+
+
+async def fan_out(
+    app: FastAPI,
+    headers: dict[str, str],
+    body: bytes,
+    kobo_data: dict[str, Any],
+    mapping_ids: list[str],
+    logs: dict[str, Any] | None = None,
+) -> dict[str, dict[str, Any]]:
+    """Send a submission to the target of each mapping, concurrently.
+
+    Returns the status code and response of each target, by mapping ID.
+    """
+    plans = await get_plans(mapping_ids)
+    processed = await get_processed_targets(kobo_data, plans)
+    headers = {k: v for k, v in headers.items() if k.lower() not in FANOUT_HEADERS}
+    results = {
+        plan.id: {
+            "target": plan.target,
+            "version": plan.version,
+            "status_code": 200,
+            "response": {"detail": "Submission has already been successfully processed"},
+        }
+        for plan in plans
+        if plan.id in processed
+    }
+    pending = [plan for plan in plans if plan.id not in processed]
+    logger.info(
+        f"Sending submission to {len(pending)} targets, {len(processed)} already processed",
+        extra=logs,
+    )
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    token = shared_stages.set({})
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://kobo-connect", timeout=None
+        ) as client:
+            responses = await asyncio.gather(
+                *(send_to_target(client, plan, headers, body) for plan in pending)
+            )
+    finally:
+        shared_stages.reset(token)
+    for plan, response in zip(pending, responses):
+        results[plan.id] = {"target": plan.target, "version": plan.version, **response}
+    return results
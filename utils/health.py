@@ -0,0 +1,137 @@
+"""Readiness probes of the dependencies of kobo-connect.
+
+The probes run in a background task every HEALTH_CHECK_INTERVAL seconds and
+their results are cached, so that the load balancer probing /ready does not
+cause any outbound traffic. Kobo and CosmosDB (if configured) are required
+for the instance to be ready; the CRMs listed in HEALTH_CHECK_TARGETS
+(``name=url,...``) are reported but do not affect readiness, since one
+unreachable CRM should not take the instance out of rotation for all others.
+The instance is not ready either before its warm-up has finished (see
+``utils.warmup``).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+from clients import http_client
+from clients.retry import NO_RETRY_POLICY
+from utils import cosmos
+from utils.logger import logger
+from utils.utilsKobo import KOBO_API_URL, KOBO_URL
+
+# load environment variables
+load_dotenv()
+
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "30"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "5"))
+
+readiness: dict[str, Any] = {
+    "status": "starting",
+    "warmup": "pending",
+    "checked_at": None,
+    "dependencies": {},
+}
+
+
+def parse_health_check_targets(value: str) -> dict[str, str]:
+    """Parse ``name=url,...`` into {name: url}."""
+    targets = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        name, url = item.split("=", 1)
+        targets[name.strip()] = url.strip()
+    return targets
+
+
+async def probe_url(url: str):
+    """Probe a URL; any response below 500 means the target is reachable."""
+    response = await http_client.get(
+        url, retry_policy=NO_RETRY_POLICY, timeout=HEALTH_CHECK_TIMEOUT
+    )
+    if response.status_code >= 500:
+        raise RuntimeError(f"status {response.status_code}")
+    return response.status_code
+
+
+async def probe_cosmos():
+    """Probe CosmosDB by reading the properties of the submissions container."""
+    await cosmos.get_cosmos_container_client().read()
+    return "ok"
+
+
+async def probe(
+    check: Callable[[], Awaitable[Any]], required: bool
+) -> dict[str, Any]:
+    """Run a probe with a timeout and report its status and latency."""
+    start = time.perf_counter()
+    result = {"required": required}
+    try:
+        detail = await asyncio.wait_for(check(), timeout=HEALTH_CHECK_TIMEOUT)
+        result.update(status="ok", detail=detail)
+    except Exception as e:
+        result.update(status="unavailable", detail=str(e) or type(e).__name__)
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def get_probes() -> dict[str, tuple[Callable[[], Awaitable[Any]], bool]]:
+    """Dependencies to probe: {name: (probe, required for readiness)}."""
+    probes = {urlsplit(KOBO_URL).netloc: (lambda: probe_url(KOBO_API_URL), True)}
+    if os.getenv("COSMOS_URL") and os.getenv("COSMOS_KEY"):
+        probes["cosmosdb"] = (probe_cosmos, True)
+    targets = parse_health_check_targets(os.getenv("HEALTH_CHECK_TARGETS", ""))
+    for name, url in targets.items():
+        probes[name] = (lambda url=url: probe_url(url), False)
+    return probes
+
+
+async def check_dependencies() -> dict[str, Any]:
+    """Probe all dependencies concurrently and update the cached readiness."""
+    probes = get_probes()
+    results = await asyncio.gather(
+        *(probe(check, required) for check, required in probes.values())
+    )
+    dependencies = dict(zip(probes, results))
+    ready = all(
+        result["status"] == "ok"
+        for result in dependencies.values()
+        if result["required"]
+    )
+    status = "ready" if ready else "unavailable"
+    if ready and readiness["warmup"] == "pending":
+        status = "warming up"
+    readiness.update(
+        status=status,
+        checked_at=datetime.now(timezone.utc).isoformat(),
+        dependencies=dependencies,
+    )
+    if not ready:
+        logger.warning(
+            "Readiness check failed",
+            extra={
+                "unavailable": ",".join(
+                    name
+                    for name, result in dependencies.items()
+                    if result["status"] != "ok"
+                )
+            },
+        )
+    return readiness
+
+
+async def run_health_checks(interval: float = HEALTH_CHECK_INTERVAL):
+    """Refresh the cached readiness periodically."""
+    while True:
+        try:
+            await check_dependencies()
+        except Exception as e:
+            logger.error(f"Failed to check dependencies: {e}")
+        await asyncio.sleep(interval)
@@ -1,31 +1,248 @@
+"""Logging setup: structured records exported to Azure Application Insights.
+
+Records are handed to a queue by the request path and formatted and exported
+by a background thread (``QueueListener``), so that logging does not block the
+event loop. Before a record is queued it is only checked against the level
+and the sampling rates and the trace context of the request is attached to
+it. Records with ``%`` arguments are also formatted then, since the caller
+may mutate the arguments afterwards; most messages are f-strings without
+arguments. Messages are redacted and truncated, and exceptions formatted, in
+the background thread.
+
+Configuration:
+- LOG_LEVEL: minimum level of the records (default INFO);
+- LOG_SAMPLE_RATES: fraction of records to keep, per level and optionally per
+  route, e.g. ``INFO=0.1,/kobo-to-espocrm:DEBUG=0.01``. Records of the same
+  Kobo submission are kept or dropped together. Levels not listed are kept;
+- LOG_MAX_MESSAGE_LENGTH: messages are truncated to this length (default 2000);
+- LOG_CONSOLE: also print records to stdout as JSON lines (default false).
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
 import logging
 import os
+import queue
+import random
+import re
+import sys
+import zlib
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
 from dotenv import load_dotenv
+from opentelemetry import context as otel_context
 from opentelemetry._logs import set_logger_provider
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
-from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
 
 # load environment variables
 load_dotenv()
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_MESSAGE_LENGTH = int(os.getenv("LOG_MAX_MESSAGE_LENGTH", "2000"))
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "false").lower() == "true"
+
+# route of the request being processed, used for sampling
+log_route: ContextVar[str | None] = ContextVar("log_route", default=None)
+
+# credentials that may end up in messages (headers, URLs, payloads)
+REDACTED_PATTERNS = [
+    (
+        re.compile(
+            r"(?i)([\"']?(?:[\w-]*token|[\w-]*key|password\w*|authorization|cookie)"
+            r"[\"']?\s*[:=]\s*[\"']?)(?:Token |Bearer )?[^\s\"',;&}]+"
+        ),
+        r"\1[REDACTED]",
+    ),
+    # Bitrix24 webhook URLs contain the webhook key
+    (re.compile(r"(/rest/\d+/)[^/\s]+"), r"\1[REDACTED]"),
+]
+
+
+def parse_sample_rates(value: str) -> dict[tuple[str | None, int], float]:
+    """Parse ``[route:]LEVEL=rate,...`` into {(route, level): rate}."""
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        key, rate = item.split("=", 1)
+        route, _, level = key.strip().rpartition(":")
+        rates[(route or None, logging.getLevelName(level.upper()))] = float(rate)
+    return rates
+
+
+def redact(message: str) -> str:
+    """Mask credentials in a message."""
+    for pattern, replacement in REDACTED_PATTERNS:
+        message = pattern.sub(replacement, message)
+    return message
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records, per route and level.
+
+    Records carrying a ``kobo_submission_id`` are sampled by hashing the id,
+    so that all records of a sampled submission are kept.
+    """
+
+    def __init__(self, rates: dict[tuple[str | None, int], float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rates:
+            return True
+        rate = self.rates.get((log_route.get(), record.levelno))
+        if rate is None:
+            rate = self.rates.get((None, record.levelno))
+        if rate is None or rate >= 1:
+            return True
+        submission_id = getattr(record, "kobo_submission_id", None)
+        if submission_id is not None:
+            return zlib.crc32(str(submission_id).encode()) % 10000 < rate * 10000
+        return random.random() < rate
+
+
+class RedactionFilter(logging.Filter):
+    """Format the message, mask credentials and cap its size.
+
+    Runs in the listener thread, so the cost of formatting large payloads is
+    not paid by the request path.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "redacted", False):
+            return True
+        message = redact(record.getMessage())
+        if len(message) > LOG_MAX_MESSAGE_LENGTH:
+            message = (
+                f"{message[:LOG_MAX_MESSAGE_LENGTH]}... "
+                f"[truncated {len(message) - LOG_MAX_MESSAGE_LENGTH} characters]"
+            )
+        record.msg, record.args, record.redacted = message, None, True
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler that leaves most of the formatting to the listener thread.
+
+    The default ``prepare`` formats the message and the exception of every
+    record before queuing it; records are only used within this process, so
+    only what may change before the listener gets to them is captured on the
+    request path: the current trace context (which the listener thread does
+    not have) and, for records with ``%`` arguments, the message, formatted
+    here because a copy of the arguments would still share the objects that
+    the caller may mutate.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            record.msg, record.args = record.getMessage(), None
+        record.otel_context = otel_context.get_current()
+        return record
+
+
+class ContextLoggingHandler(LoggingHandler):
+    """OpenTelemetry handler exporting records with the trace context they were logged in.
+
+    Records are exported from the listener thread, so that trace_id and span_id
+    are taken from the context captured by ``LazyQueueHandler`` instead.
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        context = record.__dict__.pop("otel_context", None)
+        if context is None:
+            super().emit(record)
+            return
+        token = otel_context.attach(context)
+        try:
+            super().emit(record)
+        finally:
+            otel_context.detach(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines, including the ``extra`` fields."""
+
+    reserved = set(vars(logging.makeLogRecord({}))) | {
+        "message",
+        "asctime",
+        "redacted",
+        "otel_context",
+    }
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in self.reserved
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogContextMiddleware:
+    """ASGI middleware recording the route of the request for sampling."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = log_route.set(scope["path"])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            log_route.reset(token)
+
+
 # Set up logs export to Azure Application Insights
 logger_provider = LoggerProvider()
 set_logger_provider(logger_provider)
 connection_string = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING", "").strip()
 if connection_string:
+    # imported only when used, it takes a large share of the startup time
+    from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
+
     exporter = AzureMonitorLogExporter(
         connection_string=connection_string
     )
     logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
 
-# Attach LoggingHandler to root logger
-handler = LoggingHandler()
-logging.getLogger().addHandler(handler)
-logging.getLogger().setLevel(logging.NOTSET)
+# Export from a background thread, fed by a queue handler on the root logger
+handlers = [ContextLoggingHandler()]
+if LOG_CONSOLE:
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(JsonFormatter())
+    handlers.append(console_handler)
+for handler in handlers:
+    handler.addFilter(RedactionFilter())
+log_queue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(SamplingFilter(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))))
+listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+logging.getLogger().addHandler(queue_handler)
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 # Silence noisy loggers
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("azure").setLevel(logging.WARNING)
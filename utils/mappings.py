@@ -0,0 +1,328 @@
+"""Registry of field mappings, stored in SQLite.
+
+A mapping holds the headers that a Kobo REST service would otherwise send
+with every submission (``targeturl``, field mappings, ...), for one Kobo
+asset and target. Every update creates a new version. A REST service then
+only sends the header ``mappingid`` (and optionally ``mappingversion``), and
+``MappingMiddleware`` adds the stored headers to the request, so that the
+routes work as with custom headers. Headers sent by the REST service take
+precedence, so credentials such as ``targetkey`` can stay in Kobo.
+
+Versions never change once stored: they are compiled once per process into a
+``MappingPlan`` with the headers already encoded. The latest version of a
+mapping is cached for MAPPING_CACHE_SECONDS, after which other instances see
+updates.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import uuid
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, NamedTuple
+
+from dotenv import load_dotenv
+from utils import fastjson
+from utils.fastjson import FastJSONResponse
+from utils.cache import TTLCache
+
+# load environment variables
+load_dotenv()
+
+MAPPINGS_DB = os.getenv("MAPPINGS_DB", "mappings.db")
+
+# routes of submissions, the only ones to which mappings apply
+MAPPED_PATHS = ("/kobo-to-", "/kobo-update-")
+# headers that identify the request, never taken from a mapping
+RESERVED_HEADERS = {"host", "content-length", "content-type", "mappingid", "mappingversion"}
+# credentials, never returned by the API
+SECRET_HEADERS = {"authorization", "kobotoken", "password121", "profilingkey", "targetkey"}
+REDACTED = "********"
+
+latest_versions = TTLCache(
+    "mapping_version", ttl=float(os.getenv("MAPPING_CACHE_SECONDS", "30"))
+)
+
+
+class MappingPlan(NamedTuple):
+    """A mapping version, compiled for use on every request."""
+
+    id: str
+    version: int
+    target: str
+    headers: tuple[tuple[bytes, bytes], ...]
+
+
+def redact_mapping(mapping: dict[str, Any]) -> dict[str, Any]:
+    """Copy of a mapping with the values of its secret headers hidden."""
+    headers = {
+        name: REDACTED if name in SECRET_HEADERS else value
+        for name, value in mapping["headers"].items()
+    }
+    return {**mapping, "headers": headers}
+
+
+def connect() -> sqlite3.Connection:
+    connection = sqlite3.connect(MAPPINGS_DB)
+    connection.row_factory = sqlite3.Row
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS mappings (
+            id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            koboasset TEXT NOT NULL,
+            target TEXT NOT NULL,
+            headers TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (id, version)
+        )
+        """
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS mappings_koboasset ON mappings (koboasset)"
+    )
+    return connection
+
+
+def row_to_mapping(row: sqlite3.Row) -> dict[str, Any]:
+    return {
+        "id": row["id"],
+        "version": row["version"],
+        "koboasset": row["koboasset"],
+        "target": row["target"],
+        "headers": fastjson.loads(row["headers"]),
+        "created_at": row["created_at"],
+    }
+
+
+def validate_headers(headers: dict[str, Any]) -> dict[str, str]:
+    """Check that the headers of a mapping are valid HTTP headers."""
+    if not isinstance(headers, dict) or not headers:
+        raise ValueError("headers must be a non-empty object")
+    valid = {}
+    for name, value in headers.items():
+        name = name.strip().lower()
+        if not name or not name.isascii() or any(c in name for c in " :\r\n"):
+            raise ValueError(f"Invalid header name: {name!r}")
+        if name in RESERVED_HEADERS:
+            raise ValueError(f"Header {name!r} cannot be part of a mapping")
+        if not isinstance(value, str) or "\r" in value or "\n" in value:
+            raise ValueError(f"Invalid value of header {name!r}")
+        valid[name] = value
+    return valid
+
+
+def insert_version(
+    connection: sqlite3.Connection,
+    mapping_id: str,
+    version: int,
+    koboasset: str,
+    target: str,
+    headers: dict[str, str],
+) -> dict[str, Any]:
+    created_at = datetime.now(timezone.utc).isoformat()
+    connection.execute(
+        "INSERT INTO mappings VALUES (?, ?, ?, ?, ?, ?)",
+        (mapping_id, version, koboasset, target, fastjson.dumps(headers).decode(), created_at),
+    )
+    return {
+        "id": mapping_id,
+        "version": version,
+        "koboasset": koboasset,
+        "target": target,
+        "headers": headers,
+        "created_at": created_at,
+    }
+
+
+def create_mapping_sync(koboasset: str, target: str, headers: dict[str, Any]) -> dict[str, Any]:
+    headers = validate_headers(headers)
+    with connect() as connection:
+        return insert_version(connection, uuid.uuid4().hex, 1, koboasset, target, headers)
+
+
+def update_mapping_sync(
+    mapping_id: str, koboasset: str, headers: dict[str, Any]
+) -> dict[str, Any] | None:
+    headers = validate_headers(headers)
+    with connect() as connection:
+        row = connection.execute(
+            "SELECT * FROM mappings WHERE id = ? AND koboasset = ? "
+            "ORDER BY version DESC LIMIT 1",
+            (mapping_id, koboasset),
+        ).fetchone()
+        if row is None:
+            return None
+        # secrets sent back redacted keep their stored value
+        previous = fastjson.loads(row["headers"])
+        for name in SECRET_HEADERS & headers.keys():
+            if headers[name] == REDACTED:
+                if name in previous:
+                    headers[name] = previous[name]
+                else:
+                    del headers[name]
+        mapping = insert_version(
+            connection, mapping_id, row["version"] + 1, koboasset, row["target"], headers
+        )
+    latest_versions.pop(mapping_id, None)
+    return mapping
+
+
+def get_mapping_sync(mapping_id: str, version: int | None = None) -> dict[str, Any] | None:
+    with connect() as connection:
+        if version is None:
+            row = connection.execute(
+                "SELECT * FROM mappings WHERE id = ? ORDER BY version DESC LIMIT 1",
+                (mapping_id,),
+            ).fetchone()
+        else:
+            row = connection.execute(
+                "SELECT * FROM mappings WHERE id = ? AND version = ?",
+                (mapping_id, version),
+            ).fetchone()
+    return row_to_mapping(row) if row is not None else None
+
+
+def list_mappings_sync(koboasset: str) -> list[dict[str, Any]]:
+    """Latest version of every mapping of a Kobo asset."""
+    with connect() as connection:
+        rows = connection.execute(
+            """
+            SELECT * FROM mappings AS m WHERE koboasset = ? AND version = (
+                SELECT MAX(version) FROM mappings WHERE id = m.id
+            ) ORDER BY created_at
+            """,
+            (koboasset,),
+        ).fetchall()
+    return [row_to_mapping(row) for row in rows]
+
+
+def list_all_mappings_sync() -> list[dict[str, Any]]:
+    """Latest version of every mapping."""
+    with connect() as connection:
+        rows = connection.execute(
+            """
+            SELECT * FROM mappings AS m WHERE version = (
+                SELECT MAX(version) FROM mappings WHERE id = m.id
+            ) ORDER BY created_at
+            """
+        ).fetchall()
+    return [row_to_mapping(row) for row in rows]
+
+
+def delete_mapping_sync(mapping_id: str, koboasset: str) -> bool:
+    with connect() as connection:
+        deleted = connection.execute(
+            "DELETE FROM mappings WHERE id = ? AND koboasset = ?", (mapping_id, koboasset)
+        ).rowcount
+    latest_versions.pop(mapping_id, None)
+    return deleted > 0
+
+
+async def create_mapping(koboasset: str, target: str, headers: dict[str, Any]):
+    return await asyncio.to_thread(create_mapping_sync, koboasset, target, headers)
+
+
+async def update_mapping(mapping_id: str, koboasset: str, headers: dict[str, Any]):
+    return await asyncio.to_thread(update_mapping_sync, mapping_id, koboasset, headers)
+
+
+async def get_mapping(mapping_id: str, version: int | None = None):
+    return await asyncio.to_thread(get_mapping_sync, mapping_id, version)
+
+
+async def list_mappings(koboasset: str):
+    return await asyncio.to_thread(list_mappings_sync, koboasset)
+
+
+async def delete_mapping(mapping_id: str, koboasset: str):
+    return await asyncio.to_thread(delete_mapping_sync, mapping_id, koboasset)
+
+
+@lru_cache(maxsize=1024)
+def compile_mapping(
+    mapping_id: str, version: int, target: str, headers_json: str
+) -> MappingPlan:
+    """Compile a mapping version; versions are immutable, so this is done once."""
+    headers = fastjson.loads(headers_json)
+    return MappingPlan(
+        id=mapping_id,
+        version=version,
+        target=target,
+        headers=tuple((name.encode(), value.encode()) for name, value in headers.items()),
+    )
+
+
+def compile_plan(mapping: dict[str, Any]) -> MappingPlan:
+    return compile_mapping(
+        mapping["id"],
+        mapping["version"],
+        mapping["target"],
+        fastjson.dumps(mapping["headers"]).decode(),
+    )
+
+
+async def get_mapping_plan(mapping_id: str, version: int | None = None) -> MappingPlan | None:
+    """Get the compiled plan of a mapping version (by default the latest)."""
+    if version is None:
+        plan = latest_versions.get(mapping_id)
+        if plan is not None:
+            return plan
+    mapping = await get_mapping(mapping_id, version)
+    if mapping is None:
+        return None
+    plan = compile_plan(mapping)
+    if version is None:
+        latest_versions.set(mapping_id, plan)
+    return plan
+
+
+async def preload_mapping_plans() -> list[dict[str, Any]]:
+    """Compile and cache the latest version of every mapping, and return them."""
+    mappings = await asyncio.to_thread(list_all_mappings_sync)
+    for mapping in mappings:
+        latest_versions.set(mapping["id"], compile_plan(mapping))
+    return mappings
+
+
+class MappingMiddleware:
+    """ASGI middleware adding the headers of the mapping in ``mappingid``.
+
+    Only applies to submission routes: the stored headers include credentials,
+    which must never authorize other requests (e.g. to the mappings API).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(MAPPED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        request_headers = dict(scope["headers"])
+        mapping_id = request_headers.get(b"mappingid")
+        if mapping_id is None:
+            await self.app(scope, receive, send)
+            return
+
+        version = request_headers.get(b"mappingversion", b"").decode()
+        plan = None
+        if not version or version.isdigit():
+            plan = await get_mapping_plan(
+                mapping_id.decode(), int(version) if version else None
+            )
+        if plan is None:
+            response = FastJSONResponse(status_code=404, content={"detail": "Mapping not found"})
+            await response(scope, receive, send)
+            return
+
+        # headers sent with the request take precedence over the mapping; the
+        # scope is updated in place, so that outer middlewares see its route
+        headers = list(scope["headers"])
+        headers.extend(header for header in plan.headers if header[0] not in request_headers)
+        scope["headers"] = headers
+        scope.setdefault("state", {})["mapping"] = plan
+        await self.app(scope, receive, send)
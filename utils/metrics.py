@@ -0,0 +1,223 @@
+"""Prometheus metrics, exposed on /metrics for capacity planning and autoscaling.
+
+- request counts and latencies per route (``MetricsMiddleware``);
+- latencies and errors of downstream calls per target host and entity, and
+  the seconds lost in calls that timed out;
+- submissions cancelled at their deadline, per route;
+- queued and in-flight downstream calls per host, read from the rate limiters,
+  and the state of their circuits;
+- submissions rejected because the circuit of their target is open;
+- queued, in-flight and rejected submissions per tenant, read from the
+  scheduler;
+- hits and misses of the caches (121 login tokens, related-entity lookups);
+- bytes of attachments downloaded from Kobo;
+- sizes of the batches flushed by the write buffers.
+
+With several worker processes, metrics are written to PROMETHEUS_MULTIPROC_DIR
+and aggregated across workers when scraped (see ``generate_metrics``); the
+rate limiters, circuits and tenant queues are those of the worker answering
+the scrape.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from clients.circuit_breaker import breakers
+from clients.rate_limiter import limiters
+from utils.scheduler import scheduler
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+REQUESTS = Counter(
+    "kobo_connect_requests_total",
+    "Requests received, per route and status code.",
+    ["method", "route", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "kobo_connect_request_duration_seconds",
+    "Time to process a request, per route.",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "kobo_connect_requests_in_flight",
+    "Requests being processed.",
+    multiprocess_mode="livesum",
+)
+DOWNSTREAM_LATENCY = Histogram(
+    "kobo_connect_downstream_duration_seconds",
+    "Time of a single call to a target, per host and entity.",
+    ["host", "entity"],
+    buckets=LATENCY_BUCKETS,
+)
+DOWNSTREAM_ERRORS = Counter(
+    "kobo_connect_downstream_errors_total",
+    "Failed calls to a target (error status or transport error), per host and entity.",
+    ["host", "entity", "error"],
+)
+DOWNSTREAM_TIMEOUT_SECONDS = Counter(
+    "kobo_connect_downstream_timeout_seconds",
+    "Seconds spent in calls to a target that timed out or hit the deadline, per host.",
+    ["host"],
+)
+CIRCUIT_REJECTIONS = Counter(
+    "kobo_connect_circuit_rejections",
+    "Submissions rejected because the circuit of their target is open, per host.",
+    ["host"],
+)
+DEADLINES_EXCEEDED = Counter(
+    "kobo_connect_deadlines_exceeded",
+    "Submissions cancelled at their deadline, per route.",
+    ["route"],
+)
+CACHE_REQUESTS = Counter(
+    "kobo_connect_cache_requests_total",
+    "Cache lookups, per cache and result (hit or miss).",
+    ["cache", "result"],
+)
+ATTACHMENT_BYTES = Counter(
+    "kobo_connect_attachment_bytes_total",
+    "Bytes of attachments downloaded from Kobo.",
+)
+WRITE_BATCH_SIZE = Histogram(
+    "kobo_connect_write_batch_size",
+    "Writes per batch flushed by a write buffer.",
+    ["buffer"],
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+
+
+def record_cache(cache: str, hit: bool):
+    """Count a hit or miss of a cache."""
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class RateLimiterCollector:
+    """Report the queues of the per-host rate limiters and circuits at scrape time."""
+
+    def collect(self):
+        queued = GaugeMetricFamily(
+            "kobo_connect_downstream_queued",
+            "Calls waiting for a concurrency slot, per host.",
+            labels=["host"],
+        )
+        in_flight = GaugeMetricFamily(
+            "kobo_connect_downstream_in_flight",
+            "Calls in flight, per host.",
+            labels=["host"],
+        )
+        concurrency = GaugeMetricFamily(
+            "kobo_connect_downstream_concurrency_limit",
+            "Current adaptive concurrency limit, per host.",
+            labels=["host"],
+        )
+        circuit = GaugeMetricFamily(
+            "kobo_connect_circuit_open",
+            "Whether the circuit of a host is open (1), half-open (0.5) or closed (0).",
+            labels=["host"],
+        )
+        for host, limiter in list(limiters.items()):
+            queued.add_metric([host], limiter.queued)
+            in_flight.add_metric([host], limiter.in_flight)
+            concurrency.add_metric([host], limiter.concurrency)
+        for host, breaker in list(breakers.items()):
+            circuit.add_metric([host], {"open": 1, "half-open": 0.5}.get(breaker.state, 0))
+        yield queued
+        yield in_flight
+        yield concurrency
+        yield circuit
+
+
+REGISTRY.register(RateLimiterCollector())
+
+
+class SchedulerCollector:
+    """Report the queues of the tenants of the scheduler at scrape time."""
+
+    def collect(self):
+        queued = GaugeMetricFamily(
+            "kobo_connect_tenant_queued",
+            "Submissions waiting for a slot, per tenant.",
+            labels=["tenant"],
+        )
+        in_flight = GaugeMetricFamily(
+            "kobo_connect_tenant_in_flight",
+            "Submissions being processed, per tenant.",
+            labels=["tenant"],
+        )
+        rejected = CounterMetricFamily(
+            "kobo_connect_tenant_rejected",
+            "Submissions rejected because the queue of their tenant was full.",
+            labels=["tenant"],
+        )
+        for name, tenant in list(scheduler.tenants.items()):
+            queued.add_metric([name], len(tenant.waiters))
+            in_flight.add_metric([name], tenant.in_flight)
+            rejected.add_metric([name], tenant.rejected)
+        yield queued
+        yield in_flight
+        yield rejected
+
+
+REGISTRY.register(SchedulerCollector())
+
+
+def generate_metrics() -> bytes:
+    """Metrics in the Prometheus text format, of all workers if there are several."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(RateLimiterCollector())
+    registry.register(SchedulerCollector())
+    return generate_latest(registry)
+
+
+def mark_worker_stopped():
+    """Drop the live gauges of this worker from the aggregated metrics."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and measuring their latency per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # use the route template, not the path, to bound the number of series
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUEST_LATENCY.labels(method, route).observe(time.perf_counter() - start)
+            REQUESTS.labels(method, route, str(status_code)).inc()
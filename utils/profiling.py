@@ -0,0 +1,201 @@
+"""On-demand profiling of requests and of the running process.
+
+Profiling is disabled unless PROFILING_KEY is set, and every profiling request
+must send the key in the ``profilingkey`` header.
+
+- Per request: add ``profile=true`` to the query string (or send the header
+  ``profile: true``) to run the request under cProfile and tracemalloc. The
+  report is stored in PROFILE_DIR and its id returned in ``X-Profile-Id``.
+  cProfile records the whole event loop thread, so requests running
+  concurrently on the same instance also appear in the profile; only one
+  request is profiled at a time.
+- Process-wide: ``sample_stacks`` records the stacks of all threads every
+  ``interval`` seconds, in the folded format read by flame graph tools.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from dotenv import load_dotenv
+from fastapi.responses import JSONResponse
+from utils.logger import logger
+
+# load environment variables
+load_dotenv()
+
+PROFILING_KEY = os.getenv("PROFILING_KEY", "")
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_TOP = 40
+
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+profile_lock = asyncio.Lock()
+
+
+def is_authorized(key: str | None) -> bool:
+    """Check a profiling key; always False if profiling is disabled."""
+    return bool(PROFILING_KEY) and key is not None and hmac.compare_digest(
+        key.encode(), PROFILING_KEY.encode()
+    )
+
+
+def profile_path(profile_id: str, suffix: str) -> Path | None:
+    """Path of a stored profile, or None if the id is not valid."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    return PROFILE_DIR / f"{profile_id}{suffix}"
+
+
+def write_profile(profile_id: str, report: str, profiler: cProfile.Profile | None):
+    """Store a report (and the raw cProfile stats) and remove the oldest ones."""
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    (PROFILE_DIR / f"{profile_id}.txt").write_text(report)
+    if profiler is not None:
+        profiler.dump_stats(PROFILE_DIR / f"{profile_id}.prof")
+    reports = sorted(PROFILE_DIR.glob("*.txt"), key=lambda path: path.stat().st_mtime)
+    for old in reports[:-PROFILE_MAX_FILES]:
+        old.unlink(missing_ok=True)
+        old.with_suffix(".prof").unlink(missing_ok=True)
+
+
+def format_report(
+    title: str,
+    duration: float,
+    profiler: cProfile.Profile,
+    snapshot: tracemalloc.Snapshot,
+    peak_memory: int,
+) -> str:
+    """Summarize the CPU and allocation profile of a request as text."""
+    report = io.StringIO()
+    report.write(f"{title}\nduration: {duration * 1000:.1f} ms\n")
+    report.write(f"peak traced memory: {peak_memory / 2**20:.2f} MB\n\n")
+    report.write(f"Top {PROFILE_TOP} functions by cumulative time\n")
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    report.write(f"Top {PROFILE_TOP} lines by memory allocated and not released\n")
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+        report.write(f"{stat}\n")
+    return report.getvalue()
+
+
+def is_profile_requested(scope) -> bool:
+    query = parse_qs(scope.get("query_string", b"").decode())
+    header = dict(scope["headers"]).get(b"profile", b"").decode()
+    return "true" in (query.get("profile", [""])[0].lower(), header.lower())
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests that ask for it."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILING_KEY or not is_profile_requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        key = dict(scope["headers"]).get(b"profilingkey", b"").decode()
+        if not is_authorized(key):
+            response = JSONResponse(status_code=403, content={"detail": "Invalid profiling key"})
+            await response(scope, receive, send)
+            return
+        if profile_lock.locked():
+            response = JSONResponse(
+                status_code=409, content={"detail": "Another request is being profiled"}
+            )
+            await response(scope, receive, send)
+            return
+
+        async with profile_lock:
+            profile_id = uuid.uuid4().hex
+
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"x-profile-id", profile_id.encode()),
+                    ]
+                await send(message)
+
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                profiler.disable()
+                duration = time.perf_counter() - start
+                snapshot = tracemalloc.take_snapshot()
+                _, peak_memory = tracemalloc.get_traced_memory()
+                if started_tracemalloc:
+                    tracemalloc.stop()
+                report = format_report(
+                    f"{scope['method']} {scope['path']}",
+                    duration,
+                    profiler,
+                    snapshot,
+                    peak_memory,
+                )
+                try:
+                    await asyncio.to_thread(write_profile, profile_id, report, profiler)
+                    logger.info(
+                        f"Stored profile {profile_id} of {scope['path']}",
+                        extra={"profile_id": profile_id},
+                    )
+                except OSError as e:
+                    logger.error(f"Failed to store profile {profile_id}: {e}")
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.01) -> Counter:
+    """Sample the stacks of all other threads for ``seconds`` seconds.
+
+    Returns the number of samples per stack, as ``thread;outer;...;inner``.
+    Blocking: run it in a separate thread.
+    """
+    own_thread = threading.get_ident()
+    samples: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def format_folded(samples: Counter) -> str:
+    """Format stack samples as folded stacks (``stack count`` per line)."""
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
@@ -0,0 +1,212 @@
+"""Fair scheduling of submissions between tenants.
+
+A tenant is a Kobo form (the ``koboasset`` or ``parentasset`` header) or,
+without one, the host of the target (``targeturl`` or ``url121``). Each
+worker processes at most SCHEDULER_MAX_CONCURRENCY submissions at a time,
+and each tenant at most SCHEDULER_TENANT_MAX_CONCURRENCY of them, so that a
+large form cannot take all the capacity. Submissions beyond these limits wait
+in a queue per tenant, and free slots go to the queues by weighted fair
+queueing: a tenant with weight 2 gets twice the slots of a tenant with
+weight 1 while both are waiting.
+
+Weights and limits can be set per tenant with the ``SCHEDULER_TENANTS``
+environment variable, e.g. ``SCHEDULER_TENANTS=aXk2ghF3=4/16,bulk.example.org=0.5``
+(weight, optionally followed by the maximum concurrency). A tenant with
+SCHEDULER_TENANT_MAX_QUEUE submissions waiting rejects new ones with 503,
+which Kobo retries later.
+
+Requests made while processing a submission (e.g. by ``/kobo-to-many``) use
+the slot of that submission.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+from utils.fastjson import FastJSONResponse
+from utils.logger import logger
+
+# load environment variables
+load_dotenv()
+
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "64"))
+SCHEDULER_TENANT_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_TENANT_MAX_CONCURRENCY", "16"))
+SCHEDULER_TENANT_MAX_QUEUE = int(os.getenv("SCHEDULER_TENANT_MAX_QUEUE", "200"))
+SCHEDULER_RETRY_AFTER = int(os.getenv("SCHEDULER_RETRY_AFTER", "30"))
+SCHEDULED_PATHS = ("/kobo-to-", "/kobo-update-", "/update-kobo-csv")
+ASSET_HEADERS = (b"koboasset", b"parentasset")
+TARGET_HEADERS = (b"targeturl", b"url121")
+
+# whether the current request already holds a slot
+scheduled: ContextVar[bool] = ContextVar("scheduled", default=False)
+
+
+def parse_tenants(value: str) -> dict[str, tuple[float, int | None]]:
+    """Parse ``tenant=weight[/max_concurrency],...`` into {tenant: (weight, max)}.
+
+    Raises ValueError unless weights and maximums are positive.
+    """
+    tenants = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        tenant, config = item.split("=", 1)
+        weight, _, max_concurrency = config.partition("/")
+        weight = float(weight)
+        max_concurrency = int(max_concurrency) if max_concurrency else None
+        if not (math.isfinite(weight) and weight > 0):
+            raise ValueError(f"SCHEDULER_TENANTS: weight of {tenant.strip()} must be positive")
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError(
+                f"SCHEDULER_TENANTS: max concurrency of {tenant.strip()} must be positive"
+            )
+        tenants[tenant.strip()] = (weight, max_concurrency)
+    return tenants
+
+
+def get_tenant(headers: list[tuple[bytes, bytes]]) -> str:
+    """Tenant of a request: its Kobo form, or the host of its target."""
+    headers = dict(headers)
+    for name in ASSET_HEADERS:
+        if headers.get(name):
+            return headers[name].decode("latin-1").strip()
+    for name in TARGET_HEADERS:
+        if headers.get(name):
+            return urlsplit(headers[name].decode("latin-1").strip()).netloc.lower()
+    return "default"
+
+
+class QueueFullError(Exception):
+    """Too many submissions of the tenant are waiting."""
+
+
+class Tenant:
+    """Queue and in-flight submissions of a tenant."""
+
+    def __init__(self, name: str, weight: float, max_concurrency: int):
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.waiters: deque[asyncio.Future] = deque()
+        self.in_flight = 0
+        self.rejected = 0
+        # virtual time at which the slots given to the tenant are paid for
+        self.finish = 0.0
+
+
+class FairScheduler:
+    """Weighted fair queueing of submissions, with concurrency caps per tenant."""
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        tenant_max_concurrency: int = SCHEDULER_TENANT_MAX_CONCURRENCY,
+        max_queue: int = SCHEDULER_TENANT_MAX_QUEUE,
+        tenants: dict[str, tuple[float, int | None]] | None = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.max_queue = max_queue
+        self.configured = tenants or {}
+        self.tenants: dict[str, Tenant] = {}
+        self.in_flight = 0
+        self.virtual_time = 0.0
+
+    def get_tenant(self, name: str) -> Tenant:
+        if name not in self.tenants:
+            weight, max_concurrency = self.configured.get(name, (1.0, None))
+            self.tenants[name] = Tenant(
+                name, weight, max_concurrency or self.tenant_max_concurrency
+            )
+        return self.tenants[name]
+
+    def dispatch(self):
+        """Give free slots to the waiting tenants that have received the least."""
+        while self.in_flight < self.max_concurrency:
+            eligible = [
+                tenant
+                for tenant in self.tenants.values()
+                if tenant.waiters and tenant.in_flight < tenant.max_concurrency
+            ]
+            if not eligible:
+                return
+            tenant = min(eligible, key=lambda t: t.finish)
+            self.virtual_time = tenant.finish
+            tenant.finish += 1 / tenant.weight
+            tenant.in_flight += 1
+            self.in_flight += 1
+            tenant.waiters.popleft().set_result(None)
+
+    def release(self, tenant: Tenant):
+        tenant.in_flight -= 1
+        self.in_flight -= 1
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, name: str):
+        """Wait for a slot of the tenant; raises QueueFullError if its queue is full."""
+        tenant = self.get_tenant(name)
+        if not tenant.waiters:
+            # a tenant that was idle starts at the current virtual time, without credit
+            tenant.finish = max(tenant.finish, self.virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        tenant.waiters.append(waiter)
+        self.dispatch()
+        if not waiter.done() and len(tenant.waiters) > self.max_queue:
+            tenant.waiters.remove(waiter)
+            tenant.rejected += 1
+            raise QueueFullError(name)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was given just before the cancellation
+                self.release(tenant)
+            else:
+                tenant.waiters.remove(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+
+scheduler = FairScheduler(tenants=parse_tenants(os.getenv("SCHEDULER_TENANTS", "")))
+
+
+class SchedulerMiddleware:
+    """ASGI middleware processing submissions in the slots of their tenant."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith(SCHEDULED_PATHS)
+            or scheduled.get()
+        ):
+            await self.app(scope, receive, send)
+            return
+        tenant = get_tenant(scope["headers"])
+        token = scheduled.set(True)
+        try:
+            async with scheduler.slot(tenant):
+                await self.app(scope, receive, send)
+        except QueueFullError:
+            logger.warning(f"Rejecting submission of {tenant}: queue full")
+            response = FastJSONResponse(
+                status_code=503,
+                content={"detail": f"Too many submissions queued for {tenant}"},
+                headers={"Retry-After": str(SCHEDULER_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+        finally:
+            scheduled.reset(token)
@@ -0,0 +1,103 @@
+"""Production server: uvicorn with one worker process per core.
+
+Settings, from environment variables:
+- WEB_CONCURRENCY: worker processes (default: one per available core);
+- SERVER_KEEP_ALIVE_SECONDS: how long idle connections are kept open, longer
+  than the idle timeout of the load balancer in front of the app, so that a
+  burst of webhooks reuses its connections;
+- SERVER_BACKLOG: connections waiting to be accepted during a burst (also
+  capped by the ``net.core.somaxconn`` of the host);
+- SERVER_GRACEFUL_SHUTDOWN_SECONDS: on SIGTERM, workers stop accepting
+  connections and wait this long for in-flight submissions to finish (by
+  default the submission deadline, after which they are cancelled anyway);
+- SERVER_ACCESS_LOG: log every request (``false`` saves CPU under load, the
+  requests are still counted in the metrics);
+- RELOAD: restart on code changes, with a single worker (development only).
+
+uvloop and httptools are used when installed (not on Windows).
+
+With several workers, the per-host rate limits are split among them and the
+Prometheus metrics are aggregated across workers through
+PROMETHEUS_MULTIPROC_DIR (see ``utils.metrics``).
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import shutil
+import tempfile
+
+import uvicorn
+from dotenv import load_dotenv
+
+# load environment variables
+load_dotenv()
+
+SERVER_KEEP_ALIVE_SECONDS = int(os.getenv("SERVER_KEEP_ALIVE_SECONDS", "75"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "4096"))
+SERVER_GRACEFUL_SHUTDOWN_SECONDS = os.getenv("SERVER_GRACEFUL_SHUTDOWN_SECONDS")
+SERVER_ACCESS_LOG = os.getenv("SERVER_ACCESS_LOG", "true").lower() == "true"
+RELOAD = os.getenv("RELOAD", "false").lower() == "true"
+
+
+def available_cores() -> int:
+    """Cores this process may run on, e.g. as limited by the container."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def graceful_shutdown_seconds() -> int:
+    """Seconds to wait for in-flight requests on shutdown."""
+    if SERVER_GRACEFUL_SHUTDOWN_SECONDS:
+        return int(SERVER_GRACEFUL_SHUTDOWN_SECONDS)
+    # read like utils.deadline, without importing the app in the supervisor
+    return math.ceil(float(os.getenv("SUBMISSION_DEADLINE_SECONDS", "240")))
+
+
+def prepare_multiprocess_metrics() -> str | None:
+    """Create an empty PROMETHEUS_MULTIPROC_DIR shared by the workers.
+
+    Returns the directory if it was created in a temporary location.
+    """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        directory = tempfile.mkdtemp(prefix="kobo-connect-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+        return directory
+    # metrics of a previous run would be added to the new ones
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    return None
+
+
+def run_server(app: str = "main:app", port: int = 8000, workers: int | None = None):
+    """Run the app until it receives SIGINT or SIGTERM."""
+    if RELOAD:
+        uvicorn.run(app, host="0.0.0.0", port=port, reload=True)
+        return
+    if workers is None:
+        workers = int(os.getenv("WEB_CONCURRENCY") or available_cores())
+    # read by the workers, which are started as new processes
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    temporary_directory = None
+    if workers > 1:
+        temporary_directory = prepare_multiprocess_metrics()
+    try:
+        uvicorn.run(
+            app,
+            host="0.0.0.0",
+            port=port,
+            workers=workers,
+            loop="auto",
+            http="auto",
+            backlog=SERVER_BACKLOG,
+            timeout_keep_alive=SERVER_KEEP_ALIVE_SECONDS,
+            timeout_graceful_shutdown=graceful_shutdown_seconds(),
+            server_header=False,
+            access_log=SERVER_ACCESS_LOG,
+        )
+    finally:
+        if temporary_directory:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
@@ -0,0 +1,135 @@
+"""OpenTelemetry tracing of routes and of the stages of processing a submission.
+
+FastAPI creates a server span for every request once a tracer provider is
+set. On top of that every downstream call gets a client span, and the stages
+of processing a submission (Cosmos DB, attachments, related-entity lookups,
+writes to the target) a span each. Spans carry the
+submission, form and target attributes set with ``set_submission_attributes``.
+
+The exporter is chosen with ``TRACING_EXPORTER``:
+- ``azure``: Azure Application Insights (default if
+  ``APPLICATIONINSIGHTS_CONNECTION_STRING`` is set);
+- ``console``: print spans to stdout;
+- ``file``: append spans as JSON lines to ``TRACING_FILE``;
+- ``none``: do not export spans (default otherwise).
+"""
+
+from __future__ import annotations
+
+import functools
+import os
+import threading
+from contextvars import ContextVar
+from typing import Any, Sequence
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SpanExporter,
+    SpanExportResult,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+# load environment variables
+load_dotenv()
+
+connection_string = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING", "").strip()
+TRACING_EXPORTER = (
+    os.getenv("TRACING_EXPORTER", "azure" if connection_string else "none")
+    .strip()
+    .lower()
+)
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+TRACING_SAMPLE_RATIO = float(os.getenv("TRACING_SAMPLE_RATIO", "1.0"))
+
+span_attributes: ContextVar[dict[str, str]] = ContextVar("span_attributes", default={})
+
+
+class FileSpanExporter(SpanExporter):
+    """Append spans as JSON lines to a local file, to inspect traces without Azure."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        with self.lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def get_span_exporter(name: str) -> SpanExporter | None:
+    """Create the span exporter configured with TRACING_EXPORTER."""
+    if name == "azure":
+        from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter
+
+        return AzureMonitorTraceExporter(connection_string=connection_string)
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "file":
+        return FileSpanExporter(TRACING_FILE)
+    return None
+
+
+# Set up span export
+tracer_provider = TracerProvider(
+    resource=Resource.create({"service.name": "kobo-connect"}),
+    sampler=ParentBased(TraceIdRatioBased(TRACING_SAMPLE_RATIO)),
+)
+span_exporter = get_span_exporter(TRACING_EXPORTER)
+if span_exporter is not None:
+    tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+trace.set_tracer_provider(tracer_provider)
+tracer = trace.get_tracer("kobo-connect")
+
+
+def set_submission_attributes(
+    kobo_data: dict[str, Any] | None = None, target: str | None = None, **attributes
+):
+    """Set the submission, form and target attributes of the current request.
+
+    They are added to the current span and to every span started afterwards
+    while processing the request. Only the host of ``target`` is recorded,
+    since target URLs can contain credentials (e.g. Bitrix24 webhooks).
+    """
+    if kobo_data is not None:
+        for attribute, key in (
+            ("kobo.form_id", "_xform_id_string"),
+            ("kobo.form_version", "__version__"),
+            ("kobo.submission_id", "_id"),
+            ("kobo.submission_uuid", "_uuid"),
+        ):
+            if key in kobo_data:
+                attributes[attribute] = str(kobo_data[key])
+    if target:
+        attributes["target.host"] = urlsplit(target).netloc or target
+    attributes = {key: str(value) for key, value in attributes.items()}
+    span_attributes.set({**span_attributes.get(), **attributes})
+    trace.get_current_span().set_attributes(attributes)
+
+
+def traced(name: str | None = None):
+    """Run an async function in a span carrying the submission attributes."""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(
+                span_name, attributes=span_attributes.get()
+            ):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,8 +1,13 @@
-import requests
+import csv
+import httpx
 import unicodedata
+from functools import lru_cache
 from fastapi import HTTPException, Header
 from datetime import datetime, timedelta
 from utils.logger import logger
+from utils.tracing import traced
+from utils.metrics import record_cache
+from clients import http_client
 
 
 def clean_text(text):
@@ -15,6 +20,15 @@ def clean_text(text):
     return cleaned_text
 
 
+@lru_cache(maxsize=1)
+def kobo121_field_types() -> dict[str, str]:
+    """121 question type of each Kobo question type, read once."""
+    with open("mappings/kobo121fieldtypes.csv", newline="") as csvfile:
+        reader = csv.reader(csvfile, delimiter="\t")
+        next(reader, None)
+        return {row[0]: row[1] for row in reader if len(row) == 2}
+
+
 def required_headers_121(
     url121: str = Header(), username121: str = Header(), password121: str = Header()
 ):
@@ -23,7 +37,8 @@ def required_headers_121(
 # Dictionary to store cookies, credentials, and expiration times
 cookie121 = {}
 
-def login121(url121, username, password):
+@traced()
+async def login121(url121, username, password):
     # Check if URL exists in the dictionary
     if url121 in cookie121:
         cookie_data = cookie121[url121]
@@ -35,18 +50,20 @@ def login121(url121, username, password):
             # Check if the cookie is valid for at least 24 more hours
             if (cookie_expiry - current_time) >= timedelta(hours=24):
                 logger.info(f"Using cached cookie for {url121}")
+                record_cache("121_token", True)
                 return cookie_data['cookie']
             else:
                 logger.info(f"Cookie for {url121} is valid for less than 24 hours, refreshing cookie...")
 
     # Otherwise, request a new cookie
+    record_cache("121_token", False)
     body = {'username': username, 'password': password}
     url = f'{url121}/api/users/login'
     
     try:
-        login_response = requests.post(url, data=body)
+        login_response = await http_client.post(url, data=body)
         login_response.raise_for_status()
-    except requests.RequestException as e:
+    except httpx.HTTPStatusError as e:
         error_message = str(e)
         logger.error(
             f"Failed: 121 login returned {login_response.status_code} {error_message}",
@@ -55,6 +72,10 @@ def login121(url121, username, password):
         raise HTTPException(
             status_code=login_response.status_code, detail=error_message
         )
+    except httpx.HTTPError as e:
+        error_message = str(e)
+        logger.error(f"Failed: 121 login failed {error_message}", extra=None)
+        raise HTTPException(status_code=502, detail=error_message)
     
     # Parse the response
     response_data = login_response.json()
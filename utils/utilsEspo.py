@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import asyncio
 from typing import Any
 
 from fastapi import Header, HTTPException
 from utils.logger import logger
+from utils.tracing import traced
 
 
-def espo_request(
+@traced()
+async def espo_request(
     espo_client: Any,
     method: str,
     entity: str,
@@ -15,7 +18,7 @@ def espo_request(
 ) -> dict[str, Any] | None:
     """Make a request to EspoCRM. Returns the response dict on success, or None on failure."""
     try:
-        response = espo_client.request(method, entity, params)
+        response = await espo_client.request(method, entity, params)
         return response
     except HTTPException as e:
         detail = e.detail if "Unknown Error" not in e.detail else ""
@@ -27,3 +30,21 @@ def required_headers_espocrm(
     targeturl: str = Header(), targetkey: str = Header()
 ) -> tuple[str, str]:
     return targeturl, targetkey
+
+
+async def create_records(
+    espo_client: Any,
+    payload: dict[str, dict[str, Any]],
+    logs: dict[str, Any] | None = None,
+) -> dict[str, dict[str, Any] | None]:
+    """Create the records of several entities concurrently, over the pooled connections.
+
+    Returns the response dict of each entity, or None if its record failed.
+    """
+    responses = await asyncio.gather(
+        *(
+            espo_request(espo_client, "POST", entity, params=params, logs=logs)
+            for entity, params in payload.items()
+        )
+    )
+    return dict(zip(payload, responses))
@@ -1,8 +1,33 @@
-import requests
+import httpx
+import asyncio
+import os
+import re
 import time
-from fastapi import Header
-import sys
+import orjson
+from functools import lru_cache
+from dotenv import load_dotenv
+from fastapi import Header, HTTPException, Request
 from utils.logger import logger
+from utils.tracing import traced
+from utils.metrics import ATTACHMENT_BYTES
+from utils.fanout import run_shared
+from utils.attachment_cache import attachment_cache, cache_key
+from clients import http_client
+
+# load environment variables
+load_dotenv()
+
+KOBO_URL = os.getenv("KOBO_URL", "https://kobo.ifrc.org").rstrip("/")
+KOBO_API_URL = f"{KOBO_URL}/api/v2"
+KOBO_MEDIA_URL = os.getenv("KOBO_MEDIA_URL", "https://kc.ifrc.org/media/original")
+# Kobo stores attachments some time after sending the submission to the hook
+KOBO_ATTACHMENT_DELAY = float(os.getenv("KOBO_ATTACHMENT_DELAY", "30"))
+KOBO_ATTACHMENT_RETRY_DELAY = float(os.getenv("KOBO_ATTACHMENT_RETRY_DELAY", "10"))
+KOBO_ATTACHMENT_RETRY_TIMEOUT = float(os.getenv("KOBO_ATTACHMENT_RETRY_TIMEOUT", "60"))
+KOBO_MAX_BODY_BYTES = int(os.getenv("KOBO_MAX_BODY_BYTES", str(20 * 2**20)))
+
+# control fields read by the routes, kept when parsing only the mapped fields
+CONTROL_FIELDS = {"uuid", "skipconnect", "updaterecordby", "operation", "id"}
 
 
 def required_headers_kobo(kobotoken: str = Header(), koboasset: str = Header()):
@@ -19,38 +44,83 @@ def required_headers_121_kobo(
     return url121, username121, password121, kobotoken, koboasset
 
 
-def get_kobo_attachment(URL, kobo_token):
-    """Get attachment from kobo"""
+@traced()
+async def get_kobo_attachment(URL, kobo_token):
+    """Get attachment from kobo, or from the attachment cache"""
+    return await run_shared(
+        ("attachment", URL, kobo_token), lambda: cached_kobo_attachment(URL, kobo_token)
+    )
+
+
+async def cached_kobo_attachment(URL, kobo_token):
+    key = cache_key(URL, kobo_token or "")
+    data = await attachment_cache.get(key)
+    if data is None:
+        data, complete = await download_kobo_attachment(URL, kobo_token)
+        if complete:
+            await attachment_cache.put(key, data)
+    return data
+
+
+def is_kobo_placeholder(response: httpx.Response) -> bool:
+    """Whether Kobo answered in place of an attachment it has not stored yet."""
+    if response.status_code == 404:
+        return True
+    content_type = response.headers.get("content-type", "")
+    return response.status_code == 200 and content_type.startswith(
+        ("text/html", "application/json")
+    )
+
+
+async def download_kobo_attachment(URL, kobo_token):
+    """Download an attachment; also return whether it is complete, to be cached.
+
+    Kobo stores attachments some time after sending the submission, so the
+    download is retried for up to KOBO_ATTACHMENT_RETRY_TIMEOUT seconds while
+    Kobo answers with a placeholder. Small attachments (e.g. signatures) are
+    returned at once.
+    """
     headers = {"Authorization": f"Token {kobo_token}"}
-    timeout = time.time() + 60  # 1 minute from now
+    timeout = time.time() + KOBO_ATTACHMENT_RETRY_TIMEOUT
     while True:
-        data_request = requests.get(URL, headers=headers)
-        data = data_request.content
-        if sys.getsizeof(data) > 1000 or time.time() > timeout:
+        data_request = await http_client.get(URL, headers=headers)
+        if not is_kobo_placeholder(data_request) or time.time() > timeout:
             break
-        time.sleep(10)
-    return data
+        await asyncio.sleep(KOBO_ATTACHMENT_RETRY_DELAY)
+    data = data_request.content
+    ATTACHMENT_BYTES.inc(len(data))
+    complete = data_request.status_code == 200 and not is_kobo_placeholder(data_request)
+    return data, complete
 
 
-def get_attachment_dict(kobo_data, kobotoken=None, koboasset=None):
+@traced()
+async def get_attachment_dict(kobo_data, kobotoken=None, koboasset=None):
     """Create a dictionary that maps the attachment filenames to their URL."""
+    attachments = await run_shared(
+        ("attachments", kobo_data.get("_id"), kobotoken, koboasset),
+        lambda: fetch_attachment_dict(kobo_data, kobotoken, koboasset),
+    )
+    return dict(attachments)
+
+
+async def fetch_attachment_dict(kobo_data, kobotoken=None, koboasset=None):
     attachments, attachments_list = {}, []
     
     try:
         if kobotoken and koboasset and "_id" in kobo_data.keys():
-            time.sleep(30)
+            await asyncio.sleep(KOBO_ATTACHMENT_DELAY)
             headers = {"Authorization": f"Token {kobotoken}"}
-            URL = f"https://kobo.ifrc.org/api/v2/assets/{koboasset}/data/{kobo_data['_id']}/?format=json"
+            URL = f"{KOBO_API_URL}/assets/{koboasset}/data/{kobo_data['_id']}/?format=json"
             
             try:
-                data_request = requests.get(URL, headers=headers, timeout=30)
+                data_request = await http_client.get(URL, headers=headers, timeout=30)
                 data_request.raise_for_status()
                 data = data_request.json()
                 
                 if "_attachments" in data.keys():
                     attachments_list = data["_attachments"]
                     logger.info(f"Retrieved {len(attachments_list)} attachments from API for submission {kobo_data['_id']}")
-            except requests.exceptions.RequestException as e:
+            except httpx.HTTPError as e:
                 logger.error(f"Failed to fetch attachment data from Kobo API for submission {kobo_data['_id']}: {e}")
                 # Fall back to using attachments from kobo_data if available
             except ValueError as e:
@@ -74,7 +144,7 @@ def get_attachment_dict(kobo_data, kobotoken=None, koboasset=None):
                 try:
                     filename = attachment["filename"].split("/")[-1]
                     downloadurl = (
-                        "https://kc.ifrc.org/media/original?media_file="
+                        f"{KOBO_MEDIA_URL}?media_file="
                         + attachment["filename"]
                     )
                     mimetype = attachment["mimetype"]
@@ -92,6 +162,71 @@ def get_attachment_dict(kobo_data, kobotoken=None, koboasset=None):
     return attachments
 
 
+async def read_body(request: Request, max_bytes: int | None = None) -> bytes:
+    """Read the request body, failing with 413 as soon as it exceeds max_bytes."""
+    max_bytes = KOBO_MAX_BODY_BYTES if max_bytes is None else max_bytes
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail="Submission too large")
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail="Submission too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def mapped_fields(header_keys) -> frozenset[str]:
+    """Kobo fields that may be referenced by a header mapping.
+
+    Header keys carry prefixes such as ``multi.``, ``repeat.group.0.question``,
+    ``repeat:group:0:question`` or ``attachment-``; every part is included, so
+    the result is a superset of the fields actually read.
+    """
+    return compile_mapped_fields(tuple(header_keys))
+
+
+@lru_cache(maxsize=1024)
+def compile_mapped_fields(header_keys: tuple[str, ...]) -> frozenset[str]:
+    # the same REST service sends the same headers, so this is computed once
+    fields = set()
+    for key in header_keys:
+        key = key.lower()
+        fields.update([key, *re.split(r"[.:]", key), *key.split("-")])
+    return frozenset(fields)
+
+
+async def parse_kobo_submission(request: Request, fields: frozenset[str] | None = None):
+    """Parse a Kobo submission from the request body.
+
+    If ``fields`` is given, only these fields (matched on their lowercase name
+    without group), the metadata fields (``_id``, ``__version__``, ...) and the
+    control fields are kept, so that the rest of the submission is released
+    right after decoding instead of being held, and copied, while the
+    submission is processed.
+    """
+    return load_kobo_submission(await read_body(request), fields)
+
+
+def load_kobo_submission(body: bytes, fields: frozenset[str] | None = None):
+    """Decode a Kobo submission, keeping only ``fields`` if given."""
+    try:
+        kobo_data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(kobo_data, dict):
+        raise HTTPException(status_code=422, detail="Not a valid Kobo submission")
+    if fields is not None:
+        fields = fields | CONTROL_FIELDS
+        kobo_data = {
+            key: value
+            for key, value in kobo_data.items()
+            if key.startswith("_") or key.lower().split("/")[-1] in fields
+        }
+    return kobo_data
+
+
 def clean_kobo_data(kobo_data):
     """Clean Kobo data by removing group names and converting keys to lowercase."""
     kobo_data_clean = {k.lower(): v for k, v in kobo_data.items()}
@@ -102,6 +237,24 @@ def clean_kobo_data(kobo_data):
     return kobo_data_clean
 
 
+async def find_kobo_hook(koboasset, kobotoken, name, endpoint):
+    """Look up a REST service of a Kobo form by name and endpoint.
+
+    Used before retrying the creation of a REST service, which is not idempotent.
+    Returns a response with the existing REST service, or None if not found.
+    """
+    response = await http_client.get(
+        f"{KOBO_API_URL}/assets/{koboasset}/hooks/?format=json",
+        headers={"Authorization": f"Token {kobotoken}"},
+    )
+    if response.status_code != 200:
+        return None
+    for hook in response.json().get("results", []):
+        if hook.get("name") == name and hook.get("endpoint") == endpoint:
+            return httpx.Response(201, json=hook)
+    return None
+
+
 def required_headers_linked_kobo(
     kobotoken: str = Header(),
     childasset: str = Header(),
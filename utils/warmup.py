@@ -0,0 +1,133 @@
+"""Warm-up of an instance before it takes submissions.
+
+Without it, the first submissions after a deploy or scale-out pay for DNS
+resolution and TLS handshakes, the first CosmosDB request, 121 logins and the
+first related-entity lookups. On startup, concurrently:
+- Kobo and the URLs in WARMUP_URLS (``url,...``) are requested, which leaves
+  open connections in the pool of the shared HTTP client;
+- CosmosDB (if configured) is read once;
+- the 121 instances in WARMUP_121 (``url=username:password,...``) are logged
+  into, caching their tokens;
+- the mappings of the registry are compiled, and the related entities that
+  their EspoCRM field mappings look up are preloaded;
+- the Kobo-to-121 field types are read.
+
+Every step is best effort: failures are logged, and the warm-up stops
+waiting after WARMUP_TIMEOUT seconds. /ready does not report the instance
+as ready before the warm-up has finished (see ``utils.health``).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable
+
+from dotenv import load_dotenv
+from clients.espo_api_client import EspoAPI
+from routes.routesEspo import parse_target_field, preload_related_entities
+from utils import cosmos, health
+from utils.logger import logger
+from utils.mappings import preload_mapping_plans
+from utils.utils121 import kobo121_field_types, login121
+from utils.utilsKobo import KOBO_API_URL
+
+# load environment variables
+load_dotenv()
+
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "60"))
+
+
+def parse_urls(value: str) -> list[str]:
+    """Parse ``url,...`` into a list of URLs."""
+    return [url.strip() for url in value.split(",") if url.strip()]
+
+
+def parse_logins_121(value: str) -> list[tuple[str, str, str]]:
+    """Parse ``url=username:password,...`` into [(url, username, password)]."""
+    logins = []
+    for item in value.split(","):
+        url, _, credentials = item.partition("=")
+        username, _, password = credentials.partition(":")
+        if url.strip() and username:
+            logins.append((url.strip(), username.strip(), password.strip()))
+    return logins
+
+
+def get_related_lookups(mappings: list[dict[str, Any]]) -> set[tuple[str, str, str, str]]:
+    """Related-entity lookups of EspoCRM mappings: {(url, key, entity, field)}."""
+    lookups = set()
+    for mapping in mappings:
+        headers = mapping["headers"]
+        if mapping["target"] != "espocrm" or not headers.get("targeturl"):
+            continue
+        for value in headers.values():
+            target_field = parse_target_field(value)
+            if target_field is not None and target_field.related:
+                lookups.add(
+                    (
+                        headers["targeturl"],
+                        headers.get("targetkey", ""),
+                        target_field.related_entity,
+                        target_field.related_entity_field,
+                    )
+                )
+    return lookups
+
+
+async def preload_mappings():
+    """Compile the mappings and preload the related entities they look up."""
+    mappings = await preload_mapping_plans()
+    results = await asyncio.gather(
+        *(
+            preload_related_entities(EspoAPI(url, key), entity, field, {})
+            for url, key, entity, field in get_related_lookups(mappings)
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Warm-up: failed to preload related entities: {result}")
+    lookups = sum(result for result in results if isinstance(result, int))
+    logger.info(f"Warm-up: compiled {len(mappings)} mappings, preloaded {lookups} lookups")
+
+
+async def run_step(name: str, step: Awaitable[Any]) -> bool:
+    """Run a warm-up step, logging its failure."""
+    try:
+        await step
+        return True
+    except Exception as e:
+        logger.warning(f"Warm-up: {name} failed: {str(e) or type(e).__name__}")
+        return False
+
+
+async def warm_up():
+    """Warm up the instance, then let /ready report it as ready."""
+    start = time.perf_counter()
+    steps = {"kobo": health.probe_url(KOBO_API_URL)}
+    for url in parse_urls(os.getenv("WARMUP_URLS", "")):
+        steps[url] = health.probe_url(url)
+    if cosmos.cosmos_container_client is not None:
+        steps["cosmosdb"] = health.probe_cosmos()
+    for url, username, password in parse_logins_121(os.getenv("WARMUP_121", "")):
+        steps[f"121 login to {url}"] = login121(url, username, password)
+    steps["mappings"] = preload_mappings()
+    steps["121 field types"] = asyncio.to_thread(kobo121_field_types)
+
+    tasks = [asyncio.ensure_future(run_step(name, step)) for name, step in steps.items()]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=WARMUP_TIMEOUT)
+    finally:
+        for task in tasks:
+            task.cancel()
+    warmed = sum(task.result() for task in done)
+    status = "done" if not pending else "timed out"
+    logger.info(
+        f"Warm-up {status} in {time.perf_counter() - start:.1f}s, "
+        f"{warmed} of {len(steps)} steps succeeded"
+    )
+    health.readiness["warmup"] = status
+    # report readiness now rather than at the next periodic check
+    await health.check_dependencies()
@@ -0,0 +1,112 @@
+"""Buffer of writes to a target, flushed in batches.
+
+Writes are grouped per key (e.g. a Bitrix24 webhook) and flushed together
+once ``max_batch`` writes are pending or ``max_delay`` seconds after the first
+one, whichever comes first. A write never waits more than half of the time
+left to the deadline of its submission. Every write waits for the outcome of its own item
+in the batch, so a failed record only fails the submission it belongs to.
+
+A batch is sent in a context of its own, not in the one of the submission
+that started it: its span links to the span of every write in it, and its
+deadline is the earliest deadline of the submissions still waiting for it. Writes of submissions that
+were cancelled (e.g. at their deadline) are left out.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple
+
+from opentelemetry import trace
+from utils.deadline import deadline, remaining
+from utils.logger import logger
+from utils.metrics import WRITE_BATCH_SIZE
+from utils.tracing import tracer
+
+# flush(key, items) returns one result (or exception) per item, in order
+Flush = Callable[[Hashable, list[Any]], Awaitable[list[Any]]]
+
+
+class PendingWrite(NamedTuple):
+    """A write waiting in a buffer, with the deadline and span of its submission."""
+
+    item: Any
+    deadline: float | None
+    span: trace.SpanContext
+    future: asyncio.Future
+
+
+class WriteBuffer:
+    """Accumulate writes per key and flush them in batches."""
+
+    def __init__(self, name: str, flush: Flush, max_batch: int, max_delay: float):
+        self.name = name
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending: dict[Hashable, list[PendingWrite]] = {}
+        self.timers: dict[Hashable, asyncio.TimerHandle] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        """Add a write to the batch of its key and wait for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append(
+            PendingWrite(item, deadline.get(), trace.get_current_span().get_span_context(), future)
+        )
+        if len(batch) >= self.max_batch:
+            self.flush_key(key)
+            return await future
+        # a write waits at most half of the time left to its deadline
+        delay = self.max_delay
+        left = remaining()
+        if left is not None:
+            delay = min(delay, max(left, 0.0) / 2)
+        timer = self.timers.get(key)
+        if timer is None or timer.when() > loop.time() + delay:
+            if timer is not None:
+                timer.cancel()
+            self.timers[key] = loop.call_later(
+                delay, self.flush_key, key, context=contextvars.Context()
+            )
+        return await future
+
+    def flush_key(self, key: Hashable):
+        """Send the pending batch of a key in the background."""
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = [write for write in self.pending.pop(key, []) if not write.future.done()]
+        if batch:
+            task = asyncio.get_running_loop().create_task(
+                self.send(key, batch), context=contextvars.Context()
+            )
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, key: Hashable, batch: list[PendingWrite]):
+        deadlines = [write.deadline for write in batch if write.deadline is not None]
+        if deadlines:
+            deadline.set(min(deadlines))
+        WRITE_BATCH_SIZE.labels(self.name).observe(len(batch))
+        links = [trace.Link(write.span) for write in batch if write.span.is_valid]
+        with tracer.start_as_current_span(
+            f"write batch {self.name}",
+            links=links,
+            attributes={"batch.size": len(batch)},
+        ):
+            try:
+                results = await self.flush(key, [write.item for write in batch])
+            except Exception as e:
+                logger.error(f"Failed to flush {len(batch)} writes of {self.name}: {e}")
+                results = [e] * len(batch)
+        for write, result in zip(batch, results):
+            if write.future.done():
+                continue
+            if isinstance(result, BaseException):
+                write.future.set_exception(result)
+            else:
+                write.future.set_result(result)